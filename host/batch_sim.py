@@ -0,0 +1,402 @@
+"""
+Simulates thousands of blimps at once, as NumPy arrays, to rank controller
+settings without flying them. Needs numpy.
+
+Each blimp hovers in a room (setpoint 0) after being released with a random
+trim, i.e. a ballonet fill that isn't neutral, so it starts drifting up or
+down and the controller has to find neutral buoyancy by pumping. The model:
+  - buoyancy from the ballonet fill, with a slow thermal swing, and drag
+  - the pump moves the fill at a fixed rate and draws fixed power while on
+  - the floor and the ceiling stop the blimp (counted as hits)
+  - barometer: noise plus a slow random-walk bias
+  - ToF: valid below its range; beyond it, and on random dropouts, it
+    reads out of range like correct_VL53L0X() returns
+  - sonar: valid between its minimum and maximum range; random dropouts
+    read nothing, like the TypeError read_buffered() raises on a bad frame
+MODEL holds the constants, --model name=value changes them.
+
+The controller part is the vectorized form of what one tick of
+ballonet_controller does: ALTITUDE.fuse() with the floor recalibration,
+ballonet_logic.estimate() (smoothing, the linear fit over n_s samples and
+its velocity units) and ballonet_logic.decide(). --self-test checks those
+against the scalar code.
+
+Settings are swept on a grid. Blimps with the same n_s and T run as one
+batch, one column per (setting, replicate). Every setting sees the same
+replicates (trims, noise, dropouts), so the differences between settings
+aren't noise from the draws. A blimp has settled once its true velocity
+stays within --band mm/s, off the floor and ceiling, to the end; one that
+hasn't settled for the last --hold s counts as the whole --duration.
+Settings are ranked by mean settling time plus --energy-weight s per J of
+pump energy.
+
+    python host/batch_sim.py
+    python host/batch_sim.py --grid bangbang_tolerance=20,40,60,80 --grid n_s=3,5 --replicates 500
+    python host/batch_sim.py --csv sweep.csv --top 20
+
+"""
+
+import argparse
+import itertools
+import csv
+import sys
+import time
+
+import numpy as np
+
+import mpcompat
+
+mpcompat.install()
+
+import ballonet_logic  # noqa: E402 (needs mpcompat first)
+
+# setting: values swept when --grid doesn't give them
+GRID = {
+    'bangbang_tolerance': (20.0, 50.0, 80.0),
+    'n_s': (3, 5, 8),
+    'T': (500, 1000),
+    'barometer_drift': (0.5, 1.0, 2.0),
+    'calibration_drift': (0.1, 0.25),
+}
+_INTEGER = ('n_s', 'T')
+
+MODEL = {
+    'room': 6.0,  # m, floor to ceiling
+    'start_low': 1.0,  # m, released between these heights
+    'start_high': 3.0,
+    'trim': 0.15,  # standard deviation of the neutral fill, as a fraction of the ballonet
+    'fill_lift': 0.2,  # m/s^2 of lift per whole ballonet of air pumped out
+    'thermal_lift': 0.005,  # m/s^2 amplitude of the slow thermal swing
+    'thermal_period': 600.0,  # s
+    'drag': 0.3,  # 1/s linear drag
+    'quadratic_drag': 0.5,  # 1/m
+    'flow': 1 / 60,  # ballonets per s the pump moves
+    'pump_power': 1.5,  # W
+    'step': 0.05,  # s, physics time step
+    'barometer_noise': 0.08,  # m
+    'barometer_walk': 0.005,  # m/sqrt(s), bias random walk
+    'tof_range': 1.2,  # m
+    'tof_noise': 0.005,  # m
+    'tof_dropout': 0.05,
+    'sonar_min': 0.2,  # m
+    'sonar_max': 7.5,  # m
+    'sonar_noise': 0.01,  # m
+    'sonar_dropout': 0.1,
+    'floor_height': 0.5,  # controller settings for the room
+    'ceiling_height': 5.0,
+}
+
+WARM_UP_MS = 300  # ballonet_controller's warm-up tick
+
+
+# ALTITUDE.fuse() for arrays. Distances are mm, NaN or +-inf when there's no
+# valid reading. Updates `floor` in place and returns the altitudes and
+# whether a rangefinder was used.
+def fuse(raw, sr, lr, floor, barometer_drift, calibration_drift):
+    barometer = raw - floor
+    sr = sr / 1000
+    lr = lr / 1000
+    sr_valid = (sr > 0) & (sr < np.inf)
+    lr_valid = (lr > 0) & (lr < np.inf)
+    distance = np.where(sr_valid, sr, np.where(lr_valid, lr, np.nan))
+    deviation = np.abs(distance - barometer)
+    ranged = (sr_valid | lr_valid) & (deviation < barometer_drift)
+    recalibrate = ranged & (deviation < calibration_drift)
+    floor[recalibrate] = raw[recalibrate] - distance[recalibrate]
+    return np.where(ranged, distance, barometer), ranged
+
+
+# ballonet_logic.estimate() for arrays. h and dt are (blimps, n_s) windows of
+# the smoothed altitudes and ms between samples, newest last, shifted in place.
+def estimate(h, dt, meters, dt_ms):
+    smoothed = 0.5 * meters + 0.5 * h[:, -1]
+    h[:, :-1] = h[:, 1:]
+    h[:, -1] = smoothed
+    dt[:, :-1] = dt[:, 1:]
+    dt[:, -1] = dt_ms
+    n = h.shape[1]
+    x = np.cumsum(dt, axis=1)
+    sumx = x.sum(axis=1)
+    sumy = h.sum(axis=1)
+    slope = (n * (x * h).sum(axis=1) - sumx * sumy) / (n * (x * x).sum(axis=1) - sumx * sumx)
+    # same units as the controller's velocity
+    return np.trunc(slope * 1000 * 1000 / (dt.sum(axis=1) / 1000))
+
+
+# ballonet_logic.decide() for arrays: PUMP_IN, PUMP_OUT or IDLE per blimp
+def decide(altitude, velocity, setpoint, floor_height, ceiling_height, tolerance):
+    setpoint = np.where(altitude < floor_height, setpoint + ballonet_logic.BOUNDARY_PUSH,
+                        np.where(altitude > ceiling_height, setpoint - ballonet_logic.BOUNDARY_PUSH, setpoint))
+    e = velocity - setpoint
+    return np.where(np.abs(e) > tolerance,
+                    np.where(e > 0, ballonet_logic.PUMP_IN, ballonet_logic.PUMP_OUT),
+                    ballonet_logic.IDLE)
+
+
+class Batch:
+    # configs: dicts of the swept settings, all with this n_s and T.
+    # Blimp k runs configs[k // replicates] on replicate k % replicates.
+    def __init__(self, configs, n_s, T, replicates, model, rng):
+        self.n_s = n_s
+        self.T = T
+        self.model = model
+        self.rng = rng
+        self.replicates = replicates
+        self.size = len(configs) * replicates
+        self.tolerance = np.repeat([c['bangbang_tolerance'] for c in configs], replicates)
+        self.barometer_drift = np.repeat([c['barometer_drift'] for c in configs], replicates)
+        self.calibration_drift = np.repeat([c['calibration_drift'] for c in configs], replicates)
+        # the same replicates for every config
+        self.height = self._tile(rng.uniform(model['start_low'], model['start_high'], replicates))
+        self.neutral = self._tile(0.5 + model['trim'] * rng.standard_normal(replicates))
+        self.phase = self._tile(rng.uniform(0, 2 * np.pi, replicates))
+        self.velocity = np.zeros(self.size)
+        self.fill = np.full(self.size, 0.5)
+        self.bias = np.zeros(self.size)
+        self.floor = np.zeros(self.size)  # ALTITUDE.floor_altitude; the barometer reads height above the floor
+        self.direction = np.zeros(self.size, dtype=np.int8)
+        self.time = 0.0
+        self.energy = np.zeros(self.size)
+        self.hits = np.zeros(self.size, dtype=np.int32)
+        self.touching = np.zeros(self.size, dtype=bool)
+        self.last_unsettled = np.zeros(self.size)
+        self.ranged = np.zeros(self.size)
+        self.ticks = 0
+
+    def _tile(self, values):
+        return np.tile(values, self.size // self.replicates)
+
+    def _noise(self):
+        return self._tile(self.rng.standard_normal(self.replicates))
+
+    def _chance(self, p):
+        return self._tile(self.rng.random(self.replicates) < p)
+
+    def advance(self, seconds):
+        m = self.model
+        steps = max(1, int(round(seconds / m['step'])))
+        step = seconds / steps
+        for k in range(steps):
+            thermal = m['thermal_lift'] * np.sin(2 * np.pi * self.time / m['thermal_period'] + self.phase)
+            acceleration = (m['fill_lift'] * (self.neutral - self.fill) + thermal
+                            - m['drag'] * self.velocity
+                            - m['quadratic_drag'] * self.velocity * np.abs(self.velocity))
+            self.velocity += acceleration * step
+            self.height += self.velocity * step
+            touching = (self.height <= 0) | (self.height >= m['room'])
+            if touching.any():
+                self.velocity[touching] = 0
+                np.clip(self.height, 0, m['room'], out=self.height)
+            self.hits += touching & ~self.touching
+            self.touching = touching
+            # pumping in adds air to the ballonet, which makes the blimp heavier
+            self.fill += self.direction * m['flow'] * step
+            np.clip(self.fill, 0, 1, out=self.fill)
+            self.energy += (self.direction != 0) * m['pump_power'] * step
+            self.bias += m['barometer_walk'] * np.sqrt(step) * self._noise()
+            self.time += step
+
+    # Fused altitudes from one reading of each sensor
+    def measure(self):
+        m = self.model
+        raw = self.height + self.bias + m['barometer_noise'] * self._noise()
+        tof = self.height + m['tof_noise'] * self._noise()
+        tof = np.where((tof < m['tof_range']) & ~self._chance(m['tof_dropout']), tof * 1000, np.inf)
+        sonar = self.height + m['sonar_noise'] * self._noise()
+        in_range = (sonar > m['sonar_min']) & (sonar < m['sonar_max'])
+        sonar = np.where(in_range, sonar * 1000, np.inf)
+        sonar[self._chance(m['sonar_dropout'])] = np.nan
+        altitude, ranged = fuse(raw, tof, sonar, self.floor, self.barometer_drift, self.calibration_drift)
+        self.ranged += ranged
+        return altitude
+
+    def run(self, duration, band):
+        n_s = self.n_s
+        h = np.zeros((self.size, n_s))
+        dt = np.zeros((self.size, n_s))
+        # warm-up: n_s + 1 unsmoothed samples with the pump off
+        for i in range(n_s + 1):
+            if i:
+                self.advance(WARM_UP_MS / 1000)
+            h[:, :-1] = h[:, 1:]
+            h[:, -1] = self.measure()
+            dt[:, :-1] = dt[:, 1:]
+            dt[:, -1] = WARM_UP_MS if i else 0
+        start = self.time
+        period = self.T / 1000
+        while self.time - start < duration:
+            self.advance(period)
+            velocity = estimate(h, dt, self.measure(), self.T)
+            self.direction = decide(h[:, -1], velocity, 0.0, self.model['floor_height'],
+                                    self.model['ceiling_height'], self.tolerance).astype(np.int8)
+            unsettled = (np.abs(self.velocity * 1000) > band) | self.touching
+            self.last_unsettled[unsettled] = self.time - start
+            self.ticks += 1
+        return self.time - start
+
+
+# Runs every combination of the grid; one result dict per config
+def sweep(grid, replicates=200, duration=300.0, band=50.0, hold=30.0, model=None, seed=1):
+    model = dict(MODEL, **(model or dict()))
+    names = list(grid)
+    configs = [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+    groups = dict()
+    for config in configs:
+        groups.setdefault((config['n_s'], config['T']), []).append(config)
+    results = []
+    for (n_s, T), group in sorted(groups.items()):
+        batch = Batch(group, n_s, T, replicates, model, np.random.default_rng(seed))
+        flown = batch.run(duration, band)
+        settle = batch.last_unsettled.reshape(len(group), replicates)
+        settled = settle <= flown - hold
+        settle = np.where(settled, settle, flown)
+        energy = batch.energy.reshape(len(group), replicates)
+        hits = batch.hits.reshape(len(group), replicates)
+        ranged = batch.ranged.reshape(len(group), replicates) / batch.ticks
+        for k, config in enumerate(group):
+            results.append(dict(config, settle=float(settle[k].mean()), settle_p90=float(np.percentile(settle[k], 90)),
+                                settled=float(settled[k].mean()), energy=float(energy[k].mean()),
+                                hits=float(hits[k].mean()), ranged=float(ranged[k].mean())))
+    return results
+
+
+def rank(results, energy_weight=0.5):
+    for result in results:
+        result['score'] = result['settle'] + energy_weight * result['energy']
+    return sorted(results, key=lambda result: result['score'])
+
+
+def format_results(results, top=10):
+    lines = ["{:>9} {:>3} {:>5} {:>6} {:>6} | {:>7} {:>7} {:>7} {:>7} {:>5} {:>6} {:>7}".format(
+        "tolerance", "n_s", "T", "baro", "calib", "settle", "p90", "settled", "energy", "hits", "ranged", "score")]
+    for r in results[:top]:
+        lines.append("{:9.0f} {:3d} {:5d} {:6.2f} {:6.2f} | {:6.1f}s {:6.1f}s {:6.0f}% {:6.1f}J {:5.2f} {:5.0f}% {:7.1f}".format(
+            r['bangbang_tolerance'], r['n_s'], r['T'], r['barometer_drift'], r['calibration_drift'],
+            r['settle'], r['settle_p90'], 100 * r['settled'], r['energy'], r['hits'], 100 * r['ranged'], r['score']))
+    return lines
+
+
+def _scalar_fuse(raw, sr, lr, floor, barometer_drift, calibration_drift):
+    from altitude import ALTITUDE
+    altitude = ALTITUDE(None)
+    altitude.floor_altitude = floor
+    altitude.barometer_drift = barometer_drift
+    altitude.calibration_drift = calibration_drift
+    sr = None if np.isnan(sr) else sr
+    lr = None if np.isnan(lr) else lr
+    return altitude.fuse(raw, sr, lr), altitude.floor_altitude
+
+
+def self_test():
+    failures = []
+    rng = np.random.default_rng(3)
+
+    # the vectorized controller against the scalar code it copies
+    n = 2000
+    raw = rng.uniform(0, 4, n)
+    floor = rng.normal(0, 0.3, n)
+    choices = np.array([np.nan, np.inf, -np.inf, 0.0])
+    sr = np.where(rng.random(n) < 0.6, (raw - floor + rng.normal(0, 0.4, n)) * 1000, choices[rng.integers(0, 4, n)])
+    lr = np.where(rng.random(n) < 0.6, (raw - floor + rng.normal(0, 0.8, n)) * 1000, choices[rng.integers(0, 4, n)])
+    drifts = rng.uniform(0.1, 2, n), rng.uniform(0, 0.5, n)
+    vector_floor = floor.copy()
+    fused, ranged = fuse(raw, sr, lr, vector_floor, *drifts)
+    for k in range(n):
+        expected, expected_floor = _scalar_fuse(raw[k], sr[k], lr[k], floor[k], drifts[0][k], drifts[1][k])
+        if abs(expected - fused[k]) > 1e-9 or abs(expected_floor - vector_floor[k]) > 1e-9:
+            failures.append("fuse differs for {}".format((raw[k], sr[k], lr[k], floor[k])))
+            break
+    for n_s in (3, 5, 8):
+        b = 300
+        h = rng.uniform(0, 3, (b, n_s))
+        dt = rng.integers(450, 1050, (b, n_s)).astype(float)
+        meters = rng.uniform(0, 3, b)
+        tolerance = rng.uniform(0, 100, b)
+        histories = [{'altitude': list(h[k]), 'time': [500.0] + list(dt[k]), 'velocity': [0] * n_s} for k in range(b)]
+        velocity = estimate(h, dt, meters, 1000)
+        direction = decide(h[:, -1], velocity, 0.0, 0.5, 2.5, tolerance)
+        cfg = {'setpoint': 0.0, 'floor_height': 0.5, 'ceiling_height': 2.5}
+        for k in range(b):
+            expected = ballonet_logic.estimate(histories[k], meters[k], 1000, n_s, 120)
+            cfg['bangbang_tolerance'] = tolerance[k]
+            if abs(expected - velocity[k]) > 1:
+                failures.append("n_s={}: velocity {} vs {}".format(n_s, velocity[k], expected))
+                break
+            if expected == velocity[k] and ballonet_logic.decide(histories[k]['altitude'][-1], expected, cfg)[0] != direction[k]:
+                failures.append("n_s={}: decision differs".format(n_s))
+                break
+
+    grid = {'bangbang_tolerance': (0.0, 50.0, 1000.0), 'n_s': (5,), 'T': (1000,),
+            'barometer_drift': (1.0,), 'calibration_drift': (0.25,)}
+    started = time.perf_counter()
+    results = sweep(grid, replicates=300, duration=240, seed=4)
+    elapsed = time.perf_counter() - started
+    by_tolerance = dict((r['bangbang_tolerance'], r) for r in results)
+    for line in format_results(rank(results)):
+        print(line)
+    print("{} blimps over 240 s in {:.2f} s".format(900, elapsed))
+    if by_tolerance[1000.0]['energy'] != 0:
+        failures.append("a tolerance nothing exceeds still pumped")
+    if not by_tolerance[0.0]['energy'] > by_tolerance[50.0]['energy'] > 0:
+        failures.append("pump energy doesn't fall as the tolerance widens")
+    if not by_tolerance[50.0]['settled'] > by_tolerance[1000.0]['settled']:
+        failures.append("the controller doesn't settle more blimps than no control")
+    return mpcompat.report(failures)
+
+
+def _values(name, text):
+    kind = int if name in _INTEGER else float
+    return tuple(kind(value) for value in text.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help="values to sweep for one of: " + ", ".join(GRID))
+    parser.add_argument('--model', action='append', default=[], metavar='NAME=VALUE', help="change a MODEL constant")
+    parser.add_argument('--replicates', type=int, default=200, help="blimps per setting")
+    parser.add_argument('--duration', type=float, default=300.0, help="s of flight after the warm-up")
+    parser.add_argument('--band', type=float, default=50.0, help="mm/s of true velocity counted as settled")
+    parser.add_argument('--hold', type=float, default=30.0, help="s a blimp must stay settled at the end")
+    parser.add_argument('--energy-weight', type=float, default=0.5, help="s of settling time a J of pumping costs")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--top', type=int, default=10, help="settings to print")
+    parser.add_argument('--csv', help="write every setting's results to this CSV file")
+    parser.add_argument('--self-test', action='store_true', help="check the vectorized controller and a small sweep")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+
+    grid = dict(GRID)
+    for item in args.grid:
+        name, values = item.split('=', 1)
+        if name not in GRID:
+            parser.error("can't sweep " + name)
+        grid[name] = _values(name, values)
+    model = dict()
+    for item in args.model:
+        name, value = item.split('=', 1)
+        if name not in MODEL:
+            parser.error("no model constant " + name)
+        model[name] = float(value)
+
+    count = 1
+    for values in grid.values():
+        count *= len(values)
+    print("{} settings x {} replicates".format(count, args.replicates))
+    started = time.perf_counter()
+    results = rank(sweep(grid, args.replicates, args.duration, args.band, args.hold, model, args.seed),
+                   args.energy_weight)
+    print("simulated in {:.1f} s".format(time.perf_counter() - started))
+    for line in format_results(results, args.top):
+        print(line)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Host benchmark and accuracy check for the thermistor conversions in ntc.py.
+
+Run from the repository root with CPython:
+    python host/bench_ntc.py [table] [--r-series OHMS] [--lut-size N]
+
+Compares the original linear-scan conversion against binary search,
+Steinhart-Hart and the ratio lookup table. Accuracy is measured against the
+table itself (exact at table points) and against log-interpolated values at
+segment midpoints. Lookup table accuracy is only checked inside
+--lut-range. Exits non-zero if binary search doesn't reproduce the table,
+or the lookup table drifts more than --tolerance from binary search.
+
+"""
+
+import argparse
+import math
+import os
+import sys
+import timeit
+
+import mpcompat
+
+mpcompat.install()
+import ntc  # noqa: E402
+
+ROOT = mpcompat.ROOT
+
+
+# the conversion ntc.thermistor used before binary search, kept as the baseline
+def linear_scan(t, r_ntc):
+    nearest_r = min(t.table_r, key=lambda x: abs(x - r_ntc))
+    i = t.table_r.index(nearest_r)
+    if i <= 0:
+        i = 0
+    elif i >= len(t.table_r) - 1:
+        i = len(t.table_r) - 2
+    elif r_ntc > t.table_r[i]:
+        i -= 1
+    return t.linear_approximation(i, i + 1, r_ntc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('table', nargs='?', default=os.path.join(ROOT, 'epcos100k.tsv'))
+    parser.add_argument('--r-series', type=float, default=99.2e3)
+    parser.add_argument('--lut-size', type=int, default=256)
+    parser.add_argument('--lut-range', type=float, nargs=2, default=(-20, 80), metavar=('T_MIN', 'T_MAX'))
+    parser.add_argument('--tolerance', type=float, default=0.5, help="max LUT error in C")
+    parser.add_argument('-n', type=int, default=20000, help="conversions per timing run")
+    args = parser.parse_args(argv)
+
+    t = ntc.thermistor(args.table)
+    t.fit_steinhart_hart()
+    t.build_lut(args.r_series, args.lut_size, *args.lut_range)
+    t_min, t_max = args.lut_range
+
+    def ratio(r):
+        return r / (r + args.r_series)
+
+    # accuracy at table points
+    table_error = max(abs(t.get_temperature(r) - tc) for r, tc in zip(t.table_r, t.table_tc))
+    sh_error = max(abs(t.get_temperature_sh(r) - tc) for r, tc in zip(t.table_r, t.table_tc))
+    lut_error = max(abs(t.get_temperature_ratio(ratio(r)) - tc)
+                    for r, tc in zip(t.table_r, t.table_tc) if t_min <= tc <= t_max)
+
+    # accuracy between table points, against interpolation in ln(R)
+    mid_errors = {'bisect': 0.0, 'steinhart-hart': 0.0, 'lut': 0.0, 'lut vs bisect': 0.0}
+    for i in range(len(t.table_r) - 1):
+        r = math.sqrt(t.table_r[i] * t.table_r[i + 1])
+        tc = (t.table_tc[i] + t.table_tc[i + 1]) / 2
+        b = t.get_temperature(r)
+        mid_errors['bisect'] = max(mid_errors['bisect'], abs(b - tc))
+        mid_errors['steinhart-hart'] = max(mid_errors['steinhart-hart'], abs(t.get_temperature_sh(r) - tc))
+        if t_min <= t.table_tc[i] and t.table_tc[i + 1] <= t_max:
+            lut = t.get_temperature_ratio(ratio(r))
+            mid_errors['lut'] = max(mid_errors['lut'], abs(lut - tc))
+            mid_errors['lut vs bisect'] = max(mid_errors['lut vs bisect'], abs(lut - b))
+
+    print("Table: {} ({} rows)".format(args.table, len(t.table_r)))
+    print("Max error at table points (C): bisect {:.4f}, steinhart-hart {:.4f}, lut {:.4f} ({:g} to {:g} C)".format(
+        table_error, sh_error, lut_error, t_min, t_max))
+    print("Max error at segment midpoints (C): " + ", ".join(
+        "{} {:.4f}".format(k, v) for k, v in mid_errors.items()))
+
+    # timing over resistances spread across the table
+    lo = math.log(t.table_r[-1])
+    hi = math.log(t.table_r[0])
+    samples = [math.exp(lo + (hi - lo) * k / 997) for k in range(997)]
+    ratios = [ratio(r) for r in samples]
+
+    def run(fn, xs):
+        def loop():
+            for k in range(args.n):
+                fn(xs[k % len(xs)])
+        return timeit.timeit(loop, number=1) / args.n * 1e6
+
+    timings = (
+        ("linear scan", run(lambda r: linear_scan(t, r), samples)),
+        ("bisect", run(t.get_temperature, samples)),
+        ("steinhart-hart", run(t.get_temperature_sh, samples)),
+        ("lut", run(t.get_temperature_ratio, ratios)),
+    )
+    for name, us in timings:
+        print("{:>15}: {:7.3f} us/conversion ({:5.1f}x)".format(name, us, timings[0][1] / us))
+
+    if table_error > 1e-6 or mid_errors['lut vs bisect'] > args.tolerance:
+        print("FAIL")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+Replays logged flights through the controller's decision code
+(micropython_root/ballonet_logic.py, the same functions ballonet_controller
+runs every tick) and compares the pump commands with the ones flown, so a
+change to the logic or the settings can be checked against past flights
+without flying. Time comes from the log, never from the workstation's
+clock, so an hour of flight replays in well under a second.
+
+    python host/controller_replay.py FLIGHT --cfg ballonet_controller.json --set bangbang_tolerance=80
+FLIGHT is a flight folder written by ground_station.py. Each telemetry
+frame holds the smoothed altitude and the pump duty of one tick; the fused
+altitude that tick saw is recovered from two consecutive frames (the
+smoothing is h = (meters + previous h) / 2), fed through estimate() and
+decide() with the frames' board timestamps, and the result compared with
+the duty flown. This needs every tick's frame: telemetry at least as fast
+as the control rate (the default 10 Hz is). After a lost frame the history
+is rebuilt from the next n_s + 1 frames, which aren't compared. The first
+n_s + 1 frames of a flight fill the history the same way.
+
+--cfg is the settings file the flight used (ballonet_controller.json or
+the old ballonet_controller_cfg), --set changes it for the replay. Setpoint
+changes sent during the flight are followed from the log unless --set
+gives a setpoint. Velocities replay within a mm/s or so of the flown ones:
+the frames hold altitudes as float32 and are timestamped when sent, a little
+after the controller read its clock.
+
+    python host/controller_replay.py --readings readings.csv --set bangbang_tolerance=80
+replays sensor readings before fusion (from i2c_replay.py --readings)
+instead: ALTITUDE fuses them each tick like the controller's sensor tasks
+and altitude_from_readings() do, on a virtual clock ticking every --period
+ms. Those have no flown commands, so the replay with --set is compared with
+the replay of the --cfg settings alone.
+
+Exits with 1 if any command differs, for regression checks. --csv writes
+the tick-by-tick comparison. --self-test flies a simulated blimp and checks
+its log replays to the same commands.
+
+"""
+
+import argparse
+import csv
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import mpcompat
+
+mpcompat.install()
+
+import config  # noqa: E402 (needs mpcompat first)
+import ballonet_logic  # noqa: E402
+from ballonet_logic import PUMP_IN, PUMP_OUT, IDLE  # noqa: E402
+from altitude import ALTITUDE  # noqa: E402
+from ground_station import FlightLog, read_flight  # noqa: E402
+
+MAX_LIST_SIZE = 120  # ballonet_controller._MAX_LIST_SIZE
+WARM_UP_MS = 300  # ballonet_controller's warm-up tick
+_TICKS_PERIOD = 1 << 30
+_DIRECTIONS = {PUMP_IN: 'in', PUMP_OUT: 'out', IDLE: 'idle'}
+
+
+def _ticks_diff(new, old):
+    d = (new - old) % _TICKS_PERIOD
+    return d - _TICKS_PERIOD if d >= _TICKS_PERIOD // 2 else d
+
+
+def _direction(duty):
+    return PUMP_IN if duty > 0 else PUMP_OUT if duty < 0 else IDLE
+
+
+# ballonet_controller's settings from a saved file (JSON or the old text
+# format) or the defaults, with `changes` applied. Invalid changes raise ValueError.
+def load_settings(path=None, changes=None):
+    settings = config.CONFIG(path or 'ballonet_controller.json', ballonet_logic.SETTINGS)
+    if path and path.endswith('.json'):
+        settings.load()
+    elif path:
+        settings.import_legacy(path)
+    if changes:
+        settings.request(changes)
+        settings.apply()
+    return settings.values
+
+
+# One row per frame of a flight log: (time in s, flown direction, flown velocity,
+# replayed direction, replayed velocity), the replayed ones None if not compared.
+def replay_flight(columns, flown, candidate, n_s):
+    sequence = columns['sequence']
+    ticks = columns['ticks_ms']
+    altitude = columns['altitude']
+    tick_cfg = dict(candidate)
+    follow_setpoint = candidate['setpoint'] == flown['setpoint']
+    rows = []
+    history = None
+    elapsed = 0
+    for k in range(len(sequence)):
+        dt = _ticks_diff(ticks[k], ticks[k - 1]) if k else 0
+        elapsed += dt
+        flown_direction = _direction(columns['duty'][k])
+        if k == 0 or (sequence[k] - sequence[k - 1]) & 0xFFFF != 1:
+            history = ballonet_logic.new_history()
+        if len(history['altitude']) < n_s + 1:
+            ballonet_logic.prime(history, altitude[k], dt)
+            rows.append((elapsed / 1000, flown_direction, columns['velocity'][k], None, None))
+            continue
+        if follow_setpoint:
+            # the setpoint commanded, without the flown floor/ceiling push
+            pushed = ballonet_logic.adjusted_setpoint(altitude[k], flown) - flown['setpoint']
+            tick_cfg['setpoint'] = columns['setpoint'][k] - pushed
+        meters = 2 * altitude[k] - altitude[k - 1]  # undo the smoothing
+        velocity = ballonet_logic.estimate(history, meters, dt, n_s, MAX_LIST_SIZE)
+        direction, setpoint = ballonet_logic.decide(history['altitude'][-1], velocity, tick_cfg)
+        rows.append((elapsed / 1000, flown_direction, columns['velocity'][k], direction, velocity))
+    return rows
+
+
+def read_readings(path):
+    readings = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            value = float(row['value']) if row['value'] not in ('', 'None') else None
+            readings.append((float(row['time']), row['kind'], value))
+    readings.sort(key=lambda reading: reading[0])
+    return readings
+
+
+# Floor altitude from the first barometer reading with a range reading near it
+def floor_from_readings(readings, max_age_s):
+    last_range = None
+    first = None
+    for t, kind, value in readings:
+        if kind == 'sr' and value is not None and 0 < value < float('inf'):
+            last_range = (t, value)
+        elif kind == 'barometer':
+            if last_range and t - last_range[0] <= max_age_s:
+                return value - last_range[1] / 1000
+            if first is None:
+                first = value
+    return first or 0.0
+
+
+# Controller ticks over sensor readings (time in s, kind, value): a list of
+# (time in s, direction, velocity or None), like _controller_task would have
+# commanded with `cfg`. The clock is virtual, in ms from the first reading.
+def replay_readings(readings, cfg, n_s, period_ms, floor=None):
+    altitude = ALTITUDE(None)
+    altitude.barometer_drift = cfg['barometer_drift']
+    altitude.calibration_drift = cfg['calibration_drift']
+    altitude.floor_altitude = floor_from_readings(readings, period_ms / 1000) if floor is None else floor
+    latest = {'barometer': None, 'sr': None, 'lr': None}
+    state = {'next': 0, 'now': 0}
+
+    def advance(now):
+        state['now'] = now
+        while state['next'] < len(readings) and readings[state['next']][0] * 1000 <= now:
+            t, kind, value = readings[state['next']]
+            latest[kind] = (value, t * 1000)
+            state['next'] += 1
+
+    def fresh(name):
+        reading = latest[name]
+        if reading is None or state['now'] - reading[1] > period_ms:
+            return None
+        return reading[0]
+
+    def fused():
+        raw_altitude = fresh('barometer')
+        if raw_altitude is None:
+            return None
+        return altitude.fuse(raw_altitude, fresh('sr'), fresh('lr'))
+
+    end = readings[-1][0] * 1000 if readings else 0
+    now = 0
+    advance(now)
+    while fused() is None and now < end:
+        now += 20
+        advance(now)
+    history = ballonet_logic.new_history()
+    previous = now
+    for i in range(n_s + 1):
+        advance(now)
+        ballonet_logic.prime(history, fused(), now - previous)
+        previous = now
+        now += WARM_UP_MS
+    rows = []
+    while now <= end:
+        advance(now)
+        meters = fused()
+        if meters is None:
+            rows.append((now / 1000, IDLE, None))  # the controller stops the pump
+        else:
+            velocity = ballonet_logic.estimate(history, meters, now - previous, n_s, MAX_LIST_SIZE)
+            previous = now
+            direction, setpoint = ballonet_logic.decide(history['altitude'][-1], velocity, cfg)
+            rows.append((now / 1000, direction, velocity))
+        now += period_ms
+    return rows
+
+
+# rows of (time, reference direction, reference velocity, replayed direction,
+# replayed velocity); the replayed ones None where not compared
+def compare(rows):
+    compared = [row for row in rows if row[3] is not None]
+    differ = [row for row in compared if row[1] != row[3]]
+    result = {'ticks': len(rows), 'compared': len(compared), 'differ': len(differ),
+              'first': differ[0] if differ else None}
+    for name, index in (('reference', 1), ('replay', 3)):
+        directions = [row[index] for row in compared]
+        result[name + '_pumping'] = sum(1 for d in directions if d != IDLE) / len(directions) if directions else 0
+        result[name + '_switches'] = sum(1 for a, b in zip(directions, directions[1:]) if a != b)
+    velocities = [abs(row[4] - row[2]) for row in compared if row[2] is not None and row[4] is not None]
+    result['velocity_max_diff'] = max(velocities) if velocities else 0
+    return result
+
+
+def format_comparison(result, reference='flown'):
+    lines = ["{} ticks, {} compared".format(result['ticks'], result['compared'])]
+    if result['compared']:
+        lines.append("commands differ in {} ticks ({:.1f}%)".format(
+            result['differ'], 100 * result['differ'] / result['compared']))
+    if result['first']:
+        t, was, was_velocity, now, velocity = result['first']
+        lines.append("  first at {:.1f} s: {} {}, replay {} (velocity {} vs {} mm/s)".format(
+            t, reference, _DIRECTIONS[was], _DIRECTIONS[now], was_velocity, velocity))
+    lines.append("pumping {:.1f}% of ticks {}, {:.1f}% replayed; {} vs {} switches".format(
+        100 * result['reference_pumping'], reference, 100 * result['replay_pumping'],
+        result['reference_switches'], result['replay_switches']))
+    lines.append("velocity differs by at most {:.0f} mm/s".format(result['velocity_max_diff']))
+    return lines
+
+
+def write_csv(path, rows, reference='flown'):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('time', reference + '_direction', reference + '_velocity',
+                         'replay_direction', 'replay_velocity'))
+        writer.writerows(rows)
+
+
+# A blimp flown by ballonet_logic with a simple buoyancy model, logged like
+# ground_station does. Returns the number of frames written.
+def simulate_flight(path, cfg, n_s, period_ms, duration_s, seed=1, lose=()):
+    rng = random.Random(seed)
+    log = FlightLog(path, flush_rows=500)
+    height = 2.0
+    velocity = 0.0
+    ticks = rng.randrange(_TICKS_PERIOD)
+    history = ballonet_logic.new_history()
+    for i in range(n_s + 1):
+        ballonet_logic.prime(history, height + rng.gauss(0, 0.02), WARM_UP_MS if i else 0)
+    sequence = 0
+    direction = IDLE
+    elapsed = 0
+    while elapsed < duration_s * 1000:
+        dt = period_ms + rng.randint(-3, 3)
+        for k in range(dt // 10):
+            # pumping in sinks; the air warming and cooling lifts and sinks it slowly
+            lift = 100 * math.sin(2 * math.pi * (elapsed + 10 * k) / 600000)
+            acceleration = lift - 200 * direction - 0.2 * velocity + rng.gauss(0, 100)  # mm/s^2
+            velocity += acceleration * 0.01
+            height = max(0.0, height + velocity / 1e6 * 10)
+        elapsed += dt
+        ticks = (ticks + dt) % _TICKS_PERIOD
+        measured = ballonet_logic.estimate(history, height + rng.gauss(0, 0.02), dt, n_s, MAX_LIST_SIZE)
+        direction, setpoint = ballonet_logic.decide(history['altitude'][-1], measured, cfg)
+        if sequence not in lose:
+            log.append(time.time(), {
+                'sequence': sequence, 'ticks_ms': ticks, 'altitude': history['altitude'][-1],
+                'velocity': measured, 'setpoint': setpoint, 'source': 0, 'duty': direction * 1023,
+                'temperatures': (20.0, 20.0), 'faults': 0})
+        sequence = (sequence + 1) & 0xFFFF
+    log.close()
+    return sequence - len(lose)
+
+
+def self_test():
+    failures = []
+    folder = tempfile.mkdtemp(prefix='controller_replay_')
+    flown = load_settings(None, {'floor_height': 1.0, 'ceiling_height': 4.0})
+    hours = 2
+    try:
+        path = os.path.join(folder, 'flight')
+        frames = simulate_flight(path, flown, 5, 1000, hours * 3600, lose=(1000, 1001, 4000))
+        columns = read_flight(path)
+        started = time.perf_counter()
+        rows = replay_flight(columns, flown, flown, 5)
+        elapsed = time.perf_counter() - started
+        same = compare(rows)
+        tuned = compare(replay_flight(columns, flown, load_settings(None, dict(flown, bangbang_tolerance=150.0)), 5))
+    finally:
+        shutil.rmtree(folder)
+    print("{} h flight, {} frames replayed in {:.2f} s".format(hours, frames, elapsed))
+    for line in format_comparison(same):
+        print("  " + line)
+    print("with bangbang_tolerance=150:")
+    for line in format_comparison(tuned):
+        print("  " + line)
+
+    if len(rows) != frames:
+        failures.append("{} rows for {} frames".format(len(rows), frames))
+    # warm-up, and 6 frames after each of the two gaps
+    if same['compared'] != frames - 3 * 6:
+        failures.append("{} ticks compared, expected {}".format(same['compared'], frames - 18))
+    if same['differ'] > same['compared'] // 500:
+        failures.append("unchanged logic replays {} different commands".format(same['differ']))
+    if same['velocity_max_diff'] > 2:
+        failures.append("velocity off by {} mm/s".format(same['velocity_max_diff']))
+    if not tuned['differ'] or tuned['replay_pumping'] >= tuned['reference_pumping']:
+        failures.append("a wider tolerance didn't pump less")
+
+    readings = []
+    rng = random.Random(2)
+    for k in range(600):
+        t = k * 0.05
+        readings.append((t, 'barometer', 100.0 + 0.5 * t / 30 + rng.gauss(0, 0.05)))
+        if k % 2:
+            readings.append((t, 'sr', 1000 + 500 * t / 30 + rng.gauss(0, 5)))
+    baseline = replay_readings(readings, flown, 5, 1000)
+    wider = replay_readings(readings, load_settings(None, dict(flown, bangbang_tolerance=150.0)), 5, 1000)
+    if len(baseline) != len(wider) or not 20 <= len(baseline) <= 30:
+        failures.append("{} and {} ticks from 30 s of readings".format(len(baseline), len(wider)))
+    return mpcompat.report(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('flight', nargs='?', help="flight folder written by ground_station.py")
+    parser.add_argument('--readings', help="replay sensor readings from i2c_replay.py --readings instead")
+    parser.add_argument('--cfg', help="settings the flight used (ballonet_controller.json or ballonet_controller_cfg)")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="change a setting for the replay")
+    parser.add_argument('--n-s', type=int, default=5, help="samples in the velocity fit, as start(n_s=...)")
+    parser.add_argument('--period', type=int, default=1000, help="control period T in ms, for --readings")
+    parser.add_argument('--csv', help="write the tick-by-tick comparison to this CSV file")
+    parser.add_argument('--self-test', action='store_true', help="replay a simulated flight")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+    if not args.flight and not args.readings:
+        parser.error("a flight folder or --readings is needed")
+
+    changes = dict()
+    for item in args.set:
+        name, value = item.split('=', 1)
+        changes[name] = config.parse_value(value)
+    try:
+        flown = load_settings(args.cfg)
+        candidate = load_settings(args.cfg, changes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    if args.readings:
+        readings = read_readings(args.readings)
+        reference = 'baseline'
+        baseline = replay_readings(readings, flown, args.n_s, args.period)
+        replayed = replay_readings(readings, candidate, args.n_s, args.period)
+        rows = [(t, direction, velocity, other[1], other[2])
+                for (t, direction, velocity), other in zip(baseline, replayed)]
+    else:
+        reference = 'flown'
+        rows = replay_flight(read_flight(args.flight), flown, candidate, args.n_s)
+    elapsed = time.perf_counter() - started
+    result = compare(rows)
+    if rows:
+        print("{:.1f} min of flight replayed in {:.2f} s".format(rows[-1][0] / 60, elapsed))
+    for line in format_comparison(result, reference):
+        print(line)
+    if args.csv:
+        write_csv(args.csv, rows, reference)
+    return 1 if result['differ'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
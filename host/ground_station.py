@@ -0,0 +1,551 @@
+"""
+Ground station for several blimps at once.
+
+Listens for the UDP telemetry frames of micropython_root/telemetry.py from any
+number of blimps, keyed by their telemetry.cfg['vehicle'] number, which has to
+be different on each blimp. The blimps and the laptop must be on one network:
+either join one blimp's AP with the others as stations on it, or point each
+blimp's telemetry.cfg['host'] at the laptop.
+
+For every vehicle it
+  - writes each flight to its own folder under --out, one file per column
+    (see FlightLog, read back with read_flight()). A new flight starts when a
+    vehicle is first seen, after --flight-gap seconds of silence, or when its
+    clock goes backwards (it rebooted).
+  - keeps rolling statistics over the last --window seconds: velocity error
+    against the setpoint, pump duty, how often each altitude source was used,
+    frame rate and lost frames.
+  - sends commands back, e.g. "setpoint=40", which the blimp's controller runs
+    with ballonet_controller.command() and acknowledges. Unacknowledged
+    commands are sent again a few times.
+
+Usage:
+    python host/ground_station.py --out flights
+then type commands:
+    3 setpoint=40               (vehicle 3)
+    all bangbang_tolerance=80
+    status
+    quit
+
+    python host/ground_station.py --simulate 20
+runs 20 simulated blimps on localhost alongside the station, and
+    python host/ground_station.py --self-test
+checks the whole loop (frames, flight files, commands) with simulated blimps.
+
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+import mpcompat
+
+mpcompat.install()
+
+import config  # noqa: E402 (needs mpcompat first)
+import ballonet_logic  # noqa: E402
+import telemetry  # noqa: E402
+from altitude import SOURCE_NAMES, SOURCE_BAROMETER, SOURCE_SHORT_RANGE, SOURCE_LONG_RANGE  # noqa: E402
+
+# column name: array typecode. 'received' is the laptop's time.time().
+COLUMNS = (
+    ('received', 'd'),
+    ('sequence', 'H'),
+    ('ticks_ms', 'I'),
+    ('altitude', 'f'),
+    ('velocity', 'f'),
+    ('setpoint', 'f'),
+    ('source', 'B'),
+    ('duty', 'h'),
+    ('temperature0', 'f'),
+    ('temperature1', 'f'),
+    ('faults', 'H'),
+)
+_INDEX = 'columns.json'
+_TICKS_PERIOD = 1 << 30  # MicroPython's ticks_ms wraps here
+
+
+# Append-only columnar file for one flight: a folder with columns.json
+# describing the columns and <column>.bin holding each column's raw values.
+# Rows are buffered and appended every `flush_rows` rows and on close().
+class FlightLog:
+    def __init__(self, path, flush_rows=50):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.rows = 0
+        os.makedirs(path)
+        with open(os.path.join(path, _INDEX), 'w') as f:
+            json.dump({'columns': COLUMNS, 'byteorder': sys.byteorder, 'started': time.time()}, f)
+        self._buffers = [array(typecode) for name, typecode in COLUMNS]
+        self._files = [open(os.path.join(path, name + '.bin'), 'ab') for name, typecode in COLUMNS]
+
+    def append(self, received, frame):
+        values = (received, frame['sequence'], frame['ticks_ms'], frame['altitude'], frame['velocity'],
+                  frame['setpoint'], frame['source'], frame['duty'],
+                  frame['temperatures'][0], frame['temperatures'][1], frame['faults'])
+        for buffer, value in zip(self._buffers, values):
+            buffer.append(value)
+        self.rows += 1
+        if len(self._buffers[0]) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        for buffer, f in zip(self._buffers, self._files):
+            buffer.tofile(f)
+            f.flush()
+            del buffer[:]
+
+    def close(self):
+        if self._files is None:
+            return
+        self.flush()
+        for f in self._files:
+            f.close()
+        self._files = None
+
+
+# Columns of a flight written by FlightLog, as {name: array}.
+# A flight cut off mid-write is trimmed to the rows every column has.
+def read_flight(path):
+    with open(os.path.join(path, _INDEX)) as f:
+        index = json.load(f)
+    columns = dict()
+    for name, typecode in index['columns']:
+        a = array(typecode)
+        with open(os.path.join(path, name + '.bin'), 'rb') as f:
+            data = f.read()
+        a.frombytes(data[:len(data) - len(data) % a.itemsize])
+        if index['byteorder'] != sys.byteorder:
+            a.byteswap()
+        columns[name] = a
+    rows = min(len(a) for a in columns.values())
+    for name in columns:
+        del columns[name][rows:]
+    return columns
+
+
+# Sums over a sliding window of frames, updated as frames come and go
+class RollingStats:
+    def __init__(self, window_s):
+        self.window_s = window_s
+        self._frames = collections.deque()  # (received, error, duty, source)
+        self._error = 0.0
+        self._error_squared = 0.0
+        self._duty = 0.0
+        self._pumping = 0
+        self._sources = [0] * len(SOURCE_NAMES)
+
+    def add(self, received, frame):
+        entry = (received, frame['velocity'] - frame['setpoint'], abs(frame['duty']) / 1023,
+                 min(frame['source'], len(SOURCE_NAMES) - 1))
+        self._frames.append(entry)
+        self._update(entry, 1)
+        while self._frames and received - self._frames[0][0] > self.window_s:
+            self._update(self._frames.popleft(), -1)
+
+    def _update(self, entry, sign):
+        received, error, duty, source = entry
+        self._error += sign * error
+        self._error_squared += sign * error * error
+        self._duty += sign * duty
+        self._pumping += sign * (duty > 0)
+        self._sources[source] += sign
+
+    def summary(self):
+        n = len(self._frames)
+        if n == 0:
+            return None
+        span = self._frames[-1][0] - self._frames[0][0]
+        return {
+            'frames': n,
+            'rate_hz': (n - 1) / span if span > 0 else 0.0,
+            'error_mean': self._error / n,
+            'error_rms': math.sqrt(max(0.0, self._error_squared / n)),
+            'duty_mean': self._duty / n,
+            'pumping': self._pumping / n,
+            'sources': {SOURCE_NAMES[i]: self._sources[i] / n for i in range(len(SOURCE_NAMES))},
+        }
+
+
+class Vehicle:
+    def __init__(self, number):
+        self.number = number
+        self.address = None  # where its frames come from, commands go there
+        self.log = None
+        self.stats = None
+        self.last_frame = None
+        self.last_seen = 0.0
+        self.frames = 0
+        self.lost = 0
+        self.flights = []
+
+
+class GroundStation(asyncio.DatagramProtocol):
+    def __init__(self, out, window_s=10.0, flight_gap_s=30.0, flush_rows=50):
+        self.out = out
+        self.window_s = window_s
+        self.flight_gap_s = flight_gap_s
+        self.flush_rows = flush_rows
+        self.vehicles = dict()  # number: Vehicle
+        self.ignored = 0
+        self.transport = None
+        # The blimp skips a command with the same sequence as its last one (a
+        # retry), so don't start where the station's last run may have ended
+        self._sequence = random.randrange(0x10000)
+        self._pending = dict()  # (vehicle, sequence): future for the ACK
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        received = time.time()
+        frame = telemetry.decode(data)
+        if frame is not None:
+            self._frame(received, frame, address)
+            return
+        ack = telemetry.decode_ack(data)
+        if ack is not None:
+            vehicle, sequence, status, error = ack
+            future = self._pending.get((vehicle, sequence))
+            if future is not None and not future.done():
+                future.set_result((status, error))
+            return
+        self.ignored += 1
+
+    def _frame(self, received, frame, address):
+        number = frame['vehicle']
+        vehicle = self.vehicles.get(number)
+        if vehicle is None:
+            vehicle = self.vehicles[number] = Vehicle(number)
+        previous = vehicle.last_frame
+        if previous is None or received - vehicle.last_seen > self.flight_gap_s \
+                or (frame['ticks_ms'] - previous['ticks_ms']) % _TICKS_PERIOD >= _TICKS_PERIOD // 2:
+            self._new_flight(vehicle, received)
+        else:
+            gap = (frame['sequence'] - previous['sequence'] - 1) & 0xFFFF
+            if gap < 0x8000:  # otherwise a reordered or repeated frame
+                vehicle.lost += gap
+        vehicle.address = address
+        vehicle.last_frame = frame
+        vehicle.last_seen = received
+        vehicle.frames += 1
+        vehicle.log.append(received, frame)
+        vehicle.stats.add(received, frame)
+
+    def _new_flight(self, vehicle, received):
+        if vehicle.log is not None:
+            vehicle.log.close()
+        name = "v{}-{}".format(vehicle.number, time.strftime("%Y%m%d-%H%M%S", time.localtime(received)))
+        path = os.path.join(self.out, name)
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(self.out, "{}-{}".format(name, suffix))
+        vehicle.log = FlightLog(path, self.flush_rows)
+        vehicle.stats = RollingStats(self.window_s)
+        vehicle.flights.append(path)
+
+    # Sends `text` to a vehicle until it's acknowledged. Returns the error text,
+    # '' if the command was accepted. Raises TimeoutError if nothing came back.
+    async def command(self, number, text, retries=3, timeout=0.5):
+        vehicle = self.vehicles.get(number)
+        if vehicle is None or vehicle.address is None:
+            raise KeyError("vehicle {} hasn't been heard from".format(number))
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        key = (number, self._sequence)
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+        data = telemetry.encode_command(self._sequence, text)
+        try:
+            for attempt in range(retries + 1):
+                self.transport.sendto(data, (vehicle.address[0], vehicle.address[1]))
+                try:
+                    status, error = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                return error if status else ''
+            raise TimeoutError("vehicle {} didn't acknowledge {!r}".format(number, text))
+        finally:
+            del self._pending[key]
+
+    # Sends `text` to every vehicle at once. Returns {vehicle: error text or exception}.
+    async def command_all(self, text, **kwargs):
+        numbers = sorted(self.vehicles)
+        results = await asyncio.gather(*[self.command(n, text, **kwargs) for n in numbers],
+                                       return_exceptions=True)
+        return dict(zip(numbers, results))
+
+    def status_lines(self):
+        lines = ["  #  frames  lost   Hz      H m   V mm/s  set   err rms  duty  pump%  " +
+                 "  ".join("{:>5}".format(name[:5]) for name in SOURCE_NAMES)]
+        now = time.time()
+        for number in sorted(self.vehicles):
+            vehicle = self.vehicles[number]
+            summary = vehicle.stats.summary()
+            frame = vehicle.last_frame
+            line = "{:3d} {:7d} {:5d}".format(number, vehicle.frames, vehicle.lost)
+            if summary is None or now - vehicle.last_seen > self.window_s:
+                lines.append(line + "  silent for {:.0f} s".format(now - vehicle.last_seen))
+                continue
+            line += " {:5.1f} {:7.3f} {:7.0f} {:5.0f} {:8.1f} {:5.2f} {:5.0f}%  ".format(
+                summary['rate_hz'], frame['altitude'], frame['velocity'], frame['setpoint'],
+                summary['error_rms'], summary['duty_mean'], 100 * summary['pumping'])
+            line += "  ".join("{:4.0f}%".format(100 * summary['sources'][name]) for name in SOURCE_NAMES)
+            lines.append(line)
+        return lines
+
+    def close(self):
+        for vehicle in self.vehicles.values():
+            if vehicle.log is not None:
+                vehicle.log.close()
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def open_station(out, host='0.0.0.0', port=telemetry.PORT, **kwargs):
+    loop = asyncio.get_running_loop()
+    transport, station = await loop.create_datagram_endpoint(
+        lambda: GroundStation(out, **kwargs), local_addr=(host, port), allow_broadcast=True)
+    return station
+
+
+# A blimp on localhost, for testing: climbs and sinks under a bang-bang
+# controller like ballonet_controller's, sends frames like telemetry.py and
+# takes commands like telemetry.poll().
+class SimulatedBlimp(asyncio.DatagramProtocol):
+    SETTINGS = {'setpoint': 0.0, 'bangbang_tolerance': 50.0, 'floor_height': 0.5, 'ceiling_height': 6.0}
+
+    def __init__(self, number, station, rate_hz=10, seed=None):
+        self.number = number
+        self.station = station
+        self.rate_hz = rate_hz
+        self.random = random.Random(seed if seed is not None else number)
+        self.settings = dict(self.SETTINGS)
+        self.altitude = self.random.uniform(1.0, 5.0)
+        self.velocity = 0.0
+        self.duty = 0
+        self.sequence = 0
+        self.ticks_ms = self.random.randrange(_TICKS_PERIOD)
+        self.commands = []
+        self._last_command = None
+        self._ack = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if len(data) < telemetry.COMMAND_SIZE or data[:2] != telemetry.COMMAND_MAGIC:
+            return
+        magic, version, sequence = struct.unpack_from(telemetry.COMMAND, data)
+        if sequence != self._last_command:
+            try:
+                self._run(data[telemetry.COMMAND_SIZE:].decode())
+                status, error = 0, b''
+            except (ValueError, KeyError) as e:
+                status, error = 1, str(e).encode()
+            self._last_command = sequence
+            self._ack = telemetry.encode_ack(self.number, sequence, status, error)
+        self.transport.sendto(self._ack, address)
+
+    def _run(self, text):
+        changes = dict()
+        for item in text.split():
+            name, value = item.split('=', 1)
+            if name not in self.settings:
+                raise KeyError("unknown setting " + name)
+            changes[name] = float(config.parse_value(value))
+        self.settings.update(changes)
+        self.commands.append(text)
+
+    def step(self, dt):
+        direction, setpoint = ballonet_logic.decide(self.altitude, self.velocity, self.settings)
+        self.duty = 1023 * direction
+        # pumping in sinks, about 40 mm/s^2 at full duty, plus drag and gusts
+        acceleration = -40 * self.duty / 1023 - 0.2 * self.velocity + self.random.gauss(0, 15)
+        self.velocity += acceleration * dt
+        self.altitude = max(0.0, self.altitude + self.velocity / 1000 * dt)
+        self.ticks_ms = (self.ticks_ms + int(dt * 1000)) % _TICKS_PERIOD
+        if self.altitude < 1.2:
+            source = SOURCE_SHORT_RANGE
+        elif self.altitude < 4.0 and self.random.random() < 0.9:
+            source = SOURCE_LONG_RANGE
+        else:
+            source = SOURCE_BAROMETER
+        frame = telemetry.encode(self.number, self.sequence, self.ticks_ms, self.altitude, self.velocity,
+                                 setpoint, source, self.duty, (20.0 + self.number / 10, float('nan')), 0)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.transport.sendto(frame, self.station)
+
+    async def run(self, duration=None):
+        period = 1 / self.rate_hz
+        start = time.monotonic()
+        ticks = 0
+        while duration is None or ticks * period < duration:
+            self.step(period)
+            ticks += 1
+            await asyncio.sleep(max(0.0, start + ticks * period - time.monotonic()))
+
+
+async def simulate(count, station, rate_hz=10, duration=None):
+    loop = asyncio.get_running_loop()
+    blimps = []
+    for number in range(count):
+        transport, blimp = await loop.create_datagram_endpoint(
+            lambda: SimulatedBlimp(number, station, rate_hz), local_addr=('127.0.0.1', 0))
+        blimps.append(blimp)
+    tasks = [asyncio.ensure_future(blimp.run(duration)) for blimp in blimps]
+    return blimps, tasks
+
+
+async def _console(station):
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line or line.strip() == 'quit':
+            return
+        line = line.strip()
+        if not line:
+            continue
+        if line == 'status':
+            print("\n".join(station.status_lines()))
+            continue
+        target, _, text = line.partition(' ')
+        try:
+            if target == 'all':
+                results = await station.command_all(text)
+            else:
+                results = {int(target): await station.command(int(target), text)}
+        except (ValueError, KeyError, TimeoutError) as e:
+            print("error: " + str(e))
+            continue
+        for number, result in sorted(results.items()):
+            print("{}: {}".format(number, "ok" if result == '' else "error: " + str(result)))
+
+
+async def _status(station, period_s):
+    while True:
+        await asyncio.sleep(period_s)
+        print("\n".join(station.status_lines()))
+
+
+async def run(args):
+    station = await open_station(args.out, args.bind, args.port, window_s=args.window,
+                                 flight_gap_s=args.flight_gap)
+    tasks = []
+    if args.simulate:
+        blimps, tasks = await simulate(args.simulate, ('127.0.0.1', args.port), args.rate)
+    if args.status:
+        tasks.append(asyncio.ensure_future(_status(station, args.status)))
+    print("Listening on {}:{}, writing flights to {}".format(args.bind, args.port, args.out))
+    try:
+        await _console(station)
+    finally:
+        for task in tasks:
+            task.cancel()
+        station.close()
+
+
+async def self_test(count=24, rate_hz=20, duration=3.0):
+    out = tempfile.mkdtemp(prefix='ground_station_')
+    failures = []
+    try:
+        station = await open_station(out, '127.0.0.1', 0, window_s=duration)
+        address = station.transport.get_extra_info('sockname')
+        blimps, tasks = await simulate(count, address, rate_hz, duration)
+        await asyncio.sleep(duration / 3)
+        started = time.monotonic()
+        results = await station.command_all("setpoint=30 bangbang_tolerance=40")
+        latency = time.monotonic() - started
+        bad = await station.command(0, "no_such_setting=1")
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(0.2)  # let the last frames arrive
+        lines = station.status_lines()
+        station.close()
+
+        # a restarted station's first command must run, not be taken for a retry
+        # of the last one the blimp saw from the station before
+        loop = asyncio.get_running_loop()
+        listener = await open_station(out, '127.0.0.1', 0)
+        address = listener.transport.get_extra_info('sockname')
+        transport, blimp = await loop.create_datagram_endpoint(
+            lambda: SimulatedBlimp(count, address, rate_hz), local_addr=('127.0.0.1', 0))
+        task = asyncio.ensure_future(blimp.run(1.0))
+        restarted = []
+        try:
+            for text in ("setpoint=10", "setpoint=20"):
+                await asyncio.sleep(0.2)  # until the station hears from the blimp
+                restarted.append(await listener.command(count, text))
+                listener.close()
+                await asyncio.sleep(0.05)  # the socket closes on the next loop iteration
+                listener = await open_station(out, '127.0.0.1', address[1])
+        finally:
+            listener.close()
+            await task
+            transport.close()
+        if restarted != ['', ''] or blimp.commands != ["setpoint=10", "setpoint=20"]:
+            failures.append("across a station restart: {}, the blimp ran {}".format(restarted, blimp.commands))
+
+        if sorted(station.vehicles) != list(range(count)):
+            failures.append("heard from vehicles {}".format(sorted(station.vehicles)))
+        for number, result in results.items():
+            if result != '':
+                failures.append("vehicle {}: command failed: {}".format(number, result))
+        if not bad:
+            failures.append("a bad command was accepted")
+        for blimp in blimps:
+            if blimp.settings['setpoint'] != 30 or blimp.commands != ["setpoint=30 bangbang_tolerance=40"]:
+                failures.append("vehicle {} ran {}".format(blimp.number, blimp.commands))
+            vehicle = station.vehicles.get(blimp.number)
+            if vehicle is None:
+                continue
+            if len(vehicle.flights) != 1:
+                failures.append("vehicle {}: {} flights".format(blimp.number, len(vehicle.flights)))
+                continue
+            columns = read_flight(vehicle.flights[0])
+            if len(columns['sequence']) != vehicle.frames or vehicle.frames + vehicle.lost != blimp.sequence:
+                failures.append("vehicle {}: sent {}, received {}, lost {}, stored {}".format(
+                    blimp.number, blimp.sequence, vehicle.frames, vehicle.lost, len(columns['sequence'])))
+            if columns['setpoint'][-1] not in (30, 80, -20):  # floor and ceiling add +-50
+                failures.append("vehicle {}: last setpoint {}".format(blimp.number, columns['setpoint'][-1]))
+        frames = sum(vehicle.frames for vehicle in station.vehicles.values())
+        print("\n".join(lines))
+        print("{} vehicles, {} frames, {:.0f} frames/s, command round trip to all {:.0f} ms".format(
+            count, frames, frames / duration, latency * 1000))
+    finally:
+        shutil.rmtree(out)
+    return mpcompat.report(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='flights', help="folder for the flight files")
+    parser.add_argument('--bind', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=telemetry.PORT)
+    parser.add_argument('--window', type=float, default=10.0, help="rolling statistics window, s")
+    parser.add_argument('--flight-gap', type=float, default=30.0, help="silence that ends a flight, s")
+    parser.add_argument('--status', type=float, default=5.0, help="print the status table this often, s (0: never)")
+    parser.add_argument('--simulate', type=int, default=0, help="also run this many simulated blimps")
+    parser.add_argument('--rate', type=float, default=10.0, help="frame rate of simulated blimps, Hz")
+    parser.add_argument('--self-test', action='store_true', help="test with simulated blimps and exit")
+    args = parser.parse_args()
+    if args.self_test:
+        return asyncio.run(self_test())
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
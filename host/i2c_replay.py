@@ -0,0 +1,414 @@
+"""
+Replays an I2C trace from micropython_root/i2ctrace.py through the unmodified
+device drivers, on CPython, faster than real time.
+
+ReplayI2C looks like machine.I2C to the drivers and answers each transaction
+with the bytes recorded in flight. Transactions are matched per device
+address, in order, so drivers brought up or polled concurrently on the
+board can be replayed one at a time here. A driver asking for something
+other than what was recorded (another register, length or written value)
+raises ReplayMismatch, which is usually the bug being looked for. Recorded
+I2C errors are raised again as OSError with the same errno. The clock
+(ticks_ms/us, sleep) is virtual and follows the recorded timestamps, so
+polling loops and timeouts behave as they did in flight without waiting.
+
+    python host/i2c_replay.py flight.i2c --files board_files
+prints bus bytes per controller tick per device, then replays the altitude
+pipeline: BMP388 readings, VL53L0X ranges tilt-corrected with the ADXL345,
+fused by ALTITUDE like ballonet_controller does. --files is a copy of the
+board's calibration files (adxl345_calibration_2point, vl53l0x_cal), which
+the drivers read during setup; without them their setup differs from the
+recording. --csv writes the fused altitudes, --readings the sensor readings
+before fusion, for host/controller_replay.py.
+
+The ultrasonic rangefinder is on a UART, so it isn't in the trace. The
+accelerometer is shared by both rangefinders, so replaying only the VL53L0X
+pairs its ranges with accelerometer readings that may have been taken for
+the ultrasonic one, a few milliseconds apart.
+
+    python host/i2c_replay.py --self-test
+records a simulated BMP388 and checks the replay gives back the same
+readings and errors.
+
+"""
+
+import argparse
+import collections
+import csv
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import mpcompat
+
+mpcompat.install()
+
+import i2ctrace  # noqa: E402 (needs mpcompat first)
+
+_TICKS_PERIOD = 1 << 30
+_NAMES = {i2ctrace.READ_MEM: 'read_mem', i2ctrace.WRITE_MEM: 'write_mem', i2ctrace.READ: 'read',
+          i2ctrace.WRITE: 'write', i2ctrace.SCAN: 'scan', i2ctrace.MARK: 'mark'}
+
+Record = collections.namedtuple('Record', 'index operation time address register data failed')
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+class ReplayEnd(Exception):
+    pass
+
+
+# Records of a trace file, with ticks_us unwrapped to seconds from the first record
+def read_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version = struct.unpack_from(i2ctrace.HEADER, data)
+    if magic != i2ctrace.MAGIC or version != i2ctrace.VERSION:
+        raise ValueError(path + " is not an I2C trace this tool can read")
+    records = []
+    offset = i2ctrace.HEADER_SIZE
+    previous = None
+    elapsed = 0
+    while offset + i2ctrace.RECORD_SIZE <= len(data):
+        operation, ticks, address, register, length = struct.unpack_from(i2ctrace.RECORD, data, offset)
+        offset += i2ctrace.RECORD_SIZE
+        payload = data[offset:offset + length]
+        offset += length
+        if len(payload) < length:
+            break  # cut off mid-record
+        if previous is not None:
+            elapsed += (ticks - previous) % _TICKS_PERIOD
+        previous = ticks
+        records.append(Record(len(records), operation & ~i2ctrace.FAILED, elapsed / 1e6, address, register,
+                              payload, bool(operation & i2ctrace.FAILED)))
+    return records
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def install(self):
+        mpcompat.set_clock(self.time, self.sleep)
+
+
+class ReplayI2C:
+    # strict: a written value that differs from the recorded one is a mismatch
+    def __init__(self, records, clock=None, strict=True):
+        self.clock = clock
+        self.strict = strict
+        self.write_mismatches = 0
+        self.queues = collections.defaultdict(collections.deque)  # address: records
+        self.scans = collections.deque()
+        for record in records:
+            if record.operation == i2ctrace.SCAN:
+                self.scans.append(record)
+            elif record.operation != i2ctrace.MARK:
+                self.queues[record.address].append(record)
+
+    def has(self, address):
+        return bool(self.queues.get(address))
+
+    def _next(self, address, operation, register, length):
+        queue = self.queues.get(address)
+        if not queue:
+            raise ReplayEnd("no more transactions for 0x{:02x}".format(address))
+        record = queue[0]
+        if self.clock is not None:
+            self.clock.now = record.time
+        if record.operation != operation or (not record.failed and (
+                record.register != register or (length is not None and len(record.data) != length))):
+            raise ReplayMismatch(
+                "0x{:02x}: driver did {} register 0x{:02x} ({} bytes) but record {} at {:.6f} s is "
+                "{} register 0x{:02x} ({} bytes)".format(
+                    address, _NAMES[operation], register, length, record.index, record.time,
+                    _NAMES.get(record.operation), record.register, len(record.data)))
+        queue.popleft()
+        if record.failed:
+            raise OSError(record.register)
+        return record
+
+    def _write(self, address, operation, register, buf):
+        record = self._next(address, operation, register, len(buf))
+        if bytes(buf) != record.data:
+            self.write_mismatches += 1
+            if self.strict:
+                raise ReplayMismatch("0x{:02x}: driver wrote {} to register 0x{:02x}, record {} has {}".format(
+                    address, bytes(buf).hex(), register, record.index, record.data.hex()))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *args, **kwargs):
+        return self._next(addr, i2ctrace.READ_MEM, memaddr, nbytes).data
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *args, **kwargs):
+        buf[:] = self._next(addr, i2ctrace.READ_MEM, memaddr, len(buf)).data
+
+    def writeto_mem(self, addr, memaddr, buf, *args, **kwargs):
+        self._write(addr, i2ctrace.WRITE_MEM, memaddr, buf)
+
+    def readfrom(self, addr, nbytes, *args):
+        return self._next(addr, i2ctrace.READ, 0, nbytes).data
+
+    def readfrom_into(self, addr, buf, *args):
+        buf[:] = self._next(addr, i2ctrace.READ, 0, len(buf)).data
+
+    def writeto(self, addr, buf, *args):
+        self._write(addr, i2ctrace.WRITE, 0, buf)
+        return 1
+
+    def scan(self):
+        if not self.scans:
+            raise ReplayEnd("no more scans")
+        return list(self.scans.popleft().data)
+
+
+# Bytes on the bus between consecutive tick marks: a list of {address: bytes}
+def bytes_per_tick(records):
+    ticks = []
+    current = None
+    for record in records:
+        if record.operation == i2ctrace.MARK:
+            current = collections.Counter()
+            ticks.append(current)
+        elif current is not None and record.operation != i2ctrace.SCAN:
+            current[record.address] += len(record.data)
+    return ticks
+
+
+def format_ticks(ticks):
+    if not ticks:
+        return ["no tick marks in the trace"]
+    addresses = sorted(set(a for tick in ticks for a in tick))
+    lines = ["bus bytes per tick over {} ticks:".format(len(ticks))]
+    for address in addresses + [None]:
+        counts = [sum(tick.values()) if address is None else tick[address] for tick in ticks]
+        name = "total" if address is None else "0x{:02x}".format(address)
+        lines.append("  {:>6}: mean {:7.1f}, max {:6d}".format(name, sum(counts) / len(counts), max(counts)))
+    return lines
+
+
+# Readings the controller's sensor tasks would have taken: [(time, kind, value)]
+def replay_sensors(i2c, clock):
+    readings = []
+    if i2c.has(0x77):
+        from bmp388 import BMP388
+        barometer = BMP388(i2c)
+        try:
+            while True:
+                barometer.start_measurement()
+                while not barometer.data_ready():
+                    pass
+                readings.append((clock.now, 'barometer', barometer.read_measurement()[0]))
+        except ReplayEnd:
+            pass
+    if i2c.has(41) and i2c.has(83):
+        from adxl345 import ADXL345
+        from accelerometer import ACCELEROMETER
+        from VL53L0X import VL53L0X
+        from distance import HeightTiltCompensator
+        accelerometer = ACCELEROMETER(ADXL345(i2c, 83), 'adxl345_calibration_2point')
+        fusion = HeightTiltCompensator(accelerometer, VL53L0X(i2c, 41))
+        fusion.offset = -40.0  # as devices.py sets it
+        try:
+            fusion.rangefinder.start()
+            while True:
+                while not fusion.rangefinder.data_ready():
+                    pass
+                readings.append((clock.now, 'sr', fusion.correct(fusion.rangefinder.read_result())))
+        except ReplayEnd:
+            pass
+    readings.sort(key=lambda reading: reading[0])
+    return readings
+
+
+# Fused altitudes at each barometer reading: [(time, altitude, source)]
+def fuse(readings, max_age_s=1.0, barometer_drift=1, calibration_drift=0.25):
+    from altitude import ALTITUDE
+    altitude = ALTITUDE(None)
+    altitude.barometer_drift = barometer_drift
+    altitude.calibration_drift = calibration_drift
+    floor_set = False
+    last_range = None
+    fused = []
+    for t, kind, value in readings:
+        if kind == 'sr':
+            last_range = (t, value)
+            continue
+        distance = last_range[1] if last_range and t - last_range[0] <= max_age_s else None
+        if not floor_set:
+            # start from the first range reading if there is one, like calibrate() does
+            if distance is not None and 0 < distance < float('inf'):
+                altitude.floor_altitude = value - distance / 1000
+            else:
+                altitude.floor_altitude = value
+            floor_set = True
+        fused.append((t, altitude.fuse(value, distance), altitude.source))
+    return fused
+
+
+class _FakeBMP388:
+    # Register file of a BMP388 that is ready every other status poll
+    CALIBRATION = bytes.fromhex('e06a3d47f6d0f8e8e50ffec7716d4e0bf3ff14c4f5')
+
+    def __init__(self):
+        self.osr = b'\x00'
+        self.polls = 0
+        self.sample = 0
+        self.fail_at = 5
+
+    def writeto_mem(self, addr, memaddr, buf):
+        if memaddr == 0x1C:
+            self.osr = bytes(buf)
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        if memaddr == 0x1C:
+            return self.osr
+        if memaddr == 0x31:
+            return self.CALIBRATION
+        if memaddr == 0x03:
+            self.polls += 1
+            if self.polls == self.fail_at:
+                raise OSError(116)  # ETIMEDOUT
+            return b'\x60' if self.polls % 2 == 0 else b'\x10'
+        if memaddr == 0x04:
+            self.sample += 1
+            pressure = 6500000 + 37 * self.sample
+            temperature = 8400000 + 11 * self.sample
+            return pressure.to_bytes(3, 'little') + temperature.to_bytes(3, 'little')
+        raise OSError(19)
+
+
+def _read_all(barometer, ticks, mark=None):
+    results = []
+    for k in range(ticks):
+        if mark:
+            mark()
+        try:
+            results.append(barometer.get_data())
+        except OSError as e:
+            results.append(('OSError', e.args[0]))
+    return results
+
+
+def self_test():
+    from bmp388 import BMP388
+    failures = []
+    clock = VirtualClock()
+    clock.install()
+    recorder = i2ctrace.RECORDER(_FakeBMP388(), size=1 << 16)
+    recorded = _read_all(BMP388(recorder), 30, recorder.mark)
+    folder = tempfile.mkdtemp(prefix='i2c_replay_')
+    path = os.path.join(folder, 'test.i2c')
+    try:
+        with open(path, 'wb') as f:
+            i2ctrace.write_header(f)
+            recorder.drain_to(f)
+        records = read_trace(path)
+    finally:
+        os.remove(path)
+        os.rmdir(folder)
+
+    started = time.perf_counter()
+    replay_clock = VirtualClock()
+    replay_clock.install()
+    i2c = ReplayI2C(records, replay_clock)
+    replayed = _read_all(BMP388(i2c), 30)
+    elapsed = time.perf_counter() - started
+    if replayed != recorded:
+        failures.append("replayed readings differ from the recording")
+    if ('OSError', 116) not in replayed:
+        failures.append("the recorded I2C error wasn't raised again")
+    try:
+        BMP388(i2c).get_data()
+        failures.append("replay went on past the end of the trace")
+    except ReplayEnd:
+        pass
+    try:
+        ReplayI2C(records).readfrom_mem(0x77, 0x00, 1)
+        failures.append("reading an unrecorded register wasn't a mismatch")
+    except ReplayMismatch:
+        pass
+    ticks = bytes_per_tick(records)
+    if len(ticks) != 30 or not all(tick[0x77] for tick in ticks):
+        failures.append("bytes per tick: {}".format(ticks))
+    mpcompat.reset_clock()
+    try:
+        time.sleep(0.001)
+    except RecursionError:
+        failures.append("time.sleep recurses after reset_clock()")
+
+    print("{} records, {:.2f} s of recorded time replayed in {:.1f} ms".format(
+        len(records), records[-1].time, elapsed * 1000))
+    for line in format_ticks(ticks):
+        print(line)
+    return mpcompat.report(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', nargs='?', help="file written by i2ctrace.record()")
+    parser.add_argument('--files', help="folder with the board's calibration files")
+    parser.add_argument('--csv', help="write the fused altitudes to this CSV file")
+    parser.add_argument('--readings', help="write the sensor readings (time, kind, value) to this CSV file")
+    parser.add_argument('--lenient', action='store_true', help="don't stop when a written value differs")
+    parser.add_argument('--self-test', action='store_true', help="record and replay a simulated BMP388")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+    if not args.trace:
+        parser.error("a trace file is needed")
+
+    records = read_trace(os.path.abspath(args.trace))
+    csv_path = os.path.abspath(args.csv) if args.csv else None
+    readings_path = os.path.abspath(args.readings) if args.readings else None
+    if args.files:
+        os.chdir(args.files)
+    print("{} records over {:.1f} s".format(len(records), records[-1].time if records else 0))
+    failed = [r for r in records if r.failed]
+    if failed:
+        print("{} failed transactions, first at {:.3f} s on 0x{:02x}".format(
+            len(failed), failed[0].time, failed[0].address))
+    for line in format_ticks(bytes_per_tick(records)):
+        print(line)
+
+    clock = VirtualClock()
+    clock.install()
+    i2c = ReplayI2C(records, clock, strict=not args.lenient)
+    started = time.perf_counter()
+    readings = replay_sensors(i2c, clock)
+    fused = fuse(readings)
+    elapsed = time.perf_counter() - started
+    mpcompat.reset_clock()
+    left = sum(len(queue) for queue in i2c.queues.values())
+    print("replayed {} sensor readings in {:.2f} s, {} transactions left over, {} written values differed".format(
+        len(readings), elapsed, left, i2c.write_mismatches))
+    if fused:
+        from altitude import SOURCE_NAMES
+        heights = [h for t, h, source in fused]
+        sources = collections.Counter(source for t, h, source in fused)
+        print("altitude {:.3f} to {:.3f} m; ".format(min(heights), max(heights)) + ", ".join(
+            "{} {:.0f}%".format(SOURCE_NAMES[s], 100 * n / len(fused)) for s, n in sorted(sources.items())))
+    if csv_path:
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('time', 'altitude', 'source'))
+            writer.writerows(fused)
+    if readings_path:
+        with open(readings_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('time', 'kind', 'value'))
+            writer.writerows(readings)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
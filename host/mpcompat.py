@@ -0,0 +1,135 @@
+"""
+Lets on-device modules from micropython_root be imported by CPython host tools.
+
+Call install() before importing anything from micropython_root. It adds the
+MicroPython-only time functions (ticks_ms, ticks_us, ticks_diff, ticks_add,
+sleep_ms, sleep_us) to the time module, routes time.sleep through the clock
+below (so firmware doing `from time import sleep` follows it too) and
+registers the `micropython`, `utime`, `ustruct`, `ujson` and `uarray` modules.
+
+Only the pure-Python parts of the firmware are supported this way;
+anything that needs `machine` has to be given a host implementation by the tool.
+
+The clock can be replaced with set_clock(fn) where fn returns seconds as a float,
+for tools that replay or simulate faster than real time.
+
+report(failures) ends a tool's --self-test: it prints each failure and the
+verdict and returns the exit status.
+
+"""
+
+import array
+import json
+import os
+import struct
+import sys
+import time
+import types
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'micropython_root'))
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+# the real ones, kept before install() replaces time.sleep
+_real_sleep = time.sleep
+_clock = time.monotonic
+_sleep = _real_sleep
+
+
+def set_clock(clock, sleep=None):
+    # clock() returns seconds. sleep(seconds) defaults to advancing nothing,
+    # which is what a virtual clock driven by the caller wants.
+    global _clock
+    global _sleep
+    _clock = clock
+    _sleep = sleep if sleep is not None else (lambda seconds: None)
+
+
+def reset_clock():
+    global _clock
+    global _sleep
+    _clock = time.monotonic
+    _sleep = _real_sleep
+
+
+def ticks_ms():
+    return int(_clock() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(_clock() * 1000000) & _TICKS_MAX
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def sleep_ms(ms):
+    _sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _sleep(us / 1000000)
+
+
+def sleep(seconds):
+    _sleep(seconds)
+
+
+def const(value):
+    return value
+
+
+def _passthrough(fn=None, *args, **kwargs):
+    return fn
+
+
+# Prints the self-test's failures (a list of strings) and the verdict,
+# returns the exit status for sys.exit()
+def report(failures):
+    for failure in failures:
+        print("FAIL: " + failure)
+    print("self-test " + ("failed" if failures else "passed"))
+    return 1 if failures else 0
+
+
+def install():
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_cpu
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+    time.sleep = sleep
+
+    micropython = types.ModuleType('micropython')
+    micropython.const = const
+    micropython.native = _passthrough
+    micropython.viper = _passthrough
+    micropython.schedule = lambda fn, arg: fn(arg)
+    micropython.alloc_emergency_exception_buf = lambda size: None
+    sys.modules.setdefault('micropython', micropython)
+
+    utime = types.ModuleType('utime')
+    for name in ('ticks_ms', 'ticks_us', 'ticks_cpu', 'ticks_add', 'ticks_diff', 'sleep_ms', 'sleep_us'):
+        setattr(utime, name, globals()[name])
+    utime.sleep = sleep
+    utime.time = time.time
+    sys.modules.setdefault('utime', utime)
+
+    sys.modules.setdefault('ustruct', struct)
+    sys.modules.setdefault('ujson', json)
+    sys.modules.setdefault('uarray', array)
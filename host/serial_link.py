@@ -0,0 +1,336 @@
+"""
+Host side of micropython_root/serialproto.py: talk to a blimp over USB serial
+with framed binary messages instead of typing into the REPL.
+
+Usage:
+    from serial_link import SerialLink
+    link = SerialLink.open('/dev/ttyUSB0')  # starts serialproto.serve() on the board
+    link.get()                              # {'setpoint': 0.0, ...}
+    link.set(setpoint=40, bangbang_tolerance=80)
+    link.save()
+    link.stream(20)                         # telemetry at up to 20 Hz
+    frame = link.telemetry.get()            # dicts as from telemetry.decode()
+    link.close()                            # back to the REPL
+
+Text the board prints while serving (task messages, errors) is passed to
+on_text, which prints it by default.
+
+    python host/serial_link.py /dev/ttyUSB0 setpoint=40
+sets values from the command line, and
+    python host/serial_link.py --self-test
+runs serialproto.serve() against this library over a Linux pseudo-terminal.
+
+Needs pyserial for real ports (pip install pyserial); the self-test doesn't.
+
+"""
+
+import argparse
+import os
+import queue
+import select
+import sys
+import tempfile
+import threading
+import time
+
+import mpcompat
+
+mpcompat.install()
+
+import config  # noqa: E402 (needs mpcompat first)
+import serialproto  # noqa: E402
+import telemetry  # noqa: E402
+
+ENTER = b"import serialproto, ballonet_controller\r" \
+        b"serialproto.serve(ballonet_controller.command, ballonet_controller.settings)\r"
+
+
+class SerialProtoError(Exception):
+    pass
+
+
+# A file descriptor with the read(n)/write() of a pyserial port, for ptys
+class FdStream:
+    def __init__(self, fd, timeout=0.1):
+        self.fd = fd
+        self.timeout = timeout
+
+    def read(self, n=1):
+        if self.timeout is not None and not select.select([self.fd], [], [], self.timeout)[0]:
+            return b''
+        try:
+            return os.read(self.fd, n)
+        except OSError:
+            return b''  # the other side closed
+
+    def fileno(self):  # for serialproto.serve()'s poll
+        return self.fd
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SerialLink:
+    def __init__(self, port, on_text=None):
+        self.port = port
+        self.on_text = on_text if on_text is not None else self._print_text
+        self.telemetry = queue.Queue()
+        self.hello = threading.Event()
+        self.errors = 0  # damaged frames that weren't text
+        self._sequence = 0
+        self._pending = dict()  # sequence: [event, reply]
+        self._lock = threading.Lock()
+        self._running = True
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def open(cls, port, baudrate=115200, **kwargs):
+        import serial
+        link = cls(serial.Serial(port, baudrate, timeout=0.1), **kwargs)
+        link.enter()
+        return link
+
+    # Interrupt whatever runs in the REPL and start serialproto.serve()
+    def enter(self, timeout=3.0):
+        self.hello.clear()
+        self.port.write(b"\r\x03\x03")
+        time.sleep(0.1)
+        self.port.write(ENTER)
+        if not self.hello.wait(timeout):
+            raise SerialProtoError("no HELLO from the board")
+
+    @staticmethod
+    def _print_text(text):
+        text = text.strip()
+        if text:
+            print("board: " + text)
+
+    def _read(self):
+        decoder = serialproto.DECODER()
+        while self._running:
+            data = self.port.read(256)
+            if not data:
+                continue
+            for frame in decoder.feed(data):
+                if type(frame) is bytes:
+                    self._text(frame)
+                else:
+                    self._frame(*frame)
+
+    def _text(self, raw):
+        try:
+            text = raw.decode()
+        except UnicodeError:
+            self.errors += 1
+            return
+        if text.isprintable() or text.strip().isprintable():
+            self.on_text(text)
+        else:
+            self.errors += 1
+
+    def _frame(self, kind, sequence, body):
+        if kind == serialproto.TELEMETRY:
+            frame = telemetry.decode(body)
+            if frame is not None:
+                self.telemetry.put(frame)
+        elif kind == serialproto.HELLO:
+            if body[:1] != bytes((serialproto.VERSION,)):
+                self.on_text("board speaks serialproto version {}".format(body[0] if body else None))
+            self.hello.set()
+        else:
+            with self._lock:
+                pending = self._pending.get(sequence)
+            if pending is not None:
+                pending[1] = (kind, body)
+                pending[0].set()
+
+    # Sends a request and returns the reply's (type, body). Lost requests
+    # are sent again `retries` times; every request here is safe to repeat.
+    def request(self, kind, body=b'', timeout=1.0, retries=1):
+        with self._lock:
+            self._sequence = (self._sequence + 1) & 0xFF
+            sequence = self._sequence
+            pending = self._pending[sequence] = [threading.Event(), None]
+        try:
+            frame = serialproto.encode(kind, sequence, body)
+            for attempt in range(retries + 1):
+                self.port.write(frame)
+                if pending[0].wait(timeout):
+                    return pending[1]
+            raise SerialProtoError("no reply to frame type {}".format(kind))
+        finally:
+            with self._lock:
+                del self._pending[sequence]
+
+    def _ack(self, kind, body=b'', **kwargs):
+        reply_kind, reply = self.request(kind, body, **kwargs)
+        if reply_kind != serialproto.ACK or not reply:
+            raise SerialProtoError("unexpected reply type {}".format(reply_kind))
+        if reply[0]:
+            raise SerialProtoError(reply[1:].decode())
+
+    def command(self, text):
+        self._ack(serialproto.COMMAND, text.encode())
+
+    def set(self, **values):
+        self.command(" ".join("{}={}".format(name, value) for name, value in values.items()))
+
+    # One setting, or all of them as a dict
+    def get(self, name=None):
+        kind, body = self.request(serialproto.GET, (name or '').encode())
+        if kind == serialproto.ACK:
+            raise SerialProtoError(body[1:].decode())
+        values = dict()
+        for item in body.decode().split():
+            key, value = item.split('=', 1)
+            values[key] = config.parse_value(value)
+        return values[name] if name else values
+
+    def save(self):
+        self._ack(serialproto.SAVE, timeout=3.0)
+
+    def stream(self, rate_hz):
+        self._ack(serialproto.STREAM, bytes((int(rate_hz),)))
+
+    # Round trip time in seconds
+    def ping(self):
+        start = time.perf_counter()
+        self._ack(serialproto.PING)
+        return time.perf_counter() - start
+
+    # Leave serve() on the board and stop reading
+    def close(self):
+        try:
+            self._ack(serialproto.CLOSE, retries=0)
+        finally:
+            self._running = False
+            self._reader.join()
+            self.port.close()
+
+
+def self_test():
+    import tty
+    failures = []
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    tty.setraw(master)
+    folder = tempfile.mkdtemp(prefix='serial_link_')
+    settings = config.CONFIG(os.path.join(folder, 'test.json'), (
+        ('setpoint', float, -200, 200, 0.0),
+        ('bangbang_tolerance', float, 0, 1000, 50.0),
+    ))
+
+    def command(text):
+        changes = dict()
+        for item in text.split():
+            name, value = item.split('=', 1)
+            changes[name] = config.parse_value(value)
+        settings.request(changes)
+        settings.apply()
+
+    board_stream = FdStream(slave, timeout=None)
+    board = threading.Thread(target=serialproto.serve, args=(command, settings, board_stream, board_stream),
+                             daemon=True)
+    texts = []
+    link = SerialLink(FdStream(master), on_text=texts.append)
+    board.start()
+    if not link.hello.wait(2):
+        print("FAIL: no HELLO")
+        return 1
+
+    pings = [link.ping() for i in range(50)]
+    if link.get() != {'setpoint': 0.0, 'bangbang_tolerance': 50.0}:
+        failures.append("get() gave {}".format(link.get()))
+    link.set(setpoint=25, bangbang_tolerance=80)
+    if settings.values['setpoint'] != 25 or link.get('bangbang_tolerance') != 80:
+        failures.append("set() left {}".format(settings.values))
+    try:
+        link.set(setpoint=1000)
+        failures.append("an out of range setpoint was accepted")
+    except SerialProtoError:
+        pass
+    link.save()
+    if not os.path.exists(settings.path):
+        failures.append("save() didn't write the settings")
+
+    # telemetry at 100 Hz for a second, with a print from the board in the middle
+    rate_hz = telemetry.cfg['rate_hz']
+    link.stream(100)
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < 1.0:
+        if telemetry.publish(1.5, 12.0, 25.0, 1, -1023):
+            sent += 1
+            if sent == 50:
+                board_stream.write(b"Pump driver fault!\r\n")
+        time.sleep(0.001)
+    link.stream(0)
+    time.sleep(0.1)
+    frames = []
+    while not link.telemetry.empty():
+        frames.append(link.telemetry.get())
+    if len(frames) != sent:
+        failures.append("{} telemetry frames sent, {} received".format(sent, len(frames)))
+    if frames and (frames[-1]['duty'] != -1023 or frames[-1]['setpoint'] != 25.0):
+        failures.append("telemetry frame {}".format(frames[-1]))
+    if [t.strip() for t in texts] != ["Pump driver fault!"]:
+        failures.append("board text {}".format(texts))
+    if telemetry.publish(1.5, 12.0, 25.0, 1, -1023):
+        failures.append("telemetry still published after stream(0)")
+
+    link.close()
+    board.join(2)
+    if board.is_alive():
+        failures.append("serve() didn't return after close()")
+    elif telemetry.cfg['rate_hz'] != rate_hz:
+        failures.append("serve() left the telemetry rate at {} Hz".format(telemetry.cfg['rate_hz']))
+    os.close(slave)
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+    # the sink runs in the controller's tick: it may only queue, never write
+    queued = serialproto._LINK(None)
+    for i in range(serialproto._SLOTS + 1):
+        queued.telemetry(bytes(telemetry.FRAME_SIZE))
+    if queued.dropped != 1:
+        failures.append("{} frames dropped with every slot full".format(queued.dropped))
+
+    pings.sort()
+    print("ping median {:.2f} ms, max {:.2f} ms; {} telemetry frames in 1 s; {} damaged frames".format(
+        1000 * pings[len(pings) // 2], 1000 * pings[-1], len(frames), link.errors))
+    return mpcompat.report(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('port', nargs='?')
+    parser.add_argument('changes', nargs='*', help="settings to change, e.g. setpoint=40")
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--save', action='store_true', help="save the settings on the board")
+    parser.add_argument('--self-test', action='store_true', help="test over a pseudo-terminal, no board needed")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+    if not args.port:
+        parser.error("a serial port is needed")
+    link = SerialLink.open(args.port, args.baud)
+    try:
+        if args.changes:
+            link.command(" ".join(args.changes))
+        if args.save:
+            link.save()
+        for name, value in link.get().items():
+            print("{}\t{}".format(name, value))
+    finally:
+        link.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
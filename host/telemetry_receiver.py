@@ -0,0 +1,166 @@
+"""
+Receives the blimps' UDP telemetry frames (see micropython_root/telemetry.py).
+
+Join the blimp's access point, then
+    python host/telemetry_receiver.py            # print frames
+    python host/telemetry_receiver.py --csv flight.csv
+Lost frames are counted per vehicle from gaps in the sequence numbers.
+
+    python host/telemetry_receiver.py --self-test
+sends frames through the on-device telemetry module to a loopback socket
+and checks what arrives, no blimp needed.
+
+"""
+
+import argparse
+import csv
+import math
+import socket
+import sys
+
+import mpcompat
+
+mpcompat.install()
+
+import telemetry  # noqa: E402 (needs mpcompat first)
+from altitude import SOURCE_NAMES  # noqa: E402
+
+COLUMNS = ('vehicle', 'sequence', 'ticks_ms', 'altitude', 'velocity', 'setpoint',
+           'source', 'duty', 'temperature0', 'temperature1', 'faults')
+
+
+def flatten(frame):
+    row = dict(frame)
+    row['temperature0'], row['temperature1'] = row.pop('temperatures')
+    return row
+
+
+class Receiver:
+    def __init__(self):
+        self.last_sequence = dict()  # vehicle: sequence
+        self.received = dict()
+        self.lost = dict()
+
+    # Decode one datagram and update the loss counts. Returns the frame dict or None.
+    def feed(self, data):
+        frame = telemetry.decode(data)
+        if frame is None:
+            return None
+        vehicle = frame['vehicle']
+        previous = self.last_sequence.get(vehicle)
+        if previous is not None:
+            gap = (frame['sequence'] - previous - 1) & 0xFFFF
+            if gap < 0x8000:  # otherwise a reordered or repeated frame
+                self.lost[vehicle] = self.lost.get(vehicle, 0) + gap
+        self.last_sequence[vehicle] = frame['sequence']
+        self.received[vehicle] = self.received.get(vehicle, 0) + 1
+        return frame
+
+
+def format_frame(frame):
+    source = frame['source']
+    source = SOURCE_NAMES[source] if source < len(SOURCE_NAMES) else str(source)
+    text = "#{vehicle} {sequence:5d} t={ticks_ms:9d} H={altitude:7.3f} m V={velocity:6.0f} mm/s " \
+           "set={setpoint:5.0f} duty={duty:5d} ({source})".format(source=source, **frame)
+    temperatures = [t for t in frame['temperatures'] if not math.isnan(t)]
+    if temperatures:
+        text += " T=" + "/".join("{:.1f}".format(t) for t in temperatures)
+    if frame['faults']:
+        text += " faults={}".format(frame['faults'])
+    return text
+
+
+def listen(args):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((args.bind, args.port))
+    receiver = Receiver()
+    out = None
+    writer = None
+    if args.csv:
+        out = open(args.csv, 'w', newline='')
+        writer = csv.DictWriter(out, COLUMNS)
+        writer.writeheader()
+    print("Listening on {}:{}".format(args.bind, args.port))
+    try:
+        while True:
+            data, address = s.recvfrom(2048)
+            frame = receiver.feed(data)
+            if frame is None:
+                continue
+            if writer:
+                writer.writerow(flatten(frame))
+            if not args.quiet:
+                print(format_frame(frame))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out:
+            out.close()
+        for vehicle in sorted(receiver.received):
+            print("vehicle {}: {} frames, {} lost".format(
+                vehicle, receiver.received[vehicle], receiver.lost.get(vehicle, 0)))
+
+
+def self_test():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    s.settimeout(1.0)
+    clock = [1000.0]
+    mpcompat.set_clock(lambda: clock[0])
+    telemetry.cfg['host'] = '127.0.0.1'
+    telemetry.cfg['port'] = s.getsockname()[1]
+    telemetry.cfg['rate_hz'] = 10
+    telemetry.cfg['vehicle'] = 7
+    telemetry.temperatures[0] = 31.5
+    telemetry.start()
+    # publish at 20 Hz, expect every other frame at 10 Hz
+    published = []
+    for i in range(40):
+        if telemetry.publish(1.0 + i / 100, -20.0 * i, 50.0, i % 3, (i % 5 - 2) * 511):
+            published.append(i)
+        clock[0] += 0.05
+    telemetry.stop()
+    mpcompat.reset_clock()
+
+    receiver = Receiver()
+    frames = []
+    try:
+        while len(frames) < len(published):
+            frames.append(receiver.feed(s.recvfrom(2048)[0]))
+    except socket.timeout:
+        pass
+    failures = []
+    if len(published) != 20:
+        failures.append("decimation: {} of 40 published, expected 20".format(len(published)))
+    if len(frames) != len(published):
+        failures.append("received {} of {} frames".format(len(frames), len(published)))
+    for i, frame in zip(published, frames):
+        expected = (7, 1.0 + i / 100, -20.0 * i, 50.0, i % 3, (i % 5 - 2) * 511, 31.5)
+        got = (frame['vehicle'], frame['altitude'], frame['velocity'], frame['setpoint'],
+               frame['source'], frame['duty'], frame['temperatures'][0])
+        if any(abs(a - b) > 1e-4 for a, b in zip(expected, got)) or not math.isnan(frame['temperatures'][1]):
+            failures.append("frame {}: expected {}, got {}".format(i, expected, got))
+    if receiver.lost.get(7, 0):
+        failures.append("{} frames counted as lost".format(receiver.lost[7]))
+    print("frame size {} bytes, {} frames sent, {} received, {} dropped by sender".format(
+        telemetry.FRAME_SIZE, telemetry.stats['sent'], len(frames), telemetry.stats['dropped']))
+    return mpcompat.report(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=telemetry.PORT)
+    parser.add_argument('--csv', help="also write every frame to this CSV file")
+    parser.add_argument('--quiet', action='store_true', help="don't print frames")
+    parser.add_argument('--self-test', action='store_true', help="loopback test, no blimp needed")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+    listen(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Latency breakdown of a trace dump from micropython_root/trace.py.
+
+On the board:
+    trace.start()
+    ...fly for a while...
+    trace.dump("trace.bin")
+copy it off (e.g. `mpremote cp :trace.bin .`), then
+    python host/trace_report.py trace.bin
+    python host/trace_report.py trace.bin --collapsed trace.folded
+The second writes the stacks in the collapsed format, for
+`flamegraph.pl trace.folded > trace.svg` or https://www.speedscope.app
+
+--stage NAME also prints a histogram of that stage's durations, e.g.
+to tell a steady BMP388 wait from occasional long I2C stalls.
+
+"""
+
+import argparse
+import sys
+
+import mpcompat
+
+mpcompat.install()
+
+import trace  # noqa: E402 (micropython_root/trace.py, needs mpcompat first)
+
+
+def histogram(durations, bins=10, width=50):
+    low = min(durations)
+    high = max(durations)
+    step = max(1, (high - low + bins) // bins)
+    counts = [0] * bins
+    for d in durations:
+        counts[min(bins - 1, (d - low) // step)] += 1
+    peak = max(counts)
+    lines = []
+    for i, count in enumerate(counts):
+        bar = '#' * (count * width // peak)
+        lines.append("{:>8d} us {:6d} {}".format(low + i * step, count, bar))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dump', help="file written by trace.dump()")
+    parser.add_argument('--collapsed', help="write collapsed stacks (self time, us) to this file")
+    parser.add_argument('--stage', action='append', default=[], help="print a histogram of this stage")
+    args = parser.parse_args()
+
+    recorded = trace.load(args.dump)
+    if recorded:
+        base = recorded[0][1]
+        starts = [trace._relative(start, base) for name, start, duration in recorded]
+        ends = [start + duration for start, (name, ticks, duration) in zip(starts, recorded)]
+        print("{} spans over {:.3f} s".format(len(recorded), (max(ends) - min(starts)) / 1e6))
+    for line in trace.format_report(recorded):
+        print(line)
+
+    for stage in args.stage:
+        durations = [duration for name, start, duration in recorded if name == stage]
+        print("")
+        if not durations:
+            print("{}: no spans".format(stage))
+            continue
+        print("{}:".format(stage))
+        for line in histogram(durations):
+            print(line)
+
+    if args.collapsed:
+        stacks = trace.collapse(trace.nest(recorded))
+        with open(args.collapsed, 'w') as f:
+            for key in sorted(stacks):
+                f.write("{} {}\n".format(key, stacks[key]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
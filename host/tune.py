@@ -0,0 +1,622 @@
+"""
+Tunes ballonet_controller's settings with Monte Carlo flights of the whole
+altitude stack, spread over every core, and writes the best settings as a
+ballonet_controller_cfg file for the board. Needs numpy.
+
+batch_sim.py runs a vectorized copy of the controller. This runs the code
+that flies, one flight at a time. Each flight builds a real ALTITUDE with
+HeightTiltCompensator fusions around simulated sensors. The ToF and the
+sonar are seen through a swinging accelerometer, and a sonar frame can go
+missing, which raises TypeError in read_buffered(). The flight calibrates
+with find_floor_from_range() and then runs ballonet_logic's estimate() and
+decide() on the controller's warm-up and tick schedule. The plant is
+batch_sim.MODEL's. Sleeps and ticks_ms run on the flight's virtual clock.
+A flight is scored like batch_sim scores it: settling time plus
+--energy-weight s per J of pump energy.
+
+Each candidate setting flies --replicates flights, with the same seeds for
+every candidate. The flights are spread over a process pool. Each worker
+writes its flight's result into its row of a results table in shared
+memory, so results aren't pickled back. Search modes:
+  --search grid     every combination of --grid values (defaults in GRID)
+  --search bayes    a Gaussian process fitted to the scores so far picks the
+                    next --batch candidates by expected improvement, in the
+                    --range bounds (defaults in SPACE); the first --initial
+                    are random
+After every batch the scored candidates go to --checkpoint (JSON, written
+atomically). Running again with the same checkpoint carries on from there.
+If the checkpoint was made with other flights (--replicates, --duration,
+--seed), scoring, base settings (--cfg) or search space (--grid, --range),
+the run stops with an error.
+
+The best candidate's settings go to --output in the old text format
+(config.export_legacy()). Copy that file to the board and load it with
+    import ballonet_controller
+    ballonet_controller.settings.import_legacy('ballonet_controller_cfg'); ballonet_controller.savecfg()
+n_s and T aren't settings; the suggested start() is printed instead. The
+other settings come from --cfg (the board's file). Without --cfg they are
+the defaults, with the floor and ceiling of the simulated room.
+
+    python host/tune.py --search bayes --evaluations 60 --checkpoint tune.json
+    python host/tune.py --search grid --grid bangbang_tolerance=20,50,80 --grid n_s=3,5
+
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import mpcompat
+
+mpcompat.install()  # also makes altitude.py's and distance.py's sleep the flight's clock
+
+import ballonet_logic  # noqa: E402 (needs mpcompat first)
+from altitude import ALTITUDE  # noqa: E402
+from distance import HeightTiltCompensator  # noqa: E402
+from batch_sim import MODEL, GRID, WARM_UP_MS  # noqa: E402
+from controller_replay import load_settings  # noqa: E402
+
+# name: (low, high, type) searched by --search bayes
+SPACE = {
+    'bangbang_tolerance': (5.0, 100.0, float),
+    'barometer_drift': (0.2, 3.0, float),
+    'calibration_drift': (0.0, 0.5, float),
+    'n_s': (3, 10, int),
+    'T': (300, 1500, int),
+}
+_START_ARGUMENTS = ('n_s', 'T')
+
+FLIGHT = dict(MODEL, **{
+    'sea_level': 120.0,  # m, barometer altitude of the floor
+    'held_low': 0.3,  # m, held between these heights for the floor calibration
+    'held_high': 0.8,
+    'tilt': 0.1,  # rad, amplitude of the swing
+    'tilt_period': 8.0,  # s
+    'tilt_noise': 0.01,  # rad
+    'tof_bias': 40.0,  # mm the ToF reads long; devices.py sets offset -40 for it
+})
+
+_COLUMNS = ('settle', 'energy', 'hits', 'settled', 'done')
+_CHECKPOINT_VERSION = 1
+
+
+class _Accelerometer:
+    # What HeightTiltCompensator uses of ACCELEROMETER
+    def __init__(self, flight):
+        self.flight = flight
+
+    def getAxes(self):
+        tilt = self.flight.last_tilt
+        return {'x': math.sin(tilt), 'y': 0.0, 'z': -math.cos(tilt)}
+
+
+class _ToF:
+    # What HeightTiltCompensator uses of VL53L0X
+    DEVICE_TYPE = 'VL53L0X_polulu'
+    vcsel_period_type = (0, 1)
+
+    def __init__(self, flight):
+        self.flight = flight
+
+    def set_Vcsel_pulse_period(self, kind, period):
+        pass
+
+    def set_measurement_timing_budget(self, budget):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self):
+        f = self.flight
+        slant = f.height / math.cos(f.tilt())
+        if slant > f.model['tof_range']:
+            return 8190
+        return int(slant * 1000 + f.model['tof_bias'] + f.model['tof_noise'] * 1000 * f.rng.gauss(0, 1))
+
+
+class _Sonar:
+    # What HeightTiltCompensator uses of XLMaxSonarUART
+    DEVICE_TYPE = 'XL-MAXSONAR'
+
+    def __init__(self, flight):
+        self.flight = flight
+
+    def start(self):
+        pass
+
+    def read(self):
+        f = self.flight
+        if f.rng.random() < f.model['sonar_dropout']:
+            return None  # no frame before the timeout
+        slant = f.height / math.cos(f.tilt()) + f.model['sonar_noise'] * f.rng.gauss(0, 1)
+        return int(round(min(max(slant, f.model['sonar_min']), 7.65) * 100))  # cm
+
+
+class _Barometer:
+    def __init__(self, flight):
+        self.flight = flight
+
+    @property
+    def altitude(self):
+        f = self.flight
+        return f.model['sea_level'] + f.height + f.bias + f.model['barometer_noise'] * f.rng.gauss(0, 1)
+
+
+class Flight:
+    def __init__(self, cfg, n_s, T, seed, model=None):
+        self.cfg = cfg
+        self.n_s = n_s
+        self.T = T
+        self.model = m = model or FLIGHT
+        self.rng = rng = random.Random(seed)
+        self.height = rng.uniform(m['held_low'], m['held_high'])
+        self.neutral = 0.5 + m['trim'] * rng.gauss(0, 1)
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.velocity = 0.0
+        self.fill = 0.5
+        self.bias = 0.0
+        self.direction = ballonet_logic.IDLE
+        self.held = True
+        self.now = 0.0
+        self.energy = 0.0
+        self.hits = 0
+        self.touching = False
+        self.last_tilt = 0.0
+        accelerometer = _Accelerometer(self)
+        self.tof = HeightTiltCompensator(accelerometer, _ToF(self))
+        self.tof.offset = -40.0  # as devices.py sets it
+        self.sonar = HeightTiltCompensator(accelerometer, _Sonar(self))
+        self.altitude = ALTITUDE(_Barometer(self), self.tof, self.sonar)
+        self.altitude.barometer_drift = cfg['barometer_drift']
+        self.altitude.calibration_drift = cfg['calibration_drift']
+
+    def clock(self):
+        return self.now
+
+    def tilt(self):
+        m = self.model
+        self.last_tilt = abs(m['tilt'] * math.sin(2 * math.pi * self.now / m['tilt_period'])
+                             + m['tilt_noise'] * self.rng.gauss(0, 1))
+        return self.last_tilt
+
+    def advance(self, seconds):
+        m = self.model
+        steps = max(1, int(round(seconds / m['step'])))
+        step = seconds / steps
+        for k in range(steps):
+            self.now += step
+            self.bias += m['barometer_walk'] * math.sqrt(step) * self.rng.gauss(0, 1)
+            if self.held:
+                continue
+            thermal = m['thermal_lift'] * math.sin(2 * math.pi * self.now / m['thermal_period'] + self.phase)
+            v = self.velocity
+            acceleration = m['fill_lift'] * (self.neutral - self.fill) + thermal - m['drag'] * v - m['quadratic_drag'] * v * abs(v)
+            self.velocity += acceleration * step
+            self.height += self.velocity * step
+            touching = not 0 < self.height < m['room']
+            if touching:
+                self.velocity = 0.0
+                self.height = min(max(self.height, 0.0), m['room'])
+                self.hits += not self.touching
+            self.touching = touching
+            # pumping in adds air to the ballonet, which makes the blimp heavier
+            self.fill = min(max(self.fill + self.direction * m['flow'] * step, 0.0), 1.0)
+            if self.direction:
+                self.energy += m['pump_power'] * step
+
+    # What the sensor tasks and altitude_from_readings() give the controller for a tick
+    def fused(self):
+        m = self.model
+        raw_altitude = self.altitude.barometer.altitude
+        sr = None
+        if self.rng.random() >= m['tof_dropout']:
+            sr = self.tof.correct(self.tof.rangefinder.read())
+        try:
+            lr = self.sonar.read_buffered()
+        except TypeError:
+            lr = None
+        return self.altitude.fuse(raw_altitude, sr, lr)
+
+    # (settling time, pump energy, floor/ceiling hits, settled)
+    def run(self, duration, band=50.0, hold=30.0):
+        mpcompat.set_clock(self.clock, self.advance)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.altitude.find_floor_from_range(10, True)
+            self.held = False
+            history = ballonet_logic.new_history()
+            for i in range(self.n_s + 1):
+                if i:
+                    self.advance(WARM_UP_MS / 1000)
+                ballonet_logic.prime(history, self.fused(), WARM_UP_MS if i else 0)
+            start = self.now
+            last_unsettled = 0.0
+            period = self.T / 1000
+            while self.now - start < duration:
+                self.advance(period)
+                velocity = ballonet_logic.estimate(history, self.fused(), self.T, self.n_s, 120)
+                self.direction = ballonet_logic.decide(history['altitude'][-1], velocity, self.cfg)[0]
+                if abs(self.velocity * 1000) > band or self.touching:
+                    last_unsettled = self.now - start
+        finally:
+            mpcompat.reset_clock()
+        flown = self.now - start
+        settled = last_unsettled <= flown - hold
+        return (last_unsettled if settled else flown), self.energy, self.hits, settled
+
+
+_table = dict()
+
+
+def _attach(name, rows):
+    memory = shared_memory.SharedMemory(name=name)
+    _table['memory'] = memory
+    _table['rows'] = np.ndarray((rows, len(_COLUMNS)), dtype=np.float64, buffer=memory.buf)
+
+
+# Pool task: one flight, its result written to row `row` of the shared table
+def _fly(task):
+    row, cfg, n_s, T, seed, duration, band, hold = task
+    settle, energy, hits, settled = Flight(cfg, n_s, T, seed).run(duration, band, hold)
+    _table['rows'][row] = (settle, energy, hits, settled, 1)
+
+
+def _score(summary, energy_weight):
+    return summary['settle'] + energy_weight * summary['energy']
+
+
+class Runner:
+    def __init__(self, base, replicates, duration, band, hold, seed, energy_weight, capacity, processes=None):
+        self.base = base
+        self.replicates = replicates
+        self.duration = duration
+        self.band = band
+        self.hold = hold
+        self.seed = seed
+        self.energy_weight = energy_weight
+        self.rows = capacity * replicates
+        self.memory = shared_memory.SharedMemory(create=True, size=self.rows * len(_COLUMNS) * 8)
+        self.table = np.ndarray((self.rows, len(_COLUMNS)), dtype=np.float64, buffer=self.memory.buf)
+        self.pool = multiprocessing.Pool(processes, initializer=_attach, initargs=(self.memory.name, self.rows))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.table
+        self.memory.close()
+        self.memory.unlink()
+
+    # Flies every candidate ({setting: value}, with n_s and T) and returns
+    # their summaries, scored
+    def evaluate(self, candidates):
+        self.table[:] = 0
+        tasks = []
+        for k, candidate in enumerate(candidates):
+            cfg = dict(self.base)
+            cfg.update((name, value) for name, value in candidate.items() if name not in _START_ARGUMENTS)
+            for r in range(self.replicates):
+                tasks.append((k * self.replicates + r, cfg, candidate['n_s'], candidate['T'],
+                              self.seed * 1000003 + r, self.duration, self.band, self.hold))
+        for done in self.pool.imap_unordered(_fly, tasks, chunksize=max(1, len(tasks) // (8 * os.cpu_count()))):
+            pass
+        summaries = []
+        for k, candidate in enumerate(candidates):
+            rows = self.table[k * self.replicates:(k + 1) * self.replicates]
+            if not rows[:, 4].all():
+                raise RuntimeError("flights of {} didn't report".format(candidate))
+            summary = dict(candidate, settle=float(rows[:, 0].mean()), energy=float(rows[:, 1].mean()),
+                           hits=float(rows[:, 2].mean()), settled=float(rows[:, 3].mean()))
+            summary['score'] = _score(summary, self.energy_weight)
+            summaries.append(summary)
+        return summaries
+
+
+def load_checkpoint(path, run):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != _CHECKPOINT_VERSION:
+        raise ValueError(path + " is from another version of this tool")
+    for key in set(run) | set(data['run']):
+        if data['run'].get(key) == run.get(key):
+            continue
+        if isinstance(run.get(key), dict) or isinstance(data['run'].get(key), dict):
+            raise ValueError("{} was made with other {} settings".format(path, key))
+        raise ValueError("{} was made with {}={}, not {}".format(path, key, data['run'].get(key), run.get(key)))
+    return data['evaluated']
+
+
+def save_checkpoint(path, run, evaluated):
+    if not path:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': _CHECKPOINT_VERSION, 'run': run, 'evaluated': evaluated}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _key(candidate):
+    return tuple(sorted((name, candidate[name]) for name in SPACE if name in candidate))
+
+
+def _normalize(candidates, space):
+    return np.array([[(c[name] - low) / (high - low) for name, (low, high, kind) in space.items()]
+                     for c in candidates])
+
+
+def _candidate(point, space):
+    candidate = dict()
+    for x, (name, (low, high, kind)) in zip(point, space.items()):
+        value = low + float(x) * (high - low)
+        if name == 'T':
+            value = int(round(value / 50)) * 50  # a few ms either way don't matter
+        candidate[name] = int(round(value)) if kind is int else round(value, 3)
+    return candidate
+
+
+def _kernel(a, b, length):
+    distance = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+    return np.exp(-0.5 * distance / length ** 2)
+
+
+_erf = np.vectorize(math.erf)
+
+
+# Points in [0, 1]^d to try next: maximum expected improvement of a Gaussian
+# process fitted to (x, y), y being scores to minimize. Picks `count` at once,
+# each assuming the ones picked before it score as well as the best so far.
+def propose(x, y, count, rng, length=0.25, noise=1e-2, samples=4000):
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float)
+    chosen = []
+    for k in range(count):
+        z = (y - y.mean()) / (y.std() or 1.0)
+        factor = np.linalg.cholesky(_kernel(x, x, length) + noise * np.eye(len(x)))
+        alpha = np.linalg.solve(factor.T, np.linalg.solve(factor, z))
+        points = rng.random((samples, x.shape[1]))
+        cross = _kernel(points, x, length)
+        mean = cross @ alpha
+        v = np.linalg.solve(factor, cross.T)
+        sigma = np.sqrt(np.clip(1.0 - (v * v).sum(axis=0), 1e-12, None))
+        improvement = z.min() - mean
+        u = improvement / sigma
+        expected = improvement * 0.5 * (1 + _erf(u / math.sqrt(2))) + sigma * np.exp(-0.5 * u * u) / math.sqrt(2 * math.pi)
+        best = points[int(np.argmax(expected))]
+        chosen.append(best)
+        x = np.vstack([x, best])
+        y = np.append(y, y.min())
+    return chosen
+
+
+def search_grid(runner, grid, evaluated, batch, checkpoint, run, report=print):
+    names = list(grid)
+    done = set(_key(e) for e in evaluated)
+    todo = [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+    todo = [c for c in todo if _key(c) not in done]
+    report("{} candidates, {} already in the checkpoint".format(len(todo) + len(done), len(done)))
+    for k in range(0, len(todo), batch):
+        evaluated.extend(runner.evaluate(todo[k:k + batch]))
+        save_checkpoint(checkpoint, run, evaluated)
+        report("{:4d} flown, best score {:.1f}".format(len(evaluated), min(e['score'] for e in evaluated)))
+    return evaluated
+
+
+def search_bayes(runner, space, evaluated, evaluations, initial, batch, checkpoint, run, seed, report=print):
+    rng = np.random.default_rng(seed + len(evaluated))
+    while len(evaluated) < evaluations:
+        count = min(batch, evaluations - len(evaluated))
+        known = [e for e in evaluated if all(name in e for name in space)]
+        if len(known) < initial:
+            points = rng.random((count, len(space)))
+        else:
+            points = propose(_normalize(known, space), [e['score'] for e in known], count, rng)
+        candidates = []
+        keys = set(_key(e) for e in evaluated)
+        for point in points:
+            candidate = _candidate(point, space)
+            if _key(candidate) not in keys:
+                keys.add(_key(candidate))
+                candidates.append(candidate)
+        if not candidates:
+            candidates = [_candidate(rng.random(len(space)), space)]
+        evaluated.extend(runner.evaluate(candidates))
+        save_checkpoint(checkpoint, run, evaluated)
+        report("{:4d} flown, best score {:.1f}".format(len(evaluated), min(e['score'] for e in evaluated)))
+    return evaluated
+
+
+def format_summaries(summaries, top=10):
+    lines = ["{:>9} {:>3} {:>5} {:>6} {:>6} | {:>7} {:>7} {:>7} {:>5} {:>7}".format(
+        "tolerance", "n_s", "T", "baro", "calib", "settle", "settled", "energy", "hits", "score")]
+    for s in summaries[:top]:
+        lines.append("{:9.1f} {:3d} {:5d} {:6.2f} {:6.2f} | {:6.1f}s {:6.0f}% {:6.1f}J {:5.2f} {:7.1f}".format(
+            s['bangbang_tolerance'], s['n_s'], s['T'], s['barometer_drift'], s['calibration_drift'],
+            s['settle'], 100 * s['settled'], s['energy'], s['hits'], s['score']))
+    return lines
+
+
+# Writes `base` with the best candidate's settings in the ballonet_controller_cfg format
+def export(best, base, path):
+    import config
+    settings = config.CONFIG(path, ballonet_logic.SETTINGS)
+    for name in settings.order:
+        settings.set(name, best.get(name, base[name]))
+    settings.export_legacy(path)
+
+
+# What a checkpoint must have been made with to be resumed: the flights,
+# the scoring, the settings not tuned and the grid or space searched.
+# Lists rather than tuples, so it compares equal after a JSON round trip.
+def _run(base, replicates, duration, seed, band, hold, energy_weight, grid=None, space=None):
+    run = {'replicates': replicates, 'duration': duration, 'seed': seed, 'band': band, 'hold': hold,
+           'energy_weight': energy_weight, 'base': dict(base)}
+    if grid is not None:
+        run['grid'] = dict((name, list(values)) for name, values in grid.items())
+    if space is not None:
+        run['space'] = dict((name, [low, high]) for name, (low, high, kind) in space.items())
+    return run
+
+
+def _base_settings(path):
+    if path:
+        return load_settings(path)
+    return load_settings(None, {'floor_height': FLIGHT['floor_height'], 'ceiling_height': FLIGHT['ceiling_height']})
+
+
+def self_test():
+    import shutil
+    import tempfile
+    failures = []
+    base = _base_settings(None)
+    candidate = {'bangbang_tolerance': 20.0, 'barometer_drift': 1.0, 'calibration_drift': 0.25, 'n_s': 5, 'T': 1000}
+    cfg = dict(base, **dict((k, v) for k, v in candidate.items() if k not in _START_ARGUMENTS))
+    first = Flight(cfg, 5, 1000, 7).run(120)
+    if Flight(cfg, 5, 1000, 7).run(120) != first:
+        failures.append("the same seed flew differently")
+    started = time.perf_counter()
+    Flight(cfg, 5, 1000, 8).run(120)
+    flight_s = time.perf_counter() - started
+
+    folder = tempfile.mkdtemp(prefix='tune_')
+    checkpoint = os.path.join(folder, 'tune.json')
+    output = os.path.join(folder, 'ballonet_controller_cfg')
+    grid = {'bangbang_tolerance': (10.0, 1000.0), 'barometer_drift': (1.0,), 'calibration_drift': (0.25,),
+            'n_s': (5,), 'T': (1000,)}
+    run = _run(base, 4, 120.0, 1, 50.0, 30.0, 0.5, grid=grid)
+    runner = Runner(base, 4, 120.0, 50.0, 30.0, 1, 0.5, capacity=4, processes=2)
+    quiet = lambda line: None  # noqa: E731
+    try:
+        evaluated = search_grid(runner, grid, [], 1, checkpoint, run, quiet)
+        # a pool flight must match the same flight flown here
+        here = [Flight(dict(base, bangbang_tolerance=10.0), 5, 1000, 1000003 + r).run(120) for r in range(4)]
+        if abs(evaluated[0]['settle'] - sum(f[0] for f in here) / 4) > 1e-9:
+            failures.append("shared table settle {} vs {}".format(evaluated[0]['settle'], sum(f[0] for f in here) / 4))
+        resumed = load_checkpoint(checkpoint, run)
+        if len(search_grid(runner, grid, resumed, 1, checkpoint, run, quiet)) != 2:
+            failures.append("resuming flew the grid again")
+        others = [dict(run, replicates=5), dict(run, energy_weight=1.0),
+                  _run(dict(base, floor_height=5.0), 4, 120.0, 1, 50.0, 30.0, 0.5, grid=grid),
+                  _run(base, 4, 120.0, 1, 50.0, 30.0, 0.5, grid=dict(grid, n_s=(3,))),
+                  _run(base, 4, 120.0, 1, 50.0, 30.0, 0.5, space=SPACE)]
+        for other in others:
+            try:
+                load_checkpoint(checkpoint, other)
+                failures.append("a checkpoint from another run was accepted: {}".format(other))
+            except ValueError:
+                pass
+        # the grid's candidates seed the Bayesian search, which then checkpoints as its own run
+        evaluated = search_bayes(runner, SPACE, resumed, 8, 2, 3, checkpoint,
+                                 _run(base, 4, 120.0, 1, 50.0, 30.0, 0.5, space=SPACE), 1, quiet)
+        if len(evaluated) != 8:
+            failures.append("{} candidates after the Bayesian search".format(len(evaluated)))
+        best = min(evaluated, key=lambda e: e['score'])
+        export(best, base, output)
+        exported = load_settings(output)
+        if exported['bangbang_tolerance'] != float(best['bangbang_tolerance']) or exported['floor_height'] != base['floor_height']:
+            failures.append("exported settings {}".format(exported))
+        with open(output) as f:
+            text = f.read()
+        print(text.strip())
+    finally:
+        runner.close()
+        shutil.rmtree(folder)
+    for line in format_summaries(sorted(evaluated, key=lambda e: e['score']), 4):
+        print(line)
+    print("one 120 s flight takes {:.0f} ms".format(flight_s * 1000))
+    return mpcompat.report(failures)
+
+
+def _parse(text, kind):
+    return tuple(kind(value) for value in text.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--search', choices=('grid', 'bayes'), default='bayes')
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2,...', help="values for --search grid")
+    parser.add_argument('--range', action='append', default=[], metavar='NAME=LOW:HIGH', help="bounds for --search bayes")
+    parser.add_argument('--evaluations', type=int, default=60, help="candidates for --search bayes")
+    parser.add_argument('--initial', type=int, default=None, help="random candidates before the Gaussian process")
+    parser.add_argument('--batch', type=int, default=None, help="candidates flown at a time")
+    parser.add_argument('--replicates', type=int, default=20, help="flights per candidate")
+    parser.add_argument('--duration', type=float, default=180.0, help="s of each flight after the warm-up")
+    parser.add_argument('--band', type=float, default=50.0, help="mm/s of true velocity counted as settled")
+    parser.add_argument('--hold', type=float, default=30.0, help="s a flight must stay settled at the end")
+    parser.add_argument('--energy-weight', type=float, default=0.5, help="s of settling time a J of pumping costs")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None, help="pool size, all cores by default")
+    parser.add_argument('--cfg', help="the board's settings, for everything not tuned")
+    parser.add_argument('--checkpoint', help="JSON file to save progress in and resume from")
+    parser.add_argument('--output', default='ballonet_controller_cfg', help="where to write the best settings")
+    parser.add_argument('--self-test', action='store_true', help="check flights, the pool, checkpoints and the output")
+    args = parser.parse_args()
+    if args.self_test:
+        return self_test()
+
+    processes = args.processes or os.cpu_count()
+    batch = args.batch or processes
+    base = _base_settings(args.cfg)
+    grid = space = None
+    if args.search == 'grid':
+        grid = dict(GRID)
+        for item in args.grid:
+            name, values = item.split('=', 1)
+            if name not in SPACE:
+                parser.error("can't search " + name)
+            grid[name] = _parse(values, SPACE[name][2])
+    else:
+        space = dict(SPACE)
+        for item in args.range:
+            name, bounds = item.split('=', 1)
+            if name not in SPACE:
+                parser.error("can't search " + name)
+            low, high = bounds.split(':')
+            kind = SPACE[name][2]
+            space[name] = (kind(low), kind(high), kind)
+    run = _run(base, args.replicates, args.duration, args.seed, args.band, args.hold, args.energy_weight,
+               grid, space)
+    try:
+        evaluated = load_checkpoint(args.checkpoint, run)
+    except ValueError as e:
+        parser.error(str(e))
+    runner = Runner(base, args.replicates, args.duration, args.band, args.hold, args.seed, args.energy_weight,
+                    batch, processes)
+    started = time.perf_counter()
+    try:
+        if grid is not None:
+            evaluated = search_grid(runner, grid, evaluated, batch, args.checkpoint, run)
+        else:
+            initial = args.initial if args.initial is not None else max(2 * batch, 2 * len(space))
+            evaluated = search_bayes(runner, space, evaluated, args.evaluations, initial, batch,
+                                     args.checkpoint, run, args.seed)
+    finally:
+        runner.close()
+    print("{} candidates x {} flights in {:.1f} s on {} processes".format(
+        len(evaluated), args.replicates, time.perf_counter() - started, processes))
+    ranked = sorted(evaluated, key=lambda e: e['score'])
+    for line in format_summaries(ranked):
+        print(line)
+    best = ranked[0]
+    export(best, base, args.output)
+    print("wrote {}; start with ballonet_controller.start(n_s={}, T={})".format(args.output, best['n_s'], best['T']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
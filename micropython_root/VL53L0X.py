@@ -12,6 +12,8 @@ from micropython import const
 import ustruct
 import utime
 import time
+from i2cbus import batch
+import vl53l0x_cal
 
 _IO_TIMEOUT = 2000
 _SYSRANGE_START = const(0x00)
@@ -119,10 +121,12 @@ class TimeoutError(RuntimeError):
 
 
 class VL53L0X:
-    def __init__(self, i2c, address=0x29):
+    # recalibrate: measure SPADs and reference calibration even if they're cached
+    def __init__(self, i2c, address=0x29, recalibrate=False):
         self.DEVICE_TYPE = 'VL53L0X_polulu'
         self.i2c = i2c
         self.address = address
+        self.recalibrate = recalibrate
         self.init()
         self._started = False
         self.measurement_timing_budget_us = 0
@@ -169,8 +173,10 @@ class VL53L0X:
         self._register(register, data)
 
     def _config(self, *config):
-        for register, value in config:
-            self._register(register, value)
+        # page-select sequences must not be interleaved with other bus traffic
+        with batch(self.i2c):
+            for register, value in config:
+                self._register(register, value)
 
     def init(self, power2v8=True):
         self._flag(_EXTSUP_HV, 0, power2v8)
@@ -200,7 +206,13 @@ class VL53L0X:
 
         self._register(_SYSTEM_SEQUENCE, 0xff)
 
-        spad_count, is_aperture = self._spad_info()
+        # SPAD info and reference calibration are cached per sensor, see vl53l0x_cal.py
+        self.uid = vl53l0x_cal.read_uid(self.i2c, self.address)
+        cached = None if self.recalibrate else vl53l0x_cal.lookup(self.uid)
+        if cached:
+            spad_count, is_aperture = cached[0], cached[1]
+        else:
+            spad_count, is_aperture = self._spad_info()
         spad_map = bytearray(self._registers(_SPAD_ENABLES, struct='6B'))
 
         # set reference spads
@@ -326,10 +338,16 @@ class VL53L0X:
         # self._register(_SYSTEM_SEQUENCE, 0xe8)
         # self._timing_budget(budget)
 
-        self._register(_SYSTEM_SEQUENCE, 0x01)
-        self._calibrate(0x40)
-        self._register(_SYSTEM_SEQUENCE, 0x02)
-        self._calibrate(0x00)
+        if cached:
+            vl53l0x_cal.write_ref_calibration(self.i2c, self.address, cached[2], cached[3])
+        else:
+            self._register(_SYSTEM_SEQUENCE, 0x01)
+            self._calibrate(0x40)
+            self._register(_SYSTEM_SEQUENCE, 0x02)
+            self._calibrate(0x00)
+            vhv, phase = vl53l0x_cal.read_ref_calibration(self.i2c, self.address)
+            vl53l0x_cal.save(self.uid, spad_count, is_aperture, vhv, phase)
+        self.calibration_cached = bool(cached)
 
         self._register(_SYSTEM_SEQUENCE, 0xe8)
 
@@ -438,11 +456,19 @@ class VL53L0X:
             else:
                 raise TimeoutError()
         for timeout in range(_IO_TIMEOUT):
-            if self._register(_RESULT_INTERRUPT_STATUS) & 0x07:
+            if self.data_ready():
                 break
             utime.sleep_ms(1)
         else:
             raise TimeoutError()
+        return self.read_result()
+
+    # In continuous mode (after start()), poll data_ready() and then
+    # read_result() instead of blocking in read().
+    def data_ready(self):
+        return bool(self._register(_RESULT_INTERRUPT_STATUS) & 0x07)
+
+    def read_result(self):
         value = self._register(_RESULT_RANGE_STATUS + 10, struct='>H')
         self._register(_INTERRUPT_CLEAR, 0x01)
         return value
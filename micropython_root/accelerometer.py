@@ -21,6 +21,9 @@ Z positive: -137.2931   -25.4973    2906.6914
 
 '''
 
+from array import array
+import calstore
+
 GRAVITY = 9.80665
 
 
@@ -31,21 +34,14 @@ class ACCELEROMETER:
         self.file = file
         self.axes_bi = {e: None for e in {'x', 'y', 'z'}}
         self.axes_bi = (self.axes_bi.copy(), self.axes_bi.copy())
-        contents = []
-        with open(self.file, "r") as f:
-            while True:
-                line = f.readline()
-                if line:
-                    split = line.rstrip().split("\t")
-                    contents.extend(split[1:len(split)])
-                else:
-                    break
-        self.axes_bi[0]['x'] = contents[0]
-        self.axes_bi[1]['x'] = contents[3]
-        self.axes_bi[0]['y'] = contents[7]
-        self.axes_bi[1]['y'] = contents[10]
-        self.axes_bi[0]['z'] = contents[14]
-        self.axes_bi[1]['z'] = contents[17]
+        # negative and positive reading of x, y, z, compiled once (see calstore.py)
+        cal = calstore.cached(self.file, _parse_calibration, 1)[0]
+        self.axes_bi[0]['x'] = cal[0]
+        self.axes_bi[1]['x'] = cal[1]
+        self.axes_bi[0]['y'] = cal[2]
+        self.axes_bi[1]['y'] = cal[3]
+        self.axes_bi[0]['z'] = cal[4]
+        self.axes_bi[1]['z'] = cal[5]
 
     def getAxes(self):
         axes = self.adxl345.getAxes()
@@ -63,6 +59,20 @@ class ACCELEROMETER:
         return axes
 
 
+# calibration text file to [array('f', (x neg, x pos, y neg, y pos, z neg, z pos))]
+def _parse_calibration(file):
+    contents = []
+    with open(file, "r") as f:
+        while True:
+            line = f.readline()
+            if line:
+                split = line.rstrip().split("\t")
+                contents.extend(split[1:len(split)])
+            else:
+                break
+    return [array('f', [float(contents[i]) for i in (0, 3, 7, 10, 14, 17)])]
+
+
 def linear_approximation(x1, y1, x2, y2, p):
     m = (y2 - y1) / (x2 - x1)
     return m * (p - x1) + y1
@@ -71,9 +81,9 @@ def linear_approximation(x1, y1, x2, y2, p):
 def main():
     global getAxes
     global this
-    from machine import Pin, I2C
     import adxl345
-    i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+    from i2cbus import get_bus
+    i2c = get_bus().client()
     a = adxl345.ADXL345(i2c, 83)
     this = ACCELEROMETER(a, 'adxl345_calibration_2point')
     getAxes = this.getAxes
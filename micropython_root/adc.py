@@ -4,7 +4,22 @@ ADS1115 driver for ESP32 running Micropython
 Not fully implemented.
 '''
 
-from time import sleep
+from time import sleep, sleep_us, ticks_us, ticks_diff
+
+_PGA = {6.144: 0b000, 4.096: 0b001, 2.048: 0b010, 1.024: 0b011, 0.512: 0b100, 0.256: 0b101}
+_MUX = {
+    "A0": 0b100,
+    "A1": 0b101,
+    "A2": 0b110,
+    "A3": 0b111,
+    # the following multiplexer configs are differential
+    "A01": 0b000,
+    "A03": 0b001,
+    "A13": 0b010,
+    "A23": 0b011,
+}
+# samples per second for each data_rate setting
+DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
 
 
 class ADS1115():
@@ -20,11 +35,30 @@ class ADS1115():
         self.comp_lat = 0b0
         self.comp_que = 0b11
         self.channel = "A0"
+        self._configs = {}  # prebuilt single-shot config per channel, see start()
+        self._buffer = bytearray(2)
+        self._started = 0
+
+    @property
+    def sps(self):
+        return DATA_RATES[self.data_rate]
+
+    @sps.setter
+    def sps(self, sps):
+        # pick the slowest data rate that is at least `sps`
+        for i, rate in enumerate(DATA_RATES):
+            if rate >= sps or i == len(DATA_RATES) - 1:
+                self.data_rate = i
+                break
+        self.invalidate()
+
+    # microseconds for one conversion at the current data rate, with 10% margin
+    @property
+    def conversion_time_us(self):
+        return 1100000 // DATA_RATES[self.data_rate]
 
     def build_config(self, single_shot=True):
         os = 0b1
-        mux = None
-        pga = None
         mode = self.mode
         data_rate = self.data_rate
         comp_mode = self.comp_mode
@@ -32,37 +66,10 @@ class ADS1115():
         comp_lat = self.comp_lat
         comp_que = self.comp_que
 
-        if self.fs == 6.144:
-            pga = 0b000
-        elif self.fs == 4.096:
-            pga = 0b001
-        elif self.fs == 2.048:
-            pga = 0b010
-        elif self.fs == 1.024:
-            pga = 0b011
-        elif self.fs == 0.512:
-            pga = 0b100
-        elif self.fs == 0.256:
-            pga = 0b101
-
-        if self.channel is "A0":
-            mux = 0b100
-        elif self.channel is "A1":
-            mux = 0b101
-        elif self.channel is "A2":
-            mux = 0b110
-        elif self.channel is "A3":
-            mux = 0b111
-        # the following multiplexer configs are differential
-        elif self.channel is "A01":
-            mux = 0b000
-        elif self.channel is "A03":
-            mux = 0b001
-        elif self.channel is "A13":
-            mux = 0b010
-        elif self.channel is "A23":
-            mux = 0b011
-        else:
+        pga = _PGA.get(self.fs)
+        try:
+            mux = _MUX[self.channel]
+        except KeyError:
             raise TypeError(str(self.channel) + "was not a valid input configuration.")
 
         # writing the 15th (msb) as 1 will tell it to do a reading
@@ -77,6 +84,47 @@ class ADS1115():
         config = config.to_bytes(2, 'big')  # convert int to bytes literal
         self.config = config
 
+    # Non-blocking single-shot conversion. start() returns immediately,
+    # then poll ready() and fetch the result with read_raw().
+    # Configs are cached per channel; call invalidate() after changing
+    # fs, data_rate or comparator settings.
+    def start(self, channel):
+        config = self._configs.get(channel)
+        if config is None:
+            self.channel = channel
+            self.build_config()
+            config = self.config
+            self._configs[channel] = config
+        self.i2c.writeto_mem(self.address, 1, config)
+        self._started = ticks_us()
+
+    def invalidate(self):
+        self._configs = {}
+
+    def ready(self):
+        # don't bother the bus until the conversion could be finished
+        if ticks_diff(ticks_us(), self._started) < self.conversion_time_us:
+            return False
+        self.i2c.readfrom_mem_into(self.address, 1, self._buffer)
+        # reading msb of 0 from the config register means a conversion is happening
+        return bool(self._buffer[0] & 0x80)
+
+    # signed 16-bit result of the last conversion. 32768 is equal to FS.
+    def read_raw(self):
+        self.i2c.readfrom_mem_into(self.address, 0, self._buffer)
+        raw = (self._buffer[0] << 8) | self._buffer[1]
+        if raw & 0x8000:
+            raw -= 0x10000
+        return raw
+
+    # blocking conversion returning the raw result
+    def convert_raw(self, channel):
+        self.start(channel)
+        sleep_us(self.conversion_time_us)
+        while not self.ready():
+            sleep_us(100)
+        return self.read_raw()
+
     def get_voltage(self, channel="A01", refresh_config=True):
         self.channel = channel
         if refresh_config:
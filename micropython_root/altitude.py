@@ -21,6 +21,13 @@ Then, call find_floor_from_range(set_floor=True)
 from time import sleep
 from statistics_tools import mean
 from distance import OUT_OF_RANGE
+import trace
+
+# which sensor the last altitude came from, see ALTITUDE.source
+SOURCE_BAROMETER = 0
+SOURCE_SHORT_RANGE = 1
+SOURCE_LONG_RANGE = 2
+SOURCE_NAMES = ('barometer', 'short range', 'long range')
 
 
 class ALTITUDE:
@@ -37,6 +44,7 @@ class ALTITUDE:
         # Used to prevent rangefinder from being used if object passes below us.
         # Set to very high value to never use barometer.
         self.barometer_drift = 1
+        self.source = SOURCE_BAROMETER  # sensor used for the last altitude
 
     # find floor altitude compared to sea level using shortrange device (ToF sensor)
     def find_floor_from_range(self, n_average=10, set_floor=False):
@@ -69,28 +77,46 @@ class ALTITUDE:
         return floor_altitude
 
     def get_altitude(self):
-        # start a read on lr rangefinder if available
-        if self.lr:
-            self.lr.start()
-        # read barometer
-        raw_altitude = self.barometer.altitude
+        t = trace.enter()
+        try:
+            # start a read on lr rangefinder if available
+            if self.lr:
+                self.lr.start()
+            # read barometer
+            raw_altitude = self.barometer.altitude
+            sr_distance = None
+            lr_distance = None
+            if self.sr:
+                # try reading short-range rangefinder
+                sr_distance = self.sr.read()
+            if self.lr and not (sr_distance and 0 < sr_distance < OUT_OF_RANGE):
+                # short-range rangefinder didn't work. try reading long-range rangefinder.
+                # By now, the sensor should have read the data into the UART buffer
+                try:
+                    lr_distance = self.lr.read_buffered()
+                except TypeError:
+                    lr_distance = None
+            return self.fuse(raw_altitude, sr_distance, lr_distance)
+        finally:
+            trace.exit('altitude.get_altitude', t)
+
+    # Combine readings taken elsewhere (e.g. by separate sensor tasks).
+    # raw_altitude is barometer altitude above sea level in meters,
+    # distances are tilt-compensated rangefinder readings in mm or None.
+    def fuse(self, raw_altitude, sr_distance=None, lr_distance=None):
         barometer_altitude_rel = raw_altitude - self.floor_altitude
-        if self.sr:
-            # try reading short-range rangefinder and convert mm to meters.
-            distance = self.sr.read() / 1000
-            if not 0 < distance < OUT_OF_RANGE:
-                distance = None
-        if self.lr and not distance:
-            # short-range rangefinder didn't work.
-            # try reading long-range rangefinder and convert mm to meters.
-            # By now, the sensor should have read the data into the UART buffer
-            try:
-                distance = self.lr.read_buffered() / 1000
-            except TypeError:
-                distance = None
-            else:
-                if not 0 < distance < OUT_OF_RANGE:
-                    distance = None
+        distance = None
+        source = SOURCE_BAROMETER
+        for reading, reading_source in ((sr_distance, SOURCE_SHORT_RANGE), (lr_distance, SOURCE_LONG_RANGE)):
+            if reading is None:
+                continue
+            # convert mm to meters
+            reading = reading / 1000
+            if 0 < reading < OUT_OF_RANGE:
+                distance = reading
+                source = reading_source
+                break
+        self.source = SOURCE_BAROMETER
         if not distance:
             # neither rangefinder got a valid reading. Gotta use barometer.
             return barometer_altitude_rel
@@ -102,6 +128,7 @@ class ALTITUDE:
         if deviation < self.barometer_drift:
             if deviation < self.calibration_drift:
                 self.floor_altitude = raw_altitude - distance
+            self.source = source
             return distance
         # else use barometer
         return barometer_altitude_rel
@@ -135,11 +162,9 @@ def main():
     from adxl345 import ADXL345
     from accelerometer import ACCELEROMETER
     from distance import HeightTiltCompensator
+    from i2cbus import get_bus
 
-    # I2C Object
-    if 'i2c' not in globals():
-        from machine import I2C, Pin
-        i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+    i2c = get_bus().client()
 
     adxl = ADXL345(i2c, 83)
     accelerometer = ACCELEROMETER(adxl, 'adxl345_calibration_2point')
@@ -1,161 +1,315 @@
 # TODO: implement temperature smoothing for thermal runaway protection
 from micropython import const
-import _thread
-from time import sleep
 import time
+import uasyncio as asyncio
 
-from statistics_tools import abs_fwd_timegraph, linreg_past
+import runtime
+import estop
+import config
+import devices
+import telemetry
+import log
+import trace
+import memmon
+import i2ctrace
+import ballonet_logic
+from ballonet_logic import PUMP_IN, PUMP_OUT
 
-from bmp388 import BMP388
-from VL53L0X import VL53L0X
-from maxsonar import XLMaxSonarUART
-from adxl345 import ADXL345
-from accelerometer import ACCELEROMETER
-from distance import HeightTiltCompensator
-from altitude import ALTITUDE
 import pump
 
-_ALTITUDE_SAMPLING_TIME_BUDGET = 200  # sampling period of barometer in ms
+# Sensors are brought up by prepare() on first use (see devices.py).
+# Any of them may be None if it didn't answer on the bus.
+barometer = None
+tof = None
+tof_fusion = None
+ultrasonic = None
+ultrasonic_fusion = None
+altitude = None
 
-# I2C Object
-if 'i2c' not in globals():
-    from machine import I2C, Pin
-    i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+_MAX_LIST_SIZE = const(120)
 
-adxl = ADXL345(i2c, 83)
-accelerometer = ACCELEROMETER(adxl, 'adxl345_calibration_2point')
-tof = VL53L0X(i2c, 41)
-tof_fusion = HeightTiltCompensator(accelerometer, tof)
-ultrasonic = XLMaxSonarUART()
-ultrasonic_fusion = HeightTiltCompensator(accelerometer, ultrasonic)
-barometer = BMP388(i2c)
+CFGFILE = "ballonet_controller.json"
+LEGACY_CFGFILE = "ballonet_controller_cfg"  # old text format, imported if there's no CFGFILE
 
-altitude = ALTITUDE(barometer, tof_fusion, ultrasonic_fusion)
-altitude.sr.offset = -40.0
+settings = config.CONFIG(CFGFILE, ballonet_logic.SETTINGS, version=1, legacy_path=LEGACY_CFGFILE)
+cfg = settings.values
 
-_MAX_LIST_SIZE = const(120)
 
-CFGFILE = "ballonet_controller_cfg"
+def loadcfg():
+    settings.load()
+    if altitude:
+        altitude.barometer_drift = cfg['barometer_drift']
+        altitude.calibration_drift = cfg['calibration_drift']
+
 
-cfg = {
-    'setpoint': 0,  # maintain this velocity
-    'bangbang_tolerance': 50,  # mm/s, activate pump above this speed
+def savecfg():
+    settings.save()
 
-    # when above ceiling height, decrease velocity setpoint
-    # it may be good to set this well under max range of LR rangefinder
-    # set to float('inf') to disable
-    'ceiling_height': 120,
 
-    # when below floor height, increase velocity setpoint
-    # set to float('-inf') to disable
-    'floor_height': 0,
+# Change settings, e.g. tune(bangbang_tolerance=80, barometer_drift=2).
+# Everything is validated first; one bad value raises ValueError and changes nothing.
+# While the controller runs the changes land together between two ticks,
+# otherwise right away. Use savecfg() to keep them.
+def tune(**changes):
+    settings.request(changes)
+    if not runtime.running('controller'):
+        settings.apply()
 
-    # noise scaling will widen the bangbang tolerance if noise is detected
-    'noise_scaling': False,
 
-    # see altitude.py file for info on these
-    'barometer_drift': 1,
-    'calibration_drift': 0.25
-}
+# tune() from text, e.g. "setpoint=20 bangbang_tolerance=80", for remote commands
+def command(text):
+    changes = dict()
+    for item in text.split():
+        name, value = item.split('=', 1)
+        changes[name] = config.parse_value(value)
+    tune(**changes)
 
 
-def loadcfg():
-    with open(CFGFILE, 'r') as f:
-        text = f.read().rstrip().split("\n")
-        for i in text:
-            key, value = i.split("\t")
-            cfg[key] = eval(value)
-    altitude.barometer_drift = cfg['barometer_drift']
-    altitude.calibration_drift = cfg['calibration_drift']
+def _setting_changed(name, value):
+    if altitude is None:
+        return
+    if name == 'barometer_drift':
+        altitude.barometer_drift = value
+    elif name == 'calibration_drift':
+        altitude.calibration_drift = value
 
 
-def savecfg():  # only dicts with string keys and stringable values are supported
-    # sadly pickle module not available in micropython yet :(
-    with open(CFGFILE, 'w') as f:
-        for key in cfg:
-            f.write("{key}\t{value}\n".format(key=key, value=str(cfg[key])))
+settings.listen(_setting_changed)
 
 
-def __loop(n_s, T):
-    global enable
-    global history
+# latest readings from the sensor tasks.
+# Each is (value, ticks_ms when read) or None if not read yet.
+readings = {'barometer': None, 'sr': None, 'lr': None}
+# latest controller output, for the logger task
+status = {'i': -1, 'time': 0, 'altitude': 0.0, 'velocity': 0, 'duty': 0, 'pump_faults': 0}
+
+_SENSOR_TASKS = ('barometer', 'tof', 'sonar')
+
+
+def _fresh(name, max_age):
+    reading = readings[name]
+    if reading is None or time.ticks_diff(time.ticks_ms(), reading[1]) > max_age:
+        return None
+    return reading[0]
+
+
+async def _barometer_task():
+    while True:
+        barometer.start_measurement()
+        await runtime.until(barometer.data_ready, 5)
+        readings['barometer'] = (barometer.read_measurement()[0], time.ticks_ms())
+
+
+async def _tof_task():
+    tof.start()  # continuous ranging
+    try:
+        while True:
+            await runtime.until(tof.data_ready, 5)
+            readings['sr'] = (tof_fusion.correct(tof.read_result()), time.ticks_ms())
+    finally:
+        tof.stop()
+
+
+async def _sonar_task():
+    while True:
+        ultrasonic.start()
+        try:
+            await runtime.until(ultrasonic.data_ready, 10, 500)
+        except OSError:
+            continue  # no reading this time, pulse again
+        try:
+            distance = ultrasonic_fusion.read_buffered()
+        except TypeError:
+            distance = None
+        readings['lr'] = (distance, time.ticks_ms())
+
+
+def altitude_from_readings(max_age):
+    raw_altitude = _fresh('barometer', max_age)
+    if raw_altitude is None:
+        return None
+    return altitude.fuse(raw_altitude, _fresh('sr', max_age), _fresh('lr', max_age))
+
+
+async def _controller_task(n_s, T):
     # Length of history to use for calculating velocity
-    history = {'altitude': [], 'velocity': [], 'time': []}
+    global history
+    history = ballonet_logic.new_history()
+    ticker = runtime.Ticker(300)
+    # wait for the first barometer reading
+    while altitude_from_readings(T) is None:
+        await asyncio.sleep_ms(20)
     previous_time = time.ticks_ms()
     for i in range(n_s + 1):
-        history['altitude'].append(altitude.meters)
+        meters = altitude_from_readings(T)
+        while meters is None:  # stale barometer: wait it out, estimate() can't use a None sample
+            await asyncio.sleep_ms(20)
+            meters = altitude_from_readings(T)
         now = time.ticks_ms()
-        history['time'].append(time.ticks_diff(now, previous_time))
-        previous_time = time.ticks_ms()
-        history['velocity'].append(0)
-        sleep(0.3)
+        ballonet_logic.prime(history, meters, time.ticks_diff(now, previous_time))
+        previous_time = now
+        await ticker.wait()
+    ticker = runtime.Ticker(T)
     i = 0
     while True:
-        if not enable:
-            pump.emergency_stop()
-            print("Stopping!")
-            _thread.exit()
-            return
-        setpoint = cfg['setpoint']
-        h = history['altitude']
-        t = history['time']
-        fix_push(h, 0.5 * altitude.meters + 0.5 * h[-1])
-        now = time.ticks_ms()
-        fix_push(t, time.ticks_diff(now, previous_time))
-        previous_time = time.ticks_ms()
-        velocity = linreg_past(abs_fwd_timegraph(t, len(t) - n_s),
-                               h,
-                               n_s)[0]
-        # convert velocity from weird units to mm/s
-        velocity = int(velocity * 1000 * 1000 / (sum(t[-n_s:]) / 1000))
-        fix_push(history['velocity'], velocity)
-
-        if h[-1] < cfg['floor_height']:
-            setpoint += 50
-        elif h[-1] > cfg['ceiling_height']:
-            setpoint -= 50
-        e = velocity - setpoint  # +e is the velocity above the setpoint
-        pwm_duty = 1
-        if abs(e) > cfg['bangbang_tolerance']:
-            if e > 0:  # velocity too upwards
-                pump.pump_in(pwm_duty)  # reduce buoyancy
-            elif e < 0:  # velocity too downwards
-                pump.pump_out(pwm_duty)  # increase buoyancy
-        else:
-            pump.stop()
-        print("{:3}| T: {:3d}, H: {:7.3f}, V: {:4d}".format(i, t[-1], h[-1], history['velocity'][-1]))
-        i += 1
-        sleep(T)
+        tick = trace.enter()
+        try:
+            memmon.tick_start()
+            i2ctrace.mark()
+            telemetry.poll(command)  # commands from the ground station
+            settings.apply()  # settings changes only land between ticks
+            m = memmon.enter()
+            meters = altitude_from_readings(T)
+            memmon.exit('altitude', m)
+            if meters is None:
+                log.warning("No fresh barometer reading!")
+                pump.stop()
+            else:
+                h = history['altitude']
+                t = history['time']
+                m = memmon.enter()
+                now = time.ticks_ms()
+                try:
+                    velocity = ballonet_logic.estimate(history, meters, time.ticks_diff(now, previous_time),
+                                                       n_s, _MAX_LIST_SIZE)
+                except MemoryError:
+                    pump.emergency_stop()
+                    raise
+                previous_time = now
+                memmon.exit('velocity', m)
+
+                direction, setpoint = ballonet_logic.decide(h[-1], velocity, cfg)
+                pwm_duty = 1
+                duty = direction * pwm_duty
+                m = memmon.enter()
+                if direction == PUMP_IN:
+                    pump.pump_in(pwm_duty)  # reduce buoyancy
+                elif direction == PUMP_OUT:
+                    pump.pump_out(pwm_duty)  # increase buoyancy
+                else:
+                    pump.stop()
+                memmon.exit('pump', m)
+                status['i'] = i
+                status['time'] = t[-1]
+                status['altitude'] = h[-1]
+                status['velocity'] = velocity
+                status['duty'] = duty
+                m = memmon.enter()
+                telemetry.publish(h[-1], velocity, setpoint, altitude.source, int(duty * 1023))
+                memmon.exit('telemetry', m)
+                i += 1
+            memmon.tick_end()
+        finally:
+            trace.exit('ballonet_controller.tick', tick)
+        memmon.idle(ticker.slack())  # collect garbage now rather than mid-tick
+        await ticker.wait()
+
+
+async def _logger_task(period_ms):
+    ticker = runtime.Ticker(period_ms)
+    i = -1
+    while True:
+        await ticker.wait()
+        if status['i'] == i:
+            continue
+        i = status['i']
+        log.info("{:3}| T: {:3d}, H: {:7.3f}, V: {:4d}", i, status['time'], status['altitude'], status['velocity'])
+
+
+def _stopped(name):
+    pump.emergency_stop()
+    log.warning("Stopping!")
+    for task in _SENSOR_TASKS + ('logger',):
+        runtime.cancel(task)
+
+
+# Bring up the altitude sensors, concurrently, if they aren't yet.
+# Returns the ALTITUDE, or None without a barometer.
+def prepare():
+    global barometer, tof, tof_fusion, ultrasonic, ultrasonic_fusion, altitude
+    if altitude is None:
+        devices.bring_up(('altitude',))
+        barometer = devices.get('barometer')
+        tof = devices.get('tof')
+        tof_fusion = devices.get('tof_fusion')
+        ultrasonic = devices.get('ultrasonic')
+        ultrasonic_fusion = devices.get('ultrasonic_fusion')
+        altitude = devices.get('altitude')
+        if altitude is None:
+            devices.report()
+            return None
+        altitude.barometer_drift = cfg['barometer_drift']
+        altitude.calibration_drift = cfg['calibration_drift']
+    return altitude
+
+
+# Start the tasks for the sensors that are present and not already sampling.
+# Returns the names of the tasks started.
+def start_sensors():
+    started = []
+    if prepare() is None:
+        return started
+    for name, device, task in (('barometer', barometer, _barometer_task),
+                               ('tof', tof_fusion, _tof_task),
+                               ('sonar', ultrasonic_fusion, _sonar_task)):
+        if device is not None and not runtime.running(name):
+            runtime.spawn(name, task)
+            started.append(name)
+    return started
 
 
 def calibrate(barometer_drift=1, calibration_drift=0.25):
+    if prepare() is None:
+        print("No barometer, can't calibrate.")
+        return
     altitude.find_floor_from_range(10, True)
 
 
-def start(n_s=5, T=1000):
-    global enable
-    global loop
-    enable = True
-    T_adjusted = T - _ALTITUDE_SAMPLING_TIME_BUDGET  # this is in ms
-    loop = _thread.start_new_thread(__loop, (n_s, T_adjusted / 1000))
+# T is the control period in ms. Sensors are sampled concurrently, so no time
+# has to be budgeted for them inside the period.
+def start(n_s=5, T=1000, log_period=1000):
+    if runtime.running('controller'):
+        print("Controller is already running.")
+        return
+    if estop.tripped():
+        print("Emergency stop is latched. Call estop.reset() first.")
+        return
+    if not start_sensors() and altitude is None:
+        print("No barometer, can't fly.")
+        return
+    if not telemetry.running():
+        try:
+            telemetry.start()
+        except OSError as e:
+            print("No telemetry: " + str(e))
+    log.start()
+    runtime.spawn('logger', _logger_task, log_period)
+    runtime.spawn('controller', _controller_task, n_s, T, on_exit=_stopped)
 
 
 def stop():
-    global enable
-    global loop
-    enable = False
+    runtime.cancel('controller')
 
 
-def setpoint(velocity):
-    global setpoint
-    setpoint = velocity
+# Cuts the pumps within microseconds, regardless of where the loop is.
+def emergency_stop():
+    estop.trigger()
 
 
-def fix_push(o, value, max_size=_MAX_LIST_SIZE):
-    if len(o) + 1 > max_size:
-        o.pop(0)
-    try:
-        o.append(value)
-    except MemoryError:
-        pump.emergency_stop()
-        raise
+def _estop(source):
+    runtime.cancel('controller')
+
+
+def _pump_fault(hbridge, active):
+    if active:
+        status['pump_faults'] += 1
+        telemetry.faults[0] = status['pump_faults']
+        log.error("Pump driver fault! Duty limits: {}", pump.fault_state())
+
+
+estop.register(_estop)
+pump.add_fault_listener(_pump_fault)
+
+
+def setpoint(velocity):
+    tune(setpoint=velocity)
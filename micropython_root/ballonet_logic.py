@@ -0,0 +1,104 @@
+"""
+The ballonet controller's decisions as plain functions of their inputs: no
+sensors, pumps, clocks or tasks. ballonet_controller calls them every tick
+with live readings; host/controller_replay.py calls the same code with
+logged ones, so a change here can be checked against past flights before
+it flies.
+
+The history is {'altitude': [...], 'time': [...], 'velocity': [...]}, oldest
+first and at most max_size long: the smoothed altitude in m, the ms since
+the previous sample and the velocity in mm/s.
+
+Usage (what one controller tick does):
+    velocity = ballonet_logic.estimate(history, meters, dt_ms, n_s, max_size)
+    direction, setpoint = ballonet_logic.decide(history['altitude'][-1], velocity, cfg)
+
+"""
+
+from statistics_tools import abs_fwd_timegraph, linreg_past
+
+INF = float('inf')
+
+# ballonet_controller's settings, for config.CONFIG
+SETTINGS = (
+    # (name, type, min, max, default)
+    ('setpoint', float, -1000.0, 1000.0, 0.0),  # maintain this velocity, mm/s
+    ('bangbang_tolerance', float, 0.0, 1000.0, 50.0),  # mm/s, activate pump above this speed
+
+    # when above ceiling height, decrease velocity setpoint
+    # it may be good to set this well under max range of LR rangefinder
+    # set to float('inf') to disable
+    ('ceiling_height', float, -INF, INF, 120.0),
+
+    # when below floor height, increase velocity setpoint
+    # set to float('-inf') to disable
+    ('floor_height', float, -INF, INF, 0.0),
+
+    # noise scaling will widen the bangbang tolerance if noise is detected
+    ('noise_scaling', bool, None, None, False),
+
+    # see altitude.py file for info on these
+    ('barometer_drift', float, 0.0, INF, 1.0),
+    ('calibration_drift', float, 0.0, INF, 0.25),
+)
+
+# pump directions from decide()
+PUMP_OUT = -1  # increase buoyancy
+IDLE = 0
+PUMP_IN = 1  # reduce buoyancy
+
+BOUNDARY_PUSH = 50  # mm/s added to the setpoint below the floor or above the ceiling
+
+
+def new_history():
+    return {'altitude': [], 'velocity': [], 'time': []}
+
+
+def push(o, value, max_size):
+    if len(o) + 1 > max_size:
+        o.pop(0)
+    o.append(value)
+
+
+# A warm-up sample, before there are enough for a velocity
+def prime(history, meters, dt_ms):
+    history['altitude'].append(meters)
+    history['time'].append(dt_ms)
+    history['velocity'].append(0)
+
+
+# Smooths the fused altitude `meters` into the history, dt_ms after the
+# previous sample, and returns the velocity in mm/s fitted to the last n_s.
+def estimate(history, meters, dt_ms, n_s, max_size):
+    h = history['altitude']
+    t = history['time']
+    push(h, 0.5 * meters + 0.5 * h[-1], max_size)
+    push(t, dt_ms, max_size)
+    velocity = linreg_past(abs_fwd_timegraph(t, len(t) - n_s),
+                           h,
+                           n_s)[0]
+    # convert velocity from weird units to mm/s
+    velocity = int(velocity * 1000 * 1000 / (sum(t[-n_s:]) / 1000))
+    push(history['velocity'], velocity, max_size)
+    return velocity
+
+
+# The velocity setpoint at a smoothed altitude in m, pushed back inside the floor and ceiling
+def adjusted_setpoint(altitude, cfg):
+    if altitude < cfg['floor_height']:
+        return cfg['setpoint'] + BOUNDARY_PUSH
+    if altitude > cfg['ceiling_height']:
+        return cfg['setpoint'] - BOUNDARY_PUSH
+    return cfg['setpoint']
+
+
+# The pump direction and the velocity setpoint it was chosen against, for a
+# smoothed altitude in m and a velocity in mm/s
+def decide(altitude, velocity, cfg):
+    setpoint = adjusted_setpoint(altitude, cfg)
+    e = velocity - setpoint  # +e is the velocity above the setpoint
+    if abs(e) > cfg['bangbang_tolerance']:
+        if e > 0:  # velocity too upwards
+            return PUMP_IN, setpoint
+        return PUMP_OUT, setpoint  # velocity too downwards
+    return IDLE, setpoint
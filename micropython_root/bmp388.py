@@ -11,6 +11,7 @@ Get altitude with this.altitude
 from time import sleep
 from micropython import const  # I don't think I need this
 from struct import unpack
+import trace
 
 # Create BMP388 ID and ADDRESS.
 # Note that the SDO pin can be changed, so the address can change during operation if desired.
@@ -54,52 +55,73 @@ class BMP388:
 
     # returns tuple of altitude(meters), pressure(pascals), temperature(C), temperature(F)
     def get_data(self):
+        t = trace.enter()
+        try:
+            self.start_measurement()
+
+            # Ensure data is ready to read
+            while not self.data_ready():
+                sleep(0.02)
+
+            return self.read_measurement()
+        finally:
+            trace.exit('bmp388.get_data', t)
+
+    # Split-phase measurement for callers that can't block:
+    # start_measurement(), poll data_ready(), then read_measurement().
+    def start_measurement(self):
         # Perform one measurement in forced mode
         self.i2c.writeto_mem(self.address, _REG_CONTROL, FORCE_MEASURE)
 
-        # Ensure data is ready to read
-        while unpack("B", self.i2c.readfrom_mem(self.address, _REG_STATUS, 1))[0] & 0x60 != 0x60:
-            sleep(0.02)
-
-        data = self.i2c.readfrom_mem(self.address, _REG_PRESSUREDATA, 6)
-
-        adc_p = data[2] << 16 | data[1] << 8 | data[0]
-        adc_t = data[5] << 16 | data[4] << 8 | data[3]
-
-        # Compensation calculations. temp = temperature
-        pd1 = adc_t - self.cal[0]
-        pd2 = pd1 * self.cal[1]
-        temp = pd2 + (pd1 * pd1) * self.cal[2]
-
-        # Calculate pressure (sec 9.3):
-        pd1 = self.cal[8] * temp
-        pd2 = self.cal[9] * temp ** 2.0
-        pd3 = self.cal[10] * temp ** 3.0
-        po1 = self.cal[7] + pd1 + pd2 + pd3
-
-        pd1 = self.cal[4] * temp
-        pd2 = self.cal[5] * temp ** 2.0
-        pd3 = self.cal[6] * temp ** 3.0
-        po2 = adc_p * (self.cal[3] + pd1 + pd2 + pd3)
-
-        pd1 = adc_p ** 2.0
-        pd2 = self.cal[11] + self.cal[12] * temp
-        pd3 = pd1 * pd2
-        po3 = pd3 + self.cal[13] * adc_p ** 3.0
-
-        pressure = po1 + po2 + po3
-
-        # Calculate altitude:
-        # see https://www.weather.gov/media/epz/wxcalc/pressureAltitude.pdf
-        # The BMP388 provides pressure in Pascals. The elevation formula requires mbar. The conversion is:
-        # 1 mbar = 100 Pa. Hence why we divide by 100 in the equation
-        altitude = (44307.7 * (1 - ((pressure / (100 * self.sea_level)) ** 0.190284)))
-        return (
-            altitude,
-            pressure,
-            temp,
-            temp * 9 / 5 + 32
-        )
+    def data_ready(self):
+        return unpack("B", self.i2c.readfrom_mem(self.address, _REG_STATUS, 1))[0] & 0x60 == 0x60
+
+    # same tuple as get_data(), from the last completed measurement
+    def read_measurement(self):
+        t = trace.enter()
+        try:
+            data = self.i2c.readfrom_mem(self.address, _REG_PRESSUREDATA, 6)
+
+            adc_p = data[2] << 16 | data[1] << 8 | data[0]
+            adc_t = data[5] << 16 | data[4] << 8 | data[3]
+
+            # Compensation calculations. temp = temperature
+            pd1 = adc_t - self.cal[0]
+            pd2 = pd1 * self.cal[1]
+            temp = pd2 + (pd1 * pd1) * self.cal[2]
+
+            # Calculate pressure (sec 9.3):
+            pd1 = self.cal[8] * temp
+            pd2 = self.cal[9] * temp ** 2.0
+            pd3 = self.cal[10] * temp ** 3.0
+            po1 = self.cal[7] + pd1 + pd2 + pd3
+
+            pd1 = self.cal[4] * temp
+            pd2 = self.cal[5] * temp ** 2.0
+            pd3 = self.cal[6] * temp ** 3.0
+            po2 = adc_p * (self.cal[3] + pd1 + pd2 + pd3)
+
+            pd1 = adc_p ** 2.0
+            pd2 = self.cal[11] + self.cal[12] * temp
+            pd3 = pd1 * pd2
+            po3 = pd3 + self.cal[13] * adc_p ** 3.0
+
+            pressure = po1 + po2 + po3
+
+            # Calculate altitude:
+            # see https://www.weather.gov/media/epz/wxcalc/pressureAltitude.pdf
+            # The BMP388 provides pressure in Pascals. The elevation formula requires mbar. The conversion is:
+            # 1 mbar = 100 Pa. Hence why we divide by 100 in the equation
+            altitude = (44307.7 * (1 - ((pressure / (100 * self.sea_level)) ** 0.190284)))
+            result = (
+                altitude,
+                pressure,
+                temp,
+                temp * 9 / 5 + 32
+            )
+            return result
+        finally:
+            trace.exit('bmp388.read_measurement', t)
 
     @property
     def altitude(self):  # return altitude in meters above sea level
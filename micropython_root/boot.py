@@ -1,13 +1,19 @@
 # This file is executed on every boot (including wake-boot from deepsleep)
 import gc
 from sys import modules
-from machine import Pin, I2C
+from time import ticks_ms, ticks_diff
 # import esp
 # esp.osdebug(none)
 # import webrepl
 # webrepl.start()
 
-i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+_boot_start = ticks_ms()
+
+import config
+from i2cbus import get_bus
+
+# The I2C peripheral is owned by i2cbus; this is a client for use from the REPL
+i2c = get_bus().client()
 
 
 # You can only import a file once
@@ -38,4 +44,23 @@ def start_ap():
     webrepl.start(password="ffff")
 
 
-start_ap()
+# To skip the access point on the next boot:
+#   boot_settings.set('start_ap', False); boot_settings.save()
+boot_settings = config.CONFIG("boot.json", (
+    # (name, type, min, max, default)
+    ('start_ap', bool, None, None, True),  # wireless REPL, costs boot time
+    ('bring_up_sensors', bool, None, None, False),  # build the altitude sensors at boot
+    ('i2c_trace', str, None, None, ''),  # record I2C to this file from boot, see i2ctrace
+))
+boot_settings.load()
+
+if boot_settings.values['start_ap']:
+    start_ap()
+if boot_settings.values['i2c_trace']:
+    import i2ctrace
+    print("boot: recording I2C to " + i2ctrace.record(boot_settings.values['i2c_trace']))
+if boot_settings.values['bring_up_sensors']:
+    import devices
+    devices.bring_up(('altitude',))
+    devices.report()
+print("boot: {} ms".format(ticks_diff(ticks_ms(), _boot_start)))
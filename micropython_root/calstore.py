@@ -0,0 +1,112 @@
+"""
+Binary store for calibration and lookup tables.
+
+Tables are kept as a few arrays in one small file:
+    header: magic b'CALS', format version, number of arrays, table version,
+            size and mtime of the text source it was compiled from (0 if none)
+    per array: typecode and length
+    the array data, back to back
+Loading is one read and a copy per array, with no text parsing.
+
+Tables with a text source (accelerometer calibration, thermistor tables)
+are compiled on first use and recompiled whenever the source's size or
+modification time changes. Without the source the compiled file is used as is.
+
+    arrays = calstore.cached("epcos100k.tsv", parse_function, version=1)
+
+where parse_function(source) returns the list of arrays. If the compiled
+file can't be written the parsed arrays are still returned.
+
+Tables without a text source (pump curves, the VL53L0X calibration cache)
+just use save() and load().
+
+"""
+
+import os
+import ustruct
+from array import array
+
+_MAGIC = b'CALS'
+_FORMAT = 1
+_HEADER = '<4sBBHII'  # magic, format, number of arrays, table version, source size, source mtime
+_HEADER_SIZE = ustruct.calcsize(_HEADER)
+_ENTRY = '<cI'  # typecode, length
+_ENTRY_SIZE = ustruct.calcsize(_ENTRY)
+
+
+def path_for(source):
+    return source + '.cal'
+
+
+# (size, mtime) of `source`, or (0, 0) if it doesn't exist
+def stamp(source):
+    if source is None:
+        return 0, 0
+    try:
+        st = os.stat(source)
+    except OSError:
+        return 0, 0
+    return st[6], int(st[8]) & 0xFFFFFFFF
+
+
+def save(path, arrays, source=None, version=0):
+    size, mtime = stamp(source)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(ustruct.pack(_HEADER, _MAGIC, _FORMAT, len(arrays), version, size, mtime))
+        for a in arrays:
+            f.write(ustruct.pack(_ENTRY, a.typecode.encode(), len(a)))
+        for a in arrays:
+            f.write(a)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # FAT can't rename over an existing file
+        os.remove(path)
+        os.rename(tmp, path)
+
+
+# Returns the list of arrays, or None if the file is missing, damaged,
+# of another table version, or older than `source`.
+def load(path, source=None, version=0):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < _HEADER_SIZE:
+        return None
+    magic, fmt, count, file_version, size, mtime = ustruct.unpack_from(_HEADER, data)
+    if magic != _MAGIC or fmt != _FORMAT or file_version != version:
+        return None
+    if source is not None:
+        current = stamp(source)
+        # a missing source is fine, the compiled table can be shipped on its own
+        if current != (0, 0) and current != (size, mtime):
+            return None
+    offset = _HEADER_SIZE + count * _ENTRY_SIZE
+    arrays = []
+    for i in range(count):
+        typecode, length = ustruct.unpack_from(_ENTRY, data, _HEADER_SIZE + i * _ENTRY_SIZE)
+        typecode = typecode.decode()
+        nbytes = length * ustruct.calcsize(typecode)
+        if offset + nbytes > len(data):
+            return None
+        arrays.append(array(typecode, data[offset:offset + nbytes]))
+        offset += nbytes
+    if offset != len(data):
+        return None
+    return arrays
+
+
+# Compiled arrays for text `source`, parsing it with parse(source) only when needed
+def cached(source, parse, version=0):
+    path = path_for(source)
+    arrays = load(path, source, version)
+    if arrays is None:
+        arrays = parse(source)
+        try:
+            save(path, arrays, source, version)
+        except OSError as e:
+            print("calstore: can't write " + path + ": " + str(e))
+    return arrays
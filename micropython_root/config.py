@@ -0,0 +1,267 @@
+"""
+Typed, versioned settings stored as JSON on flash.
+
+A CONFIG is built from a schema, a tuple of entries
+    (name, type, minimum, maximum, default)
+where type is float, int, bool or str and the bounds are None when not
+checked (bounds only apply to numbers). The values live in the `values`
+dict, which modules use directly as their `cfg`.
+
+The file holds {"version": n, "values": {...}}. Infinities are stored as the
+strings "inf" and "-inf", since JSON has no way to write them. Saving writes
+a temporary file and renames it over the old one, so a reset in the middle
+of a save leaves either the old or the new file, never half of one.
+
+Files written by an older schema are upgraded on load by `migrations`,
+{old version: fn(values) -> values}, applied in order. Version 0 is the old
+tab-separated text format (`key<TAB>value` per line), which is still
+readable and writable with import_legacy() and export_legacy() for
+external tools. Values in it are parsed without eval().
+
+Loading never fails: a missing or broken file, unknown names and invalid
+values fall back to the defaults with a message.
+
+Changes while something is running:
+  - listen(fn): fn(name, value) is called for every value that changes,
+    whether through set(), apply() or load().
+  - request(changes) validates a dict of changes (all or nothing) and queues
+    it. A control loop calls apply() between ticks, so every change in one
+    request lands at once and never in the middle of a tick.
+
+Usage:
+    import config
+    settings = config.CONFIG("thing.json", (
+        ('gain', float, 0, 10, 1.0),
+        ('enabled', bool, None, None, True),
+    ))
+    settings.load()
+    settings.set('gain', 2.5)  # raises ValueError if invalid
+    settings.save()
+    settings.listen(on_change)
+    settings.request({'gain': 3.0, 'enabled': False})
+    settings.apply()  # in the control loop, between ticks
+
+"""
+
+import os
+import _thread
+import ujson as json
+
+_INF = float('inf')
+
+
+# Parse a value from the legacy text format
+def parse_value(text):
+    text = text.strip()
+    if text in ('True', 'False'):
+        return text == 'True'
+    if text in ('None', ''):
+        return None
+    for form in ("float('inf')", 'float("inf")', 'inf'):
+        if text == form:
+            return _INF
+        if text == '-' + form:
+            return -_INF
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+
+def _encode(value):
+    if type(value) is float and (value == _INF or value == -_INF):
+        return 'inf' if value > 0 else '-inf'
+    return value
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+class CONFIG:
+    def __init__(self, path, schema, version=1, migrations=None, legacy_path=None):
+        self.path = path
+        self.schema = dict()
+        self.order = []
+        for entry in schema:
+            self.schema[entry[0]] = entry
+            self.order.append(entry[0])
+        self.version = version
+        self.migrations = migrations if migrations else dict()
+        self.legacy_path = legacy_path  # read on load() if there's no JSON file yet
+        self.values = dict()
+        self.pending = dict()  # validated changes waiting for apply()
+        self.listeners = []
+        self._lock = _thread.allocate_lock()
+        self.defaults()
+
+    def defaults(self):
+        for name in self.order:
+            self.values[name] = self.schema[name][4]
+
+    # Returns value converted to the schema type, or raises ValueError
+    def validate(self, name, value):
+        if name not in self.schema:
+            raise ValueError("unknown setting: " + str(name))
+        name, kind, minimum, maximum, default = self.schema[name]
+        if kind is float and value in ('inf', '-inf'):
+            value = _INF if value == 'inf' else -_INF
+        if kind is bool:
+            if value not in (True, False, 0, 1):
+                raise ValueError(name + " must be True or False")
+            return bool(value)
+        if kind is float and type(value) in (int, float) and type(value) is not bool:
+            value = float(value)
+        elif kind is int and type(value) is float and value == int(value):
+            value = int(value)
+        if type(value) is not kind:
+            raise ValueError("{} must be {}, not {}".format(name, kind.__name__, type(value).__name__))
+        if minimum is not None and value < minimum:
+            raise ValueError("{} must be at least {}".format(name, minimum))
+        if maximum is not None and value > maximum:
+            raise ValueError("{} must be at most {}".format(name, maximum))
+        return value
+
+    def set(self, name, value):
+        self._store(name, self.validate(name, value))
+
+    def _store(self, name, value):
+        if self.values.get(name) != value:
+            self.values[name] = value
+            self._notify(name, value)
+
+    def _notify(self, name, value):
+        for fn in self.listeners:
+            fn(name, value)
+
+    def listen(self, fn):
+        if fn not in self.listeners:
+            self.listeners.append(fn)
+
+    # Validate all of `changes` ({name: value}) and queue them for apply().
+    # Raises ValueError and queues nothing if any of them is invalid.
+    def request(self, changes):
+        checked = dict()
+        for name in changes:
+            checked[name] = self.validate(name, changes[name])
+        with self._lock:
+            self.pending.update(checked)
+
+    # Apply queued changes together, then notify listeners.
+    # Returns the number of changed values; cheap when nothing is queued.
+    def apply(self):
+        if not self.pending:
+            return 0
+        with self._lock:
+            pending = self.pending
+            self.pending = dict()
+        changed = []
+        for name in pending:
+            if self.values[name] != pending[name]:
+                self.values[name] = pending[name]
+                changed.append(name)
+        for name in changed:
+            self._notify(name, self.values[name])
+        return len(changed)
+
+    # Copy the valid entries of `values` in, warn about the rest
+    def _apply(self, values, source):
+        for name in values:
+            try:
+                self.values[name] = self.validate(name, values[name])
+            except ValueError as e:
+                print(source + ": " + str(e) + ", keeping " + str(self.values.get(name)))
+
+    def _notify_changes(self, before):
+        for name in self.order:
+            if self.values[name] != before.get(name):
+                self._notify(name, self.values[name])
+
+    def _migrate(self, version, values):
+        while version < self.version:
+            migration = self.migrations.get(version)
+            if migration:
+                values = migration(values)
+            version += 1
+        return values
+
+    def load(self):
+        before = dict(self.values)
+        self._load()
+        self._notify_changes(before)
+        return self.values
+
+    def _load(self):
+        self.defaults()
+        path = self.path
+        if not _exists(path) and _exists(path + '.tmp'):
+            path = path + '.tmp'  # reset between removing the old file and renaming
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            version = data['version']
+            values = data['values']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if self.legacy_path and _exists(self.legacy_path):
+                self._import_legacy(self.legacy_path)
+                self.save()
+                return
+            if _exists(path):
+                print(path + " is unreadable (" + str(e) + "), using defaults")
+            return
+        if version > self.version:
+            print("{} is from a newer version ({}), loading what is understood".format(path, version))
+        self._apply(self._migrate(version, values), path)
+        if version < self.version:
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        values = dict()
+        for name in self.order:
+            values[name] = _encode(self.values[name])
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'values': values}, f)
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # FAT can't rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    # Read the old `key<TAB>value` text format. It has no version, so it's version 0
+    def import_legacy(self, path):
+        before = dict(self.values)
+        self._import_legacy(path)
+        self._notify_changes(before)
+        return self.values
+
+    def _import_legacy(self, path):
+        values = dict()
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or '\t' not in line:
+                    continue
+                key, value = line.split('\t', 1)
+                values[key] = parse_value(value)
+        self._apply(self._migrate(0, values), path)
+
+    def export_legacy(self, path):
+        with open(path, 'w') as f:
+            for name in self.order:
+                value = self.values[name]
+                if type(value) is float and (value == _INF or value == -_INF):
+                    value = "float('inf')" if value > 0 else "-float('inf')"
+                f.write("{}\t{}\n".format(name, value))
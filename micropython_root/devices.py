@@ -0,0 +1,213 @@
+"""
+Lazy device registry for the sensors on the board.
+
+Nothing is constructed on import. The I2C bus is scanned once, and each
+device is built the first time something asks for it with get(). Devices
+whose I2C address didn't answer the scan, or whose driver raised during
+setup, are None instead of stopping everything else; dependents of a
+missing device are None too.
+
+bring_up(names) builds several devices at once, each independent one in
+its own thread, so waits inside driver setup (VL53L0X calibration, UART
+settling) overlap. Devices that depend on others start once those are up.
+
+Time spent on each device, including importing its driver module, is kept
+in `profile`; see report().
+
+Devices are registered with
+    register(name, factory, address=None, needs=(), optional=())
+where factory(*needs, *optional) returns the device object. Missing
+optional devices are passed as None.
+The board's sensors are registered below.
+
+Usage:
+    import devices
+    devices.bring_up(('altitude',))
+    altitude = devices.get('altitude')
+    devices.report()
+
+"""
+
+import _thread
+from time import ticks_ms, ticks_diff, sleep_ms
+import i2cbus
+
+_STACK_SIZE = 8192  # for bring-up threads, driver setup can nest deep
+
+_registry = dict()  # name: (factory, address, needs, optional, module)
+_devices = dict()  # name: device object or None once brought up
+profile = dict()  # name: (state, ms)
+_scan = {'addresses': None, 'ms': 0}
+_lock = _thread.allocate_lock()
+_import_lock = _thread.allocate_lock()  # two threads mustn't import the same module
+
+
+# module: driver module the factory imports, imported first under a lock
+def register(name, factory, address=None, needs=(), optional=(), module=None):
+    _registry[name] = (factory, address, needs, optional, module)
+
+
+def _dependencies(name):
+    entry = _registry[name]
+    return entry[2] + entry[3]
+
+
+def scan():
+    if _scan['addresses'] is None:
+        start = ticks_ms()
+        _scan['addresses'] = set(i2cbus.get_bus().client().scan())
+        _scan['ms'] = ticks_diff(ticks_ms(), start)
+    return _scan['addresses']
+
+
+def present(name):
+    address = _registry[name][1]
+    return address is None or address in scan()
+
+
+def _build(name):
+    factory, address, needs, optional, module = _registry[name]
+    start = ticks_ms()
+    device = None
+    if not present(name):
+        state = 'missing'
+    elif any(_devices.get(need) is None for need in needs):
+        state = 'needs ' + ', '.join(need for need in needs if _devices.get(need) is None)
+    else:
+        try:
+            if module:
+                with _import_lock:
+                    __import__(module)
+            device = factory(*[_devices.get(need) for need in needs + optional])
+            state = 'ok'
+        except Exception as e:
+            state = 'failed: ' + str(e)
+    with _lock:
+        _devices[name] = device
+        profile[name] = (state, ticks_diff(ticks_ms(), start))
+    return device
+
+
+def get(name):
+    if name not in _devices:
+        for need in _dependencies(name):
+            get(need)
+        _build(name)
+    return _devices[name]
+
+
+def _worker(name, done):
+    try:
+        _build(name)
+    finally:
+        with _lock:
+            done.append(name)
+
+
+# Build `names` and everything they need, independent devices concurrently.
+# Returns the total time in ms.
+def bring_up(names):
+    start = ticks_ms()
+    wanted = []
+
+    def want(name):
+        if name in wanted:
+            return
+        for need in _dependencies(name):
+            want(need)
+        wanted.append(name)
+
+    for name in names:
+        want(name)
+    scan()
+    stack_size = _thread.stack_size(_STACK_SIZE)
+    done = []
+    started = []
+    while len(started) < len(wanted) or len(done) < len(started):
+        for name in wanted:
+            if name in started:
+                continue
+            if name in _devices:
+                started.append(name)
+                done.append(name)
+                continue
+            if all(need in done for need in _dependencies(name)):
+                started.append(name)
+                _thread.start_new_thread(_worker, (name, done))
+        sleep_ms(1)
+    _thread.stack_size(stack_size)
+    return ticks_diff(ticks_ms(), start)
+
+
+# Forget a device so the next get() builds it again
+def forget(name):
+    _devices.pop(name, None)
+    profile.pop(name, None)
+
+
+def report():
+    print("I2C scan: {} ms, found {}".format(
+        _scan['ms'], ', '.join(hex(a) for a in sorted(_scan['addresses'] or ()))))
+    for name in _registry:
+        if name in profile:
+            state, ms = profile[name]
+            print("  {:18} {:6d} ms  {}".format(name, ms, state))
+        else:
+            print("  {:18}           not used".format(name))
+
+
+# Board sensors. Drivers are imported inside the factories so modules that
+# are never used are never imported.
+
+def _i2c():
+    # altitude sensors are control-critical, so they get priority on the shared bus
+    return i2cbus.get_bus().client(i2cbus.CONTROL)
+
+
+def _adxl():
+    from adxl345 import ADXL345
+    return ADXL345(_i2c(), 83)
+
+
+def _accelerometer(adxl):
+    from accelerometer import ACCELEROMETER
+    return ACCELEROMETER(adxl, 'adxl345_calibration_2point')
+
+
+def _tof():
+    from VL53L0X import VL53L0X
+    return VL53L0X(_i2c(), 41)
+
+
+def _ultrasonic():
+    from maxsonar import XLMaxSonarUART
+    return XLMaxSonarUART()
+
+
+def _fusion(accelerometer, rangefinder):
+    from distance import HeightTiltCompensator
+    return HeightTiltCompensator(accelerometer, rangefinder)
+
+
+def _barometer():
+    from bmp388 import BMP388
+    return BMP388(_i2c())
+
+
+def _altitude(barometer, tof_fusion, ultrasonic_fusion):
+    from altitude import ALTITUDE
+    altitude = ALTITUDE(barometer, tof_fusion, ultrasonic_fusion)
+    if altitude.sr:
+        altitude.sr.offset = -40.0
+    return altitude
+
+
+register('adxl', _adxl, 83, module='adxl345')
+register('accelerometer', _accelerometer, needs=('adxl',), module='accelerometer')
+register('tof', _tof, 41, module='VL53L0X')
+register('ultrasonic', _ultrasonic, module='maxsonar')
+register('tof_fusion', _fusion, needs=('accelerometer', 'tof'), module='distance')
+register('ultrasonic_fusion', _fusion, needs=('accelerometer', 'ultrasonic'), module='distance')
+register('barometer', _barometer, 0x77, module='bmp388')
+register('altitude', _altitude, needs=('barometer',), optional=('tof_fusion', 'ultrasonic_fusion'),
+         module='altitude')
@@ -10,6 +10,7 @@ Height tilt-correction for distance sensors using ADXL345 accelerometer
 
 from time import sleep
 import math
+import trace
 
 OUT_OF_RANGE = float('inf')
 INVALID = float('-inf')
@@ -33,11 +34,13 @@ class HeightTiltCompensator:
             raise NotImplementedError("Object used for ranging_device has no DEVICE_TYPE.")
         if self.type == 'VL53L0X_ada':
             self.read = self.read_VL53L0X_ada
+            self.correct = self.correct_VL53L0X
             self.MAX_RANGE = 1200
             self.MIN_RANGE = 5
             self.CONE_ADJUST = 0.5
         elif self.type == 'VL53L0X_polulu':
             self.read = self.read_VL53L0X_polulu
+            self.correct = self.correct_VL53L0X
             self.MAX_RANGE = 2000
             self.MIN_RANGE = 5
             self.CONE_ADJUST = 0.5
@@ -48,21 +51,34 @@ class HeightTiltCompensator:
             self.read = self.read_XLMAXSONAR
             self.start = self.start_XLMAXSONAR
             self.read_buffered = self.read_buffered_XLMAXSONAR
+            self.correct = self.correct_XLMAXSONAR
             self.MAX_RANGE = 7500
             self.MIN_RANGE = 200
             self.CONE_ADJUST = 0.8
 
     # this will be used if device is UART maxsonar type
     def read_XLMAXSONAR(self):
-        self.start_XLMAXSONAR()
-        sleep(0.1)
-        return self.read_buffered_XLMAXSONAR()
+        t = trace.enter()
+        try:
+            self.start_XLMAXSONAR()
+            sleep(0.1)
+            return self.read_buffered_XLMAXSONAR()
+        finally:
+            trace.exit('distance.read_XLMAXSONAR', t)
 
     def start_XLMAXSONAR(self):
         self.rangefinder.start()
 
     def read_buffered_XLMAXSONAR(self):
-        raw_distance = self.rangefinder.read()
+        t = trace.enter()
+        try:
+            return self.correct_XLMAXSONAR(self.rangefinder.read())
+        finally:
+            trace.exit('distance.read_buffered_XLMAXSONAR', t)
+
+    # correct_* apply offset and tilt compensation to a raw reading taken elsewhere,
+    # e.g. by a task polling the device. They return mm like read().
+    def correct_XLMAXSONAR(self, raw_distance):
         if raw_distance > 763:
             return OUT_OF_RANGE
         ranged_distance = max(raw_distance + self.offset / 10, 1)
@@ -70,25 +86,31 @@ class HeightTiltCompensator:
 
     # this will be used if device is serial maxsonar type
     def read_VL53L0X_ada(self):
-        raw_distance = self.rangefinder.range
-        if raw_distance > 8100:  # VL53L0X typically reads 8192 when out of range (too far)
-            return OUT_OF_RANGE
-        # calibration offset for TOF sensor
-        ranged_distance = max(raw_distance + self.offset, 1)
-        return self.tilt_compensation(ranged_distance)
+        t = trace.enter()
+        try:
+            return self.correct_VL53L0X(self.rangefinder.range)
+        finally:
+            trace.exit('distance.read_VL53L0X_ada', t)
 
     # this will be used if rangfinder is VL53L0X (polulu driver).
     def read_VL53L0X_polulu(self):
-        self.rangefinder.start()
-        # driver timings are broken in long-range, so need to call read() twice
-        self.rangefinder.read()
-        raw_distance = self.rangefinder.read()
-        self.rangefinder.stop()
+        t = trace.enter()
+        try:
+            self.rangefinder.start()
+            # driver timings are broken in long-range, so need to call read() twice
+            self.rangefinder.read()
+            raw_distance = self.rangefinder.read()
+            self.rangefinder.stop()
+            return self.correct_VL53L0X(raw_distance)
+        finally:
+            trace.exit('distance.read_VL53L0X_polulu', t)
+
+    def correct_VL53L0X(self, raw_distance):
         if raw_distance > 8100:  # VL53L0X typically reads 8192 when out of range (too far)
             return OUT_OF_RANGE
         # calibration offset for TOF sensor
         ranged_distance = max(raw_distance + self.offset, 1)
-        return self.tilt_compensation(ranged_distance)    # this will be used if rangfinder is VL53L0X (polulu driver).
+        return self.tilt_compensation(ranged_distance)
 
     def get_angle_vertical(self):
         v = self.accelerometer.getAxes()
@@ -97,7 +119,11 @@ class HeightTiltCompensator:
         return math.acos(dot_product / v_magnitude)
 
     def tilt_compensation(self, distance):
-        theta = self.get_angle_vertical()
+        t = trace.enter()
+        try:
+            theta = self.get_angle_vertical()
+        finally:
+            trace.exit('distance.get_angle_vertical', t)
         # return invalid if we're not pointing mostly straight down
         if not 0.0 < theta < self.max_angle:
             return INVALID
@@ -111,11 +137,11 @@ class HeightTiltCompensator:
 def main():
     global read  # make function global
     global this
-    from machine import Pin, I2C
     import adxl345
     import VL53L0X
     import accelerometer
-    i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+    from i2cbus import get_bus
+    i2c = get_bus().client()
     adxl = adxl345.ADXL345(i2c, 83)
     a = accelerometer.ACCELEROMETER(adxl, 'adxl345_calibration_2point')
     tof = VL53L0X.VL53L0X(i2c, 41)
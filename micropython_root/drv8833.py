@@ -1,8 +1,22 @@
+import micropython
+from array import array
 from machine import Pin, PWM
+from micropython import const
+from time import ticks_ms, ticks_diff
+
+_FAULT_LOG_SIZE = const(16)
+_FULL = const(1023)  # PWM duty for a pin held high
 
 
 # this class controls an individual channel (A or B) on the drv8833
 # It is meant to be used as an internal class for the full driver
+#
+# Both input pins get a PWM channel for the life of the bank. Direction only
+# decides which pin carries the duty cycle and whether the other one is held
+# high (brake) or low (coast), so changing direction is just duty writes.
+# Every write goes through a shadow copy of what the hardware has, and
+# unchanged outputs are skipped. Setting an integer duty with set_duty_int()
+# doesn't allocate.
 class MOTOR_BANK:
     def __init__(self, pwm_frequency, in1_pin, in2_pin, duty_callback=None):
         self._pwm_frequency = pwm_frequency
@@ -12,35 +26,71 @@ class MOTOR_BANK:
             # init both output pins as GPIO
             pin.init(Pin.OUT, value=0)
         # PWM object takes precedence over GPIO output of that pin
-        self.out = [self.pins[0], PWM(self.pins[1], freq=pwm_frequency, duty=0)]
+        self.out = (PWM(self.pins[0], freq=pwm_frequency, duty=0),
+                    PWM(self.pins[1], freq=pwm_frequency, duty=0))
+        self._written = array('H', [0, 0])  # duty last written to each pin
+        # duty cycle on in2, in1 low, as the driver always started up
         self._direction = "Forward"
-        self._duty = 0
-        self._duty_int = 0
-        self.duty_callback = duty_callback  # called when duty is changed
+        self._pwm = 1  # index of the pin carrying the duty cycle
+        self._hold = 0  # duty of the other pin, 0 or _FULL
+        self._command = 0  # commanded duty, 0 to 1023
+        self._duty_int = 0  # duty on the output after duty_limit
+        self.running = False
+        # duty_callback(running) is called when the bank starts or stops.
         # used for setting sleep when all motors off.
+        self.duty_callback = duty_callback if duty_callback else _ignore
+        # Commanded duty is scaled down to duty_limit after driver faults,
+        # see DRV8833 fault monitoring
+        self.duty_limit = 1.0
+        self.limit_ticks = 0
+        self.recovery_ms = 2000
 
     @property
     def duty(self):
-        return self._duty
+        # the setter stores full duty as _FULL, so read that back as 1, not 1023/1024
+        return 1.0 if self._command == _FULL else self._command / 1024
 
     @duty.setter
     def duty(self, duty):
-        # changes internal duty cycle and updates PWM output
-        self._duty = duty
-        self._duty_int = min(1023, max(0, int(duty * 1024)))
-        # change duty cycle while preserving direction
-        if type(self.out[0]) is PWM:
-            self.out[0].duty(self._duty_int)
-        elif type(self.out[1]) is PWM:
-            self.out[1].duty(self._duty_int)
+        # duty cycle from 0 to 1
+        self.set_duty_int(min(_FULL, max(0, int(duty * 1024))))
 
-        try:
-            self.duty_callback()
-        except TypeError as e:
-            if e == "'NoneType object isn't callable":
-                pass
-            else:
-                raise e
+    def set_duty_int(self, value):
+        # duty cycle from 0 to 1023. Only allocates while duty is limited after a fault
+        self._command = value
+        if self.duty_limit < 1.0:
+            self._recover()
+            value = int(value * self.duty_limit)
+        self._duty_int = value
+        self._write(self._pwm, value)
+        self._write(1 - self._pwm, self._hold)
+        running = value != 0
+        if running != self.running:
+            self.running = running
+            self.duty_callback(running)
+
+    def _write(self, index, value):
+        if self._written[index] != value:
+            self.out[index].duty(value)
+            self._written[index] = value
+
+    # Double the duty limit for every recovery_ms without a fault
+    def _recover(self):
+        now = ticks_ms()
+        if ticks_diff(now, self.limit_ticks) > self.recovery_ms:
+            self.duty_limit = min(1.0, self.duty_limit * 2)
+            self.limit_ticks = now
+
+    # Drive both pins low, writing the hardware even if the shadow state says it's off
+    def off(self):
+        for i in range(2):
+            self.out[i].duty(0)
+            self._written[i] = 0
+        self._command = 0
+        self._duty_int = 0
+        if self.running:
+            self.running = False
+            self.duty_callback(False)
 
     @property
     def direction(self):
@@ -51,25 +101,18 @@ class MOTOR_BANK:
         # logic to set pin config based on direction
         # See DRV8833 datasheet for more info
         if direction in ("Forward", "Forward Coast", "Reverse Brake"):
-            if type(self.out[1]) is PWM:
-                self.out[1].deinit()
-            self.out[0] = PWM(self.pins[0], freq=self._pwm_frequency, duty=self._duty_int)
-            self.out[1] = self.pins[1]
-            if "Forward" in direction:
-                self.out[1].off()
-            elif "Reverse" in direction:
-                self.out[1].on()
+            pwm = 0
         elif direction in ("Reverse", "Reverse Coast", "Forward Brake"):
-            if type(self.out[0]) is PWM:
-                self.out[0].deinit()
-            self.out[0] = self.pins[0]
-            self.out[1] = PWM(self.pins[1], freq=self._pwm_frequency, duty=self._duty_int)
-            if "Forward" in direction:
-                self.out[0].on()
-            elif "Reverse" in direction:
-                self.out[0].off()
+            pwm = 1
         else:
             raise Exception(str(direction) + " was not a valid direction.")
+        self._direction = direction
+        self._pwm = pwm
+        self._hold = _FULL if "Brake" in direction else 0
+        # duty pin first: on a switch both pins briefly carry the duty cycle,
+        # which brakes, instead of the held pin briefly driving the motor
+        self._write(pwm, self._duty_int)
+        self._write(1 - pwm, self._hold)
 
     @property
     def pwm_frequency(self):
@@ -79,21 +122,37 @@ class MOTOR_BANK:
     def pwm_frequency(self, frequency):
         # changes internal pwm_frequency and updates PWM output
         self._pwm_frequency = frequency
-        if type(self.out[0]) is PWM:
-            self.out[0].freq(self._pwm_frequency)
-        elif type(self.out[1]) is PWM:
-            self.out[1].freq(self._pwm_frequency)
+        for pwm in self.out:
+            pwm.freq(self._pwm_frequency)
+
+
+def _ignore(running):
+    pass
 
 
+# Fault monitoring:
+# nFAULT is driven low on overcurrent or overtemperature and released when the
+# fault clears. Both edges are caught by a hard interrupt, which timestamps them
+# into a ring log (fault_log_ticks / fault_log_info) and counts them.
+# The motor banks that were running when the fault started get their duty_limit
+# cut by `fault_backoff`; the limit doubles back every `recovery_ms` without a
+# new fault, checked whenever duty is written.
+# To be told about faults instead of polling `faulted`:
+#   fault_listeners.append(fn)  # fn(hbridge, active) runs scheduled, outside the IRQ
+#   on_fault_irq = fn  # fn(hbridge) runs inside the hard IRQ when a fault starts.
+#                      # It must not allocate.
 class DRV8833:
     def __init__(self, pwm_frequency, sleep_pin, fault_pin, in1_pin, in2_pin, in3_pin, in4_pin):
         # this class controls stuff between banks.
         self.sleep = sleep_pin  # Active LOW (DRV8833 enabled when HIGH)
         self.sleep.init(mode=Pin.OUT, value=0)
-        self.fault = fault_pin  # NOT IMPLEMENTED but can read with this.fault.value
-        self.fault.init(mode=Pin.IN)
+        self.fault = fault_pin  # nFAULT, open drain, active LOW
+        self.fault.init(mode=Pin.IN, pull=Pin.PULL_UP)
 
         self.sleep.off()
+        self._awake = 0  # what the SLEEP pin is set to
+        self._running = 0  # motor banks with non-zero duty
+        self.halted = False  # set by halt(), keeps the driver asleep until reset()
 
         self.motor = dict()
         if in1_pin and in2_pin:
@@ -101,27 +160,99 @@ class DRV8833:
         if in3_pin and in4_pin:
             self.motor['B'] = MOTOR_BANK(pwm_frequency, in3_pin, in4_pin, self.duty_callback)
 
+        self.faulted = False
+        self.fault_count = 0
+        self.fault_backoff = 0.5
+        self.fault_listeners = []
+        self.on_fault_irq = None
+        # ring log of fault edges: ticks_ms, and info bits
+        # bit 0: fault active (falling edge), bit 1: motor A running, bit 2: motor B running
+        self.fault_log_ticks = array('i', [0] * _FAULT_LOG_SIZE)
+        self.fault_log_info = bytearray(_FAULT_LOG_SIZE)
+        self.fault_log_count = 0
+        self._fault_scheduled = self._fault_handled  # bound once, the IRQ can't allocate
+        self.fault.irq(handler=self._fault_irq, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
+
     def emergency_stop(self):
-        # Attempts to shut off all pins in all defined motor channels.
-        # May require re-init to use motors afterwards.
+        # Shuts off all pins in all defined motor channels.
         for motor in self.motor.values():
-            for io in motor.out:
-                if type(io) is PWM:
-                    io.deinit()
-                if type(io) is Pin:
-                    io.off()
-            for io in motor.pins:
-                if type(io) is Pin:
-                    io.init(Pin.OUT, value=0)
+            motor.off()
+        self.sleep.value(0)
+        self._awake = 0
         print("Emergency Stop called.")
 
-    def duty_callback(self):
-        # set SLEEP pin HIGH if all motors off, else LOW
-        all_off = True
+    # Puts the driver to sleep, which disables all outputs immediately.
+    # Safe to call from a hard interrupt: no allocation, one pin write.
+    def halt(self):
+        self.halted = True
+        self.sleep.value(0)
+        self._awake = 0
+
+    # Undo halt() and emergency_stop(). Motors come back stopped.
+    def reset(self):
         for motor in self.motor.values():
-            if motor.duty is not 0:
-                all_off = False
-        self.sleep.value(int(not all_off))
+            motor.off()
+        self._running = 0
+        self.halted = False
+        self._update_sleep()
+
+    def _fault_irq(self, pin):
+        active = not pin.value()
+        info = int(active)
+        if 'A' in self.motor and self.motor['A']._duty_int:
+            info |= 0b010
+        if 'B' in self.motor and self.motor['B']._duty_int:
+            info |= 0b100
+        slot = self.fault_log_count % _FAULT_LOG_SIZE
+        self.fault_log_ticks[slot] = ticks_ms()
+        self.fault_log_info[slot] = info
+        self.fault_log_count += 1
+        if active:
+            self.fault_count += 1
+        self.faulted = active
+        if active and self.on_fault_irq is not None:
+            self.on_fault_irq(self)
+        try:
+            micropython.schedule(self._fault_scheduled, slot)
+        except RuntimeError:
+            pass  # queue full, the log still has it
+
+    def _fault_handled(self, slot):
+        info = self.fault_log_info[slot]
+        active = bool(info & 1)
+        if active:
+            # back off the banks that were running, and reapply their duty
+            for name, bit in (('A', 0b010), ('B', 0b100)):
+                if info & bit and name in self.motor:
+                    motor = self.motor[name]
+                    motor.duty_limit *= self.fault_backoff
+                    motor.limit_ticks = self.fault_log_ticks[slot]
+                    motor.set_duty_int(motor._command)
+        for listener in self.fault_listeners:
+            listener(self, active)
+
+    # list of (ticks_ms, active, motors running) for the logged fault edges, oldest first
+    def fault_log(self):
+        n = min(self.fault_log_count, _FAULT_LOG_SIZE)
+        log = []
+        for k in range(self.fault_log_count - n, self.fault_log_count):
+            slot = k % _FAULT_LOG_SIZE
+            info = self.fault_log_info[slot]
+            running = ('A' if info & 0b010 else '') + ('B' if info & 0b100 else '')
+            log.append((self.fault_log_ticks[slot], bool(info & 1), running))
+        return log
+
+    def duty_callback(self, running):
+        # a motor bank started or stopped.
+        # set SLEEP pin LOW if all motors off, else HIGH
+        self._running += 1 if running else -1
+        self._update_sleep()
+
+    def _update_sleep(self):
+        awake = int(self._running > 0 and not self.halted)
+        if awake != self._awake:
+            self.sleep.value(awake)
+            self._awake = awake
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+"""
+Emergency stop for every controller that drives an H-bridge.
+
+Triggered by
+  - calling estop.trigger() from any thread (REPL, controller, watchdog),
+  - an edge on a GPIO, e.g. a kill switch: estop.attach(Pin(0)),
+  - a DRV8833 nFAULT edge: estop.attach_fault(pump.hbridge1).
+
+The stop happens in two stages:
+  1. cut: every registered DRV8833 is put to sleep (one pin write each).
+     This runs directly in the caller or in the hard interrupt handler,
+     so it doesn't wait for any control loop period or sensor I/O.
+  2. finish: scheduled right after the cut, runs the registered stop
+     callbacks (pump.emergency_stop, controllers cancelling their tasks).
+
+Latency from trigger to cut and to finish is measured with ticks_us for every
+stop; see report(). The stop latches until reset() is called.
+
+Modules register themselves:
+    estop.add_hbridge(hbridge)  # cut this driver on emergency stop
+    estop.register(callback)  # callback(source) runs in stage 2
+
+"""
+
+import micropython
+from array import array
+from micropython import const
+from time import ticks_us, ticks_diff
+
+micropython.alloc_emergency_exception_buf(100)
+
+# trigger sources
+CALL = const(0)
+PIN = const(1)
+FAULT = const(2)
+SOURCE_NAMES = ("call", "pin", "fault")
+
+_HISTORY = const(8)
+
+_hbridges = []
+_callbacks = []
+_pins = []  # keep references to attached pins
+
+state = {'tripped': False, 'source': -1, 'count': 0}
+# last _HISTORY stops, microseconds from trigger to cut and to finish
+cut_latency_us = array('i', [0] * _HISTORY)
+finish_latency_us = array('i', [0] * _HISTORY)
+_times = array('i', [0, 0])  # trigger ticks_us, cut ticks_us of the latest stop
+
+
+def add_hbridge(hbridge):
+    if hbridge not in _hbridges:
+        _hbridges.append(hbridge)
+
+
+def register(callback):
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+
+def unregister(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+def tripped():
+    return state['tripped']
+
+
+# Stage 1. Allocation-free so it can run in a hard interrupt.
+def trigger(source=CALL):
+    start = ticks_us()
+    for i in range(len(_hbridges)):
+        _hbridges[i].halt()
+    cut = ticks_us()
+    if state['tripped']:
+        return  # already stopping/stopped, the cut above is all that's needed
+    state['tripped'] = True
+    state['source'] = source
+    slot = state['count'] % _HISTORY
+    state['count'] += 1
+    _times[0] = start
+    _times[1] = cut
+    cut_latency_us[slot] = ticks_diff(cut, start)
+    try:
+        micropython.schedule(_finish, slot)
+    except RuntimeError:
+        # schedule queue full, run the callbacks directly
+        _finish(slot)
+
+
+# Stage 2, runs as a scheduled callback outside of interrupt context
+def _finish(slot):
+    source = state['source']
+    for callback in _callbacks:
+        try:
+            callback(source)
+        except Exception as e:
+            print("estop callback failed: " + str(e))
+    finish_latency_us[slot] = ticks_diff(ticks_us(), _times[0])
+    print("Emergency stop ({}): cut in {} us, stopped in {} us".format(
+        SOURCE_NAMES[source], cut_latency_us[slot], finish_latency_us[slot]))
+
+
+def _pin_handler(pin):
+    trigger(PIN)
+
+
+def _fault_handler(hbridge):
+    trigger(FAULT)
+
+
+def attach(pin, edge=None):
+    from machine import Pin
+    if edge is None:
+        edge = Pin.IRQ_FALLING
+    pin.irq(handler=_pin_handler, trigger=edge, hard=True)
+    _pins.append(pin)
+
+
+# stop everything on nFAULT instead of letting the driver back off duty
+def attach_fault(hbridge):
+    add_hbridge(hbridge)
+    hbridge.on_fault_irq = _fault_handler
+
+
+# Clear the latch and wake the H-bridges. Motors come back stopped.
+def reset():
+    for hbridge in _hbridges:
+        hbridge.reset()
+    state['tripped'] = False
+    state['source'] = -1
+
+
+def report():
+    n = min(state['count'], _HISTORY)
+    if not n:
+        print("No emergency stops.")
+        return
+    print("Emergency stops: {}, tripped: {}".format(state['count'], state['tripped']))
+    cut = sorted(cut_latency_us[i] for i in range(n))
+    finish = sorted(finish_latency_us[i] for i in range(n))
+    print("  cut latency (us):    last {}, median {}, max {}".format(
+        cut_latency_us[(state['count'] - 1) % _HISTORY], cut[n // 2], cut[-1]))
+    print("  finish latency (us): last {}, median {}, max {}".format(
+        finish_latency_us[(state['count'] - 1) % _HISTORY], finish[n // 2], finish[-1]))
@@ -0,0 +1,227 @@
+"""
+Shared I2C bus manager for the ESP32 running Micropython.
+
+There is one I2C peripheral on the board (I2C 0, SCL 22, SDA 21). Only this
+module creates it; everything else asks for a client with
+`i2cbus.get_bus().client(priority)`. A client has the same methods as
+machine.I2C, so it can be handed to any of our device drivers unchanged.
+
+Every transaction holds the bus lock, so threads can't interleave on the wire.
+Multi-register sequences that must not be interrupted (e.g. the VL53L0X
+page-select preambles) go in a batch, which holds the lock for the whole block:
+
+    with i2c.batch():
+        i2c.writeto_mem(0x29, 0xFF, b'\x01')
+        i2c.writeto_mem(0x29, 0x00, b'\x00')
+
+Batches nest, and a thread holding the bus can keep issuing transactions.
+Use `batch(i2c)` in drivers so they still work with a plain machine.I2C.
+
+CONTROL priority clients (altitude sensors) go first: BACKGROUND clients
+wait while any CONTROL client is waiting for the bus.
+
+Per-device bus utilization is tracked; see report().
+
+"""
+
+import _thread
+from micropython import const
+from time import ticks_us, ticks_diff, sleep_us
+
+CONTROL = const(0)
+BACKGROUND = const(1)
+
+_bus = None
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        from machine import I2C, Pin
+        _bus = I2C_BUS(I2C(0, scl=Pin(22), sda=Pin(21)))
+    return _bus
+
+
+class _NoBatch:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_BATCH = _NoBatch()
+
+
+# batch context for drivers that may have been given a plain machine.I2C
+def batch(i2c):
+    try:
+        return i2c.batch()
+    except AttributeError:
+        return _NO_BATCH
+
+
+class I2C_BUS:
+    def __init__(self, i2c):
+        self.i2c = i2c
+        self._lock = _thread.allocate_lock()
+        self._counter_lock = _thread.allocate_lock()
+        self._owner = None
+        self._depth = 0
+        self._control_waiting = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict()  # address: [transactions, bytes, busy microseconds]
+        self._stats_start = ticks_us()
+
+    def acquire(self, priority=BACKGROUND):
+        me = _thread.get_ident()
+        if self._owner == me:
+            self._depth += 1
+            return
+        if priority == CONTROL:
+            with self._counter_lock:
+                self._control_waiting += 1
+            self._lock.acquire()
+            with self._counter_lock:
+                self._control_waiting -= 1
+        else:
+            while True:
+                # let waiting control transactions go first
+                while self._control_waiting:
+                    sleep_us(50)
+                self._lock.acquire()
+                if not self._control_waiting:
+                    break
+                self._lock.release()
+        self._owner = me
+        self._depth = 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+    def batch(self, priority=BACKGROUND):
+        return _BATCH(self, priority)
+
+    def client(self, priority=BACKGROUND):
+        return I2C_CLIENT(self, priority)
+
+    def _account(self, address, nbytes, start):
+        entry = self.stats.get(address)
+        if entry is None:
+            entry = [0, 0, 0]
+            self.stats[address] = entry
+        entry[0] += 1
+        entry[1] += nbytes
+        entry[2] += ticks_diff(ticks_us(), start)
+
+    # Utilization per device address since the last reset_stats().
+    # Returns {address: (transactions, bytes, busy_us, busy fraction)}
+    def utilization(self):
+        elapsed = max(1, ticks_diff(ticks_us(), self._stats_start))
+        return {address: (e[0], e[1], e[2], e[2] / elapsed) for address, e in self.stats.items()}
+
+    def report(self):
+        elapsed = ticks_diff(ticks_us(), self._stats_start) / 1000000
+        print("I2C utilization over {:.1f} s".format(elapsed))
+        total = 0
+        for address, u in sorted(self.utilization().items()):
+            total += u[3]
+            print("  0x{:02x}: {:6d} transactions, {:7d} bytes, {:8.1f} ms busy, {:5.1f}%".format(
+                address, u[0], u[1], u[2] / 1000, u[3] * 100))
+        print("  total: {:5.1f}%".format(total * 100))
+
+
+class _BATCH:
+    def __init__(self, bus, priority):
+        self.bus = bus
+        self.priority = priority
+
+    def __enter__(self):
+        self.bus.acquire(self.priority)
+        return self
+
+    def __exit__(self, *args):
+        self.bus.release()
+        return False
+
+
+# Looks like machine.I2C to device drivers
+class I2C_CLIENT:
+    def __init__(self, bus, priority=BACKGROUND):
+        self.bus = bus
+        self.priority = priority
+
+    def batch(self):
+        return _BATCH(self.bus, self.priority)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *args, **kwargs):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            data = bus.i2c.readfrom_mem(addr, memaddr, nbytes, *args, **kwargs)
+            bus._account(addr, nbytes, start)
+        finally:
+            bus.release()
+        return data
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *args, **kwargs):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            bus.i2c.readfrom_mem_into(addr, memaddr, buf, *args, **kwargs)
+            bus._account(addr, len(buf), start)
+        finally:
+            bus.release()
+
+    def writeto_mem(self, addr, memaddr, buf, *args, **kwargs):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            bus.i2c.writeto_mem(addr, memaddr, buf, *args, **kwargs)
+            bus._account(addr, len(buf), start)
+        finally:
+            bus.release()
+
+    def readfrom(self, addr, nbytes, *args):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            data = bus.i2c.readfrom(addr, nbytes, *args)
+            bus._account(addr, nbytes, start)
+        finally:
+            bus.release()
+        return data
+
+    def readfrom_into(self, addr, buf, *args):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            bus.i2c.readfrom_into(addr, buf, *args)
+            bus._account(addr, len(buf), start)
+        finally:
+            bus.release()
+
+    def writeto(self, addr, buf, *args):
+        bus = self.bus
+        bus.acquire(self.priority)
+        try:
+            start = ticks_us()
+            acks = bus.i2c.writeto(addr, buf, *args)
+            bus._account(addr, len(buf), start)
+        finally:
+            bus.release()
+        return acks
+
+    def scan(self):
+        with _BATCH(self.bus, self.priority):
+            return self.bus.i2c.scan()
@@ -0,0 +1,272 @@
+"""
+Records every I2C transaction to a compact binary trace, for replaying a
+flight's sensor pipeline on a workstation (host/i2c_replay.py).
+
+record() puts a RECORDER between the shared bus (i2cbus) and the I2C
+peripheral, so every driver is traced without changes. Each transaction
+is one record: the header RECORD (operation, ticks_us, device address,
+register, length) and then the bytes read or written. A transaction that
+raised OSError is recorded with the FAILED flag and the errno in place of
+the register, so the replay raises it too. mark() adds a MARK record; the
+controller marks each tick so the replay can count bus bytes per tick.
+
+Records go into one of two preallocated buffers; a task writes the full one
+to the file every cfg['flush_ms'] while the other fills. If a buffer fills
+before it's written, records are dropped and counted in stats, and the
+trace can no longer be replayed past that point. Recording stops by itself
+once the file would pass cfg['max_bytes'] or a write fails (e.g. the flash
+is full); stats['stopped'] says why.
+
+An existing file is never overwritten: record() numbers the name instead
+(flight.i2c, flight.1.i2c, flight.2.i2c, ...) and returns the one used, so
+a reset after a flight doesn't lose its trace.
+
+Start recording before the sensors are brought up, so their setup (e.g.
+calibration coefficient reads) is in the trace too, either from boot with
+    boot_settings.set('i2c_trace', 'flight.i2c'); boot_settings.save()
+or at the REPL before ballonet_controller.start():
+    import i2ctrace
+    i2ctrace.record('flight.i2c')  # returns the file name used
+    ...
+    i2ctrace.stop()
+    i2ctrace.stats  # records, bytes, dropped, written, stopped
+
+"""
+
+import os
+import ustruct
+from time import ticks_us
+import i2cbus
+
+MAGIC = b'I2CT'
+VERSION = 1
+HEADER = '<4sB'
+HEADER_SIZE = ustruct.calcsize(HEADER)
+RECORD = '<BIBHH'  # operation, ticks_us, address, register or errno, length
+RECORD_SIZE = ustruct.calcsize(RECORD)
+
+READ_MEM = 1
+WRITE_MEM = 2
+READ = 3
+WRITE = 4
+SCAN = 5
+MARK = 6
+FAILED = 0x80  # or'ed into the operation
+
+cfg = {'buffer': 8192, 'flush_ms': 200, 'max_bytes': 512 * 1024}
+
+stats = {'records': 0, 'bytes': 0, 'dropped': 0, 'written': 0, 'stopped': None}
+_state = {'recorder': None, 'file': None}
+
+
+# Looks like machine.I2C; passes everything to `i2c` and records it.
+# Callers must not record from two threads at once; i2cbus's lock sees to that.
+class RECORDER:
+    def __init__(self, i2c, size=None):
+        self.i2c = i2c
+        size = size or cfg['buffer']
+        self._buffers = (bytearray(size), bytearray(size))
+        self._active = 0
+        self._position = 0
+
+    def _record(self, operation, address, register, data):
+        buffer = self._buffers[self._active]
+        start = self._position
+        end = start + RECORD_SIZE + len(data)
+        if end > len(buffer):
+            stats['dropped'] += 1
+            return
+        ustruct.pack_into(RECORD, buffer, start, operation, ticks_us(), address, register, len(data))
+        buffer[start + RECORD_SIZE:end] = data
+        self._position = end
+        stats['records'] += 1
+        stats['bytes'] += len(data)
+
+    def _failed(self, operation, address, e):
+        self._record(operation | FAILED, address, e.args[0] if e.args else 0, b'')
+
+    def mark(self):
+        self._record(MARK, 0, 0, b'')
+
+    # Starts over in the other buffer and returns what's been recorded.
+    # Must not run during a transaction; the result is valid until the next swap().
+    def swap(self):
+        buffer = self._buffers[self._active]
+        length = self._position
+        self._active ^= 1
+        self._position = 0
+        return memoryview(buffer)[:length]
+
+    def drain_to(self, f):
+        f.write(self.swap())
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *args, **kwargs):
+        try:
+            data = self.i2c.readfrom_mem(addr, memaddr, nbytes, *args, **kwargs)
+        except OSError as e:
+            self._failed(READ_MEM, addr, e)
+            raise
+        self._record(READ_MEM, addr, memaddr, data)
+        return data
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *args, **kwargs):
+        try:
+            self.i2c.readfrom_mem_into(addr, memaddr, buf, *args, **kwargs)
+        except OSError as e:
+            self._failed(READ_MEM, addr, e)
+            raise
+        self._record(READ_MEM, addr, memaddr, buf)
+
+    def writeto_mem(self, addr, memaddr, buf, *args, **kwargs):
+        try:
+            self.i2c.writeto_mem(addr, memaddr, buf, *args, **kwargs)
+        except OSError as e:
+            self._failed(WRITE_MEM, addr, e)
+            raise
+        self._record(WRITE_MEM, addr, memaddr, buf)
+
+    def readfrom(self, addr, nbytes, *args):
+        try:
+            data = self.i2c.readfrom(addr, nbytes, *args)
+        except OSError as e:
+            self._failed(READ, addr, e)
+            raise
+        self._record(READ, addr, 0, data)
+        return data
+
+    def readfrom_into(self, addr, buf, *args):
+        try:
+            self.i2c.readfrom_into(addr, buf, *args)
+        except OSError as e:
+            self._failed(READ, addr, e)
+            raise
+        self._record(READ, addr, 0, buf)
+
+    def writeto(self, addr, buf, *args):
+        try:
+            acks = self.i2c.writeto(addr, buf, *args)
+        except OSError as e:
+            self._failed(WRITE, addr, e)
+            raise
+        self._record(WRITE, addr, 0, buf)
+        return acks
+
+    def scan(self):
+        addresses = self.i2c.scan()
+        self._record(SCAN, 0, 0, bytes(addresses))
+        return addresses
+
+
+def write_header(f):
+    f.write(ustruct.pack(HEADER, MAGIC, VERSION))
+
+
+def recording():
+    return _state['recorder'] is not None
+
+
+# Writes what's been recorded. Returns False once recording has to stop.
+def _drain():
+    # only the swap holds the bus; the flash write doesn't
+    with i2cbus.get_bus().batch(i2cbus.CONTROL):
+        recorded = _state['recorder'].swap()
+    if not len(recorded):
+        return True
+    if stats['written'] + len(recorded) > cfg['max_bytes']:
+        stats['stopped'] = 'max_bytes'
+        return False
+    try:
+        _state['file'].write(recorded)
+        _state['file'].flush()
+    except OSError as e:
+        stats['stopped'] = e
+        return False
+    stats['written'] += len(recorded)
+    return True
+
+
+async def _flush_task():
+    import runtime
+    ticker = runtime.Ticker(cfg['flush_ms'])
+    while True:
+        await ticker.wait()
+        if not _drain():
+            return
+
+
+def _stopped(name):
+    recorder = _state['recorder']
+    f = _state['file']
+    # take the recorder off the bus first, so nothing below can leave it there
+    bus = i2cbus.get_bus()
+    with bus.batch(i2cbus.CONTROL):
+        bus.i2c = recorder.i2c
+        recorded = recorder.swap()
+    _state['recorder'] = None
+    _state['file'] = None
+    try:
+        if len(recorded) and stats['stopped'] is None and stats['written'] + len(recorded) <= cfg['max_bytes']:
+            f.write(recorded)
+            stats['written'] += len(recorded)
+    except OSError as e:
+        stats['stopped'] = e
+    finally:
+        f.close()
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+# path, or the first numbered name that isn't taken: a.i2c, a.1.i2c, a.2.i2c, ...
+def _unused(path):
+    if not _exists(path):
+        return path
+    dot = path.rfind('.')
+    if dot <= path.rfind('/'):
+        dot = len(path)
+    n = 1
+    while True:
+        numbered = '{}.{}{}'.format(path[:dot], n, path[dot:])
+        if not _exists(numbered):
+            return numbered
+        n += 1
+
+
+def record(path):
+    import runtime  # not at the top, so host tools can import this module
+    if recording():
+        raise RuntimeError("already recording")
+    for key in stats:
+        stats[key] = 0
+    stats['stopped'] = None
+    path = _unused(path)
+    f = open(path, 'wb')
+    write_header(f)
+    stats['written'] = HEADER_SIZE
+    bus = i2cbus.get_bus()
+    with bus.batch(i2cbus.CONTROL):
+        recorder = RECORDER(bus.i2c)
+        bus.i2c = recorder
+    _state['file'] = f
+    _state['recorder'] = recorder
+    runtime.spawn('i2ctrace', _flush_task, on_exit=_stopped)
+    return path
+
+
+def stop():
+    import runtime
+    runtime.cancel('i2ctrace')
+
+
+# A tick boundary, for bytes per tick in the replay
+def mark():
+    recorder = _state['recorder']
+    if recorder is None:
+        return
+    with i2cbus.get_bus().batch(i2cbus.CONTROL):
+        recorder.mark()
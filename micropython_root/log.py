@@ -0,0 +1,187 @@
+"""
+Non-blocking log for control loops.
+
+print() from a control task waits on the UART or WebREPL and builds strings
+(garbage for the collector) in the middle of a tick. Logging here only stores
+the format string and up to four arguments in a preallocated ring; a
+low-rate task formats and prints them later, at most cfg['lines_per_s']
+lines per second, and optionally appends them to cfg['file'].
+
+Since only references are stored, log calls allocate nothing: pass the
+format string as a literal and values the caller already has. The
+arguments are formatted when the message is drained, so don't pass
+anything that changes in place (lists, arrays).
+
+When the ring is full new messages are dropped and counted; the drain
+task reports the count. Messages below cfg['level'] are skipped.
+
+Usage:
+    import log
+    log.info("H: {:7.3f}, V: {:4d}", h, v)
+    log.warning("No fresh barometer reading!")
+    log.start()  # the drain task, also started by the controllers
+    log.cfg['level'] = log.DEBUG
+    log.flush()  # print everything waiting, now
+    log.stats  # written, dropped, printed
+
+"""
+
+import _thread
+from array import array
+from time import ticks_ms
+import runtime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_NAMES = {DEBUG: 'D', INFO: 'I', WARNING: 'W', ERROR: 'E'}
+
+MAX_ARGS = 4
+_PERIOD_MS = 100
+
+cfg = {
+    'size': 64,  # messages, used at import and by resize()
+    'level': INFO,
+    'lines_per_s': 20,
+    'console': True,
+    'file': None,  # e.g. "log.txt", opened by start()
+}
+
+stats = {'written': 0, 'dropped': 0, 'printed': 0}
+_lock = _thread.allocate_lock()
+_state = {'head': 0, 'count': 0, 'reported': 0, 'file': None}
+
+
+# Reallocates the ring, dropping anything in it. Not for use while logging.
+def resize(size):
+    global _levels, _ticks, _formats, _args
+    with _lock:
+        cfg['size'] = size
+        _levels = array('B', bytes(size))
+        _ticks = array('I', [0] * size)
+        _formats = [None] * size
+        _args = [None] * (size * MAX_ARGS)
+        _state['head'] = 0
+        _state['count'] = 0
+
+
+resize(cfg['size'])
+
+
+def write(level, fmt, a=None, b=None, c=None, d=None):
+    if level < cfg['level']:
+        return
+    with _lock:
+        size = cfg['size']
+        count = _state['count']
+        if count == size:
+            stats['dropped'] += 1
+            return
+        i = _state['head'] + count
+        if i >= size:
+            i -= size
+        _levels[i] = level
+        _ticks[i] = ticks_ms()
+        _formats[i] = fmt
+        j = i * MAX_ARGS
+        _args[j] = a
+        _args[j + 1] = b
+        _args[j + 2] = c
+        _args[j + 3] = d
+        _state['count'] = count + 1
+        stats['written'] += 1
+
+
+def debug(fmt, a=None, b=None, c=None, d=None):
+    write(DEBUG, fmt, a, b, c, d)
+
+
+def info(fmt, a=None, b=None, c=None, d=None):
+    write(INFO, fmt, a, b, c, d)
+
+
+def warning(fmt, a=None, b=None, c=None, d=None):
+    write(WARNING, fmt, a, b, c, d)
+
+
+def error(fmt, a=None, b=None, c=None, d=None):
+    write(ERROR, fmt, a, b, c, d)
+
+
+def _output(line):
+    if cfg['console']:
+        print(line)
+    f = _state['file']
+    if f is not None:
+        f.write(line + "\n")
+
+
+# Format and output up to `limit` waiting messages. Returns how many.
+def drain(limit):
+    done = 0
+    while done < limit:
+        with _lock:
+            if not _state['count']:
+                break
+            i = _state['head']
+            level = _levels[i]
+            ticks = _ticks[i]
+            fmt = _formats[i]
+            j = i * MAX_ARGS
+            args = _args[j:j + MAX_ARGS]
+            _formats[i] = None
+            for k in range(j, j + MAX_ARGS):
+                _args[k] = None
+            _state['head'] = i + 1 if i + 1 < cfg['size'] else 0
+            _state['count'] -= 1
+        try:
+            text = fmt.format(*args)
+        except Exception as e:
+            text = fmt + " (can't format: " + str(e) + ")"
+        _output("{:9d} {} {}".format(ticks, _NAMES.get(level, '?'), text))
+        done += 1
+    dropped = stats['dropped']
+    if dropped != _state['reported']:
+        _output("log: {} messages dropped".format(dropped - _state['reported']))
+        _state['reported'] = dropped
+    stats['printed'] += done
+    f = _state['file']
+    if done and f is not None:
+        f.flush()
+    return done
+
+
+def flush():
+    drain(cfg['size'])
+
+
+def pending():
+    return _state['count']
+
+
+async def _drain_task():
+    ticker = runtime.Ticker(_PERIOD_MS)
+    while True:
+        await ticker.wait()
+        drain(max(1, cfg['lines_per_s'] * _PERIOD_MS // 1000))
+
+
+def _stopped(name):
+    flush()
+    f = _state['file']
+    _state['file'] = None
+    if f is not None:
+        f.close()
+
+
+def start():
+    if runtime.running('log'):
+        return
+    if cfg['file'] is not None and _state['file'] is None:
+        _state['file'] = open(cfg['file'], 'a')
+    runtime.spawn('log', _drain_task, on_exit=_stopped)
+
+
+def stop():
+    runtime.cancel('log')
@@ -61,6 +61,10 @@ class XLMaxSonarUART:
     def start(self):
         self._uart.write(b'\x01')  # create pulse on TX pin
 
+    # True once a complete reading ('R' + 3 digits + CR) is in the UART buffer
+    def data_ready(self):
+        return self._uart.any() >= 5
+
     def read(self):
         i = 0
         data = b''
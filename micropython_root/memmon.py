@@ -0,0 +1,167 @@
+"""
+Heap monitor and idle-time garbage collection for control loops.
+
+The control loop brackets each tick with tick_start() and tick_end(), which
+sample the heap: bytes allocated during the tick, heap in use, the
+high-water mark and the lowest free heap seen. An automatic collection
+shows up as the heap in use going down; one that landed inside a tick is
+counted separately, since that's the pause that stretches a tick.
+
+Stages of the tick can be measured on their own:
+    m = memmon.enter()
+    ...
+    memmon.exit('altitude', m)
+adds the bytes allocated in between to sections['altitude'] (runs with a
+collection in the middle can't be measured and are counted instead).
+
+After the tick's work, idle(slack_ms) runs gc.collect() if more than
+cfg['collect_above'] of the heap is in use and the time left before the
+next tick is longer than the last collection took plus cfg['margin_ms'].
+Collecting early and in the slack keeps the automatic collection, which
+runs whenever an allocation doesn't fit, off the sensor-read and
+actuate path.
+
+Usage (ballonet_controller does this):
+    memmon.tick_start()
+    ...
+    memmon.tick_end()
+    memmon.idle(ticker.slack())
+    await ticker.wait()
+and at the REPL
+    memmon.report()
+    memmon.stats, memmon.sections
+
+"""
+
+import gc
+from array import array
+from time import ticks_us, ticks_diff
+
+cfg = {
+    'collect_above': 0.5,  # fraction of the heap in use; above 1 never collects
+    'margin_ms': 5,
+}
+
+_SAMPLES = 64
+# per tick, newest last once wrapped: heap in use at the end, bytes allocated during
+heap_used = array('I', [0] * _SAMPLES)
+allocated = array('I', [0] * _SAMPLES)
+
+stats = {
+    'ticks': 0,
+    'high_water': 0,
+    'min_free': 0,
+    'tick_alloc_max': 0,
+    'tick_alloc_total': 0,
+    'collections_in_tick': 0,  # automatic ones
+    'collections_between_ticks': 0,  # automatic ones
+    'idle_collections': 0,
+    'idle_skipped': 0,  # too little slack
+    'collect_us_max': 0,
+    'collect_us_total': 0,
+}
+sections = dict()  # name: [runs, bytes, max bytes, runs with a collection inside]
+_state = {'start': 0, 'last': 0, 'next': 0, 'collect_ms': 1}
+
+
+def reset():
+    for key in stats:
+        stats[key] = 0
+    sections.clear()
+    _state['next'] = 0
+    _state['last'] = 0
+
+
+def tick_start():
+    used = gc.mem_alloc()
+    if used < _state['last']:
+        stats['collections_between_ticks'] += 1
+    _state['start'] = used
+
+
+def tick_end():
+    used = gc.mem_alloc()
+    free = gc.mem_free()
+    start = _state['start']
+    if used < start:
+        stats['collections_in_tick'] += 1
+        delta = 0
+    else:
+        delta = used - start
+    i = _state['next']
+    heap_used[i] = used
+    allocated[i] = delta
+    _state['next'] = i + 1 if i + 1 < _SAMPLES else 0
+    _state['last'] = used
+    stats['ticks'] += 1
+    stats['tick_alloc_total'] += delta
+    if delta > stats['tick_alloc_max']:
+        stats['tick_alloc_max'] = delta
+    if used > stats['high_water']:
+        stats['high_water'] = used
+    if free < stats['min_free'] or not stats['min_free']:
+        stats['min_free'] = free
+
+
+def enter():
+    return gc.mem_alloc()
+
+
+def exit(name, start):
+    used = gc.mem_alloc()
+    section = sections.get(name)
+    if section is None:
+        section = sections[name] = [0, 0, 0, 0]
+    section[0] += 1
+    if used < start:
+        section[3] += 1
+        return
+    delta = used - start
+    section[1] += delta
+    if delta > section[2]:
+        section[2] = delta
+
+
+# Collect now if the heap is full enough and `slack_ms` leaves time for it.
+# Returns True if it collected.
+def idle(slack_ms):
+    used = gc.mem_alloc()
+    if used < cfg['collect_above'] * (used + gc.mem_free()):
+        return False
+    if slack_ms < _state['collect_ms'] + cfg['margin_ms']:
+        stats['idle_skipped'] += 1
+        return False
+    t = ticks_us()
+    gc.collect()
+    duration = ticks_diff(ticks_us(), t)
+    _state['collect_ms'] = duration // 1000 + 1
+    _state['last'] = gc.mem_alloc()
+    stats['idle_collections'] += 1
+    stats['collect_us_total'] += duration
+    if duration > stats['collect_us_max']:
+        stats['collect_us_max'] = duration
+    return True
+
+
+def report():
+    used = gc.mem_alloc()
+    free = gc.mem_free()
+    ticks = stats['ticks']
+    print("heap: {} of {} bytes in use, high water {}, lowest free {}".format(
+        used, used + free, stats['high_water'], stats['min_free']))
+    if ticks:
+        print("per tick: {:.0f} bytes allocated on average, {} at most, over {} ticks".format(
+            stats['tick_alloc_total'] / ticks, stats['tick_alloc_max'], ticks))
+    print("automatic collections: {} inside ticks, {} between".format(
+        stats['collections_in_tick'], stats['collections_between_ticks']))
+    idle_count = stats['idle_collections']
+    print("idle collections: {}, {:.1f} ms mean, {:.1f} ms max; {} skipped for lack of slack".format(
+        idle_count, stats['collect_us_total'] / idle_count / 1000 if idle_count else 0,
+        stats['collect_us_max'] / 1000, stats['idle_skipped']))
+    if sections:
+        print("{:16} {:>6} {:>10} {:>8} {:>6}".format("section", "runs", "bytes/run", "max", "gc"))
+        for name in sorted(sections):
+            runs, total, largest, collected = sections[name]
+            measured = runs - collected
+            print("{:16} {:6d} {:10.0f} {:8d} {:6d}".format(
+                name, runs, total / measured if measured else 0, largest, collected))
@@ -1,45 +1,202 @@
+from math import log
+from array import array
+from time import sleep_us
 import adc
+import calstore
+
+KELVIN = 273.15
 
 get_temperature = None
 get_temperature_fahrenheit = None
 
 
 class thermometer:
-    def __init__(self, i2c, address=72, type=None):
+    # r_series is the fixed resistor on the reference side of the divider.
+    # Set lut_size to convert through a precomputed lookup table instead of
+    # searching the thermistor table every reading. lut_range limits the
+    # lookup table to (t_min, t_max), outside of which readings are clamped.
+    def __init__(self, i2c, address=72, type=None, r_series=99.2 * 1000,
+                 lut_size=None, lut_range=(None, None)):
         self.i2c = i2c
         self.address = address
         self.ads = adc.ADS1115(i2c, address)
         self.epcos = thermistor(type)  # create thermistor object
+        self.r_series = r_series
+        if lut_size:
+            self.epcos.build_lut(r_series, lut_size, *lut_range)
 
     def get_temperature(self):
-        R1 = 99.2 * 1000
-        Vref1 = self.ads.get_voltage("A3")
-        Vo = self.ads.get_voltage("A0")
-        Rntc = R1 / (Vref1 / Vo - 1)
-        return self.epcos.get_temperature(Rntc)
+        # ratiometric: both inputs use the same gain, so raw codes can be divided directly
+        ref = self.ads.convert_raw("A3")
+        ratio = self.ads.convert_raw("A0") / ref
+        return ratio_to_temperature(self.epcos, ratio, self.r_series)
 
     def get_temperature_fahrenheit(self):
         return self.get_temperature() * 9 / 5 + 32
 
 
+# Scans several thermistors on one or more ADS1115 devices without blocking.
+# channels is a list of (ads, channel) or (ads, channel, thermistor) tuples.
+# Every divider is assumed to be fed from the reference voltage measured on
+# `reference` of the same ADS1115, which is read once per scan.
+# Each thermistor channel is converted `oversample` times per scan and averaged,
+# then smoothed across scans with an exponential filter (alpha = 1 disables it).
+# Devices convert in parallel; call poll() as often as convenient
+# (at least every 1 / sps seconds for full speed) and read `temperatures`.
+#
+# Example:
+#   ads = adc.ADS1115(i2c, 72)
+#   epcos = thermistor("epcos100k.tsv")
+#   epcos.build_lut(99.2 * 1000, 256, -20, 80)
+#   scanner = thermometer_scanner([(ads, "A0"), (ads, "A1")], epcos)
+#   while True:
+#       scanner.poll()
+#       print(scanner.temperatures[0])
+class thermometer_scanner:
+    def __init__(self, channels, epcos=None, r_series=99.2 * 1000, reference="A3",
+                 oversample=4, alpha=0.5, sps=860):
+        self.r_series = r_series
+        self.oversample = oversample
+        self.alpha = alpha
+        self.n = len(channels)
+        self.temperatures = array('f', bytearray(4 * self.n))
+        self.ratios = array('f', bytearray(4 * self.n))
+        self.scans = 0
+        self._thermistors = []
+        self._sums = array('i', bytearray(4 * self.n))
+        # per device: ads, reference code, list of (channel name, index),
+        #   and position in that list (-1 is the reference read)
+        self._devices = []
+        for i, entry in enumerate(channels):
+            ads = entry[0]
+            t = entry[2] if len(entry) > 2 else epcos
+            if t is None:
+                raise TypeError("No thermistor given for channel " + str(i))
+            self._thermistors.append(t)
+            for device in self._devices:
+                if device[0] is ads:
+                    device[2].append((entry[1], i))
+                    break
+            else:
+                ads.sps = sps
+                self._devices.append([ads, 0, [(entry[1], i)], -1, 0])
+        self.reference = reference
+        self._pending = 0
+        self._begin_scan()
+
+    def _begin_scan(self):
+        for i in range(self.n):
+            self._sums[i] = 0
+        for device in self._devices:
+            device[3] = -1  # list position, -1 is the reference channel
+            device[4] = 0  # repetitions of the current channel
+            device[0].start(self.reference)
+        self._pending = len(self._devices)
+
+    # advances every device by at most one conversion.
+    # Returns True when a complete scan was just finished.
+    def poll(self):
+        for device in self._devices:
+            ads = device[0]
+            position = device[3]
+            if position >= len(device[2]) or not ads.ready():
+                continue
+            raw = ads.read_raw()
+            if position < 0:
+                device[1] = raw if raw > 0 else 1
+                position = 0
+            else:
+                self._sums[device[2][position][1]] += raw
+                device[4] += 1
+                if device[4] >= self.oversample:
+                    device[4] = 0
+                    position += 1
+            device[3] = position
+            if position < len(device[2]):
+                ads.start(device[2][position][0])
+            else:
+                self._pending -= 1
+        if self._pending:
+            return False
+        self._finish_scan()
+        self._begin_scan()
+        return True
+
+    def _finish_scan(self):
+        alpha = self.alpha if self.scans else 1
+        for device in self._devices:
+            ref = device[1] * self.oversample
+            for channel, i in device[2]:
+                ratio = self._sums[i] / ref
+                self.ratios[i] = ratio
+                t = ratio_to_temperature(self._thermistors[i], ratio, self.r_series)
+                self.temperatures[i] += alpha * (t - self.temperatures[i])
+        self.scans += 1
+
+    # blocking: run until one complete scan is finished
+    def scan(self):
+        while not self.poll():
+            sleep_us(200)
+        return self.temperatures
+
+    def get_temperature(self, i=0):
+        return self.temperatures[i]
+
+
+def ratio_to_temperature(epcos, ratio, r_series):
+    if epcos.lut is not None and epcos.lut_r_series == r_series:
+        return epcos.get_temperature_ratio(ratio)
+    if ratio >= 1:
+        ratio = 0.99999  # thermistor open circuit, report the coldest value
+    elif ratio <= 0:
+        ratio = 0.00001
+    return epcos.get_temperature(r_series * ratio / (1 - ratio))
+
+
+# tab-separated temperature (C), resistance (ohm) file to [array('f'), array('f')]
+def _parse_table(file):
+    table_tc = array('f')
+    table_r = array('f')
+    with open(file, "r") as f:
+        while True:
+            line = f.readline()
+            if line:
+                split = line.rstrip().split("\t")
+                table_tc.append(float(split[0]))
+                table_r.append(float(split[1]))
+            else:
+                break
+    return [table_tc, table_r]
+
+
+# Converts NTC thermistor resistance to temperature in C.
+# The table file is tab-separated temperature and resistance, sorted by
+# descending resistance (ascending temperature).
+# Three conversions are available, all constant or logarithmic time:
+#   get_temperature(r)        binary search over the table, linear interpolation.
+#                             Extrapolates linearly past either end of the table.
+#   get_temperature_sh(r)     Steinhart-Hart equation with coefficients
+#                             least-squares fitted to the table.
+#   get_temperature_ratio(v)  dense lookup table indexed by the divider ratio
+#                             Vntc / Vref, built by build_lut().
 class thermistor:
     def __init__(self, file):
         self.file = file
-        self.table_tc = []
-        self.table_r = []
+        # temperature and resistance columns, compiled once (see calstore.py)
         try:
-            with open(self.file, "r") as f:
-                while True:
-                    line = f.readline()
-                    if line:
-                        split = line.rstrip().split("\t")
-                        self.table_tc.append(float(split[0]))
-                        self.table_r.append(float(split[1]))
-                    else:
-                        break
+            self.table_tc, self.table_r = calstore.cached(self.file, _parse_table, 1)
         except IOError:
-            pass
+            self.table_tc = array('f')
+            self.table_r = array('f')
+        for i in range(1, len(self.table_r)):
+            if self.table_r[i - 1] <= self.table_r[i]:
+                raise Exception("Table not sorted in descending order")
         self.table = zip(self.table_r, self.table_tc)
+        self.sh = None  # Steinhart-Hart coefficients (A, B, C)
+        self.lut = None
+        self.lut_r_series = None
+        self._lut_min = 0.0
+        self._lut_scale = 0.0
 
     def linear_approximation(self, i1, i2, r):
         x1 = self.table_r[i1]
@@ -49,28 +206,101 @@ class thermistor:
         m = (y2 - y1) / (x2 - x1)
         return m * (r - x1) + y1
 
-    def get_temperature(self, r_ntc):
-        nearest_r = min(self.table_r, key=lambda x: abs(x - r_ntc))
-        i = self.table_r.index(nearest_r)
-        if i <= 0:
-            return self.linear_approximation(i, i + 1, r_ntc)
-        elif i >= len(self.table_r):
-            return self.linear_approximation(i, i - 1, r_ntc)
-        else:
-            if self.table_r[i] > self.table_r[i + 1]:
-                if r_ntc <= self.table_r[i] and r_ntc >= self.table_r[i + 1]:
-                    return self.linear_approximation(i, i + 1, r_ntc)
-                if r_ntc <= self.table_r[i - 1] and r_ntc > self.table_r[i]:
-                    return self.linear_approximation(i, i - 1, r_ntc)
+    # index i of the table segment [i, i + 1] containing r_ntc.
+    # Clamped to the first/last segment for values outside of the table.
+    def find_segment(self, r_ntc):
+        table_r = self.table_r
+        lo = 0
+        hi = len(table_r) - 2
+        while lo < hi:
+            mid = (lo + hi + 1) >> 1
+            if table_r[mid] >= r_ntc:
+                lo = mid
             else:
-                raise Exception("Table not sorted in descending order")
+                hi = mid - 1
+        return lo
+
+    def get_temperature(self, r_ntc):
+        i = self.find_segment(r_ntc)
+        return self.linear_approximation(i, i + 1, r_ntc)
+
+    # Fit 1/T = A + B*ln(R) + C*ln(R)^3 to the table by least squares
+    def fit_steinhart_hart(self):
+        # normal equations for the three basis functions 1, L, L^3
+        m = [[0.0] * 4 for i in range(3)]
+        for r, tc in zip(self.table_r, self.table_tc):
+            ln_r = log(r)
+            basis = (1.0, ln_r, ln_r ** 3)
+            y = 1 / (tc + KELVIN)
+            for j in range(3):
+                for k in range(3):
+                    m[j][k] += basis[j] * basis[k]
+                m[j][3] += basis[j] * y
+        # gaussian elimination with partial pivoting
+        for col in range(3):
+            pivot = max(range(col, 3), key=lambda row: abs(m[row][col]))
+            m[col], m[pivot] = m[pivot], m[col]
+            for row in range(col + 1, 3):
+                f = m[row][col] / m[col][col]
+                for k in range(col, 4):
+                    m[row][k] -= f * m[col][k]
+        x = [0.0] * 3
+        for row in (2, 1, 0):
+            x[row] = (m[row][3] - sum(m[row][k] * x[k] for k in range(row + 1, 3))) / m[row][row]
+        self.sh = tuple(x)
+        return self.sh
+
+    def get_temperature_sh(self, r_ntc):
+        if self.sh is None:
+            self.fit_steinhart_hart()
+        a, b, c = self.sh
+        ln_r = log(r_ntc)
+        return 1 / (a + b * ln_r + c * ln_r * ln_r * ln_r) - KELVIN
+
+    # Precompute temperatures for `size` evenly spaced divider ratios
+    # Vntc / Vref = R / (R + r_series).
+    # The table is steep in ratio at its hot and cold ends, so limit the span
+    # with t_min and t_max (degrees C, rounded out to table rows) for accuracy.
+    def build_lut(self, r_series, size=256, t_min=None, t_max=None):
+        first = 0
+        last = len(self.table_tc) - 1
+        while t_min is not None and first < last and self.table_tc[first + 1] <= t_min:
+            first += 1
+        while t_max is not None and last > first and self.table_tc[last - 1] >= t_max:
+            last -= 1
+        r_max = self.table_r[first]
+        r_min = self.table_r[last]
+        ratio_min = r_min / (r_min + r_series)
+        ratio_max = r_max / (r_max + r_series)
+        step = (ratio_max - ratio_min) / (size - 1)
+        lut = array('f', bytearray(4 * size))
+        for i in range(size):
+            ratio = ratio_min + i * step
+            lut[i] = self.get_temperature(r_series * ratio / (1 - ratio))
+        self.lut = lut
+        self.lut_r_series = r_series
+        self._lut_min = ratio_min
+        self._lut_scale = 1 / step
+        return lut
+
+    def get_temperature_ratio(self, ratio):
+        lut = self.lut
+        x = (ratio - self._lut_min) * self._lut_scale
+        last = len(lut) - 1
+        if x <= 0:
+            return lut[0]
+        if x >= last:
+            return lut[last]
+        i = int(x)
+        y1 = lut[i]
+        return y1 + (lut[i + 1] - y1) * (x - i)
 
 
 def main():
     global get_temperature
     global get_temperature_fahrenheit
-    from machine import Pin, I2C
-    i2c = I2C(0, scl=Pin(22), sda=Pin(21))  # must specify pins for some reason
+    from i2cbus import get_bus
+    i2c = get_bus().client()
     this = thermometer(i2c, 72, "epcos100k.tsv")
     get_temperature = this.get_temperature
     get_temperature_fahrenheit = this.get_temperature_fahrenheit
@@ -1,93 +1,201 @@
-# TODO: implement temperature smoothing for thermal runaway protection
+"""
+Temperature controller for a Peltier element or heater on a DRV8833 H-bridge.
+
+A PID loop with setpoint feedforward (see pid.py) drives motor A of the
+H-bridge. Positive output heats (Forward), negative output cools (Reverse).
+
+Thermal runaway protection estimates dT/dt every tick with a streaming linear
+regression over the last `runaway_window` seconds of readings, and trips when
+  - the temperature changes faster than `runaway_max_slope` in either direction
+    (thermistor fell off, shorted, or the element is overheating), or
+  - the output is saturated towards the setpoint, but the temperature is not
+    moving towards it at `runaway_min_slope` or better
+    (thermistor not mounted to the element, element disconnected, wrong polarity).
+The second check only starts `runaway_grace` seconds after the output
+saturates to allow for thermal lag.
+Either condition has to hold for `runaway_trip_samples` ticks in a row.
+
+The thermometer scan and the control loop run as runtime tasks.
+
+Usage:
+    import p_control
+    p_control.cfg['T'] = 0.25  # control period in seconds
+    p_control.start(35)  # hold 35 C
+    p_control.setpoint(30)
+    p_control.stop()
+
+"""
 from micropython import const
-import _thread
-from time import sleep
-from machine import Pin, I2C
-from drv8833 import drv8833
+import time
+import uasyncio as asyncio
+from machine import Pin
+from drv8833 import DRV8833
+from pid import PID
+from statistics_tools import RingSlope
+import adc
 import ntc
+import runtime
+import i2cbus
+import estop
+import telemetry
+import log
+
+_MIN_RUNAWAY_WINDOW = const(3)  # samples
+
+i2c = i2cbus.get_bus().client(i2cbus.BACKGROUND)
+epcos = ntc.thermistor("epcos100k.tsv")
+epcos.build_lut(99.2 * 1000, 256, -20, 80)
+# add more (ads, channel) pairs to watch more points; channel 0 is controlled
+thermometers = ntc.thermometer_scanner([(adc.ADS1115(i2c, 72), "A0")], epcos)
+
+hbridge = DRV8833(1000, Pin(32), Pin(33), Pin(25), Pin(26), None, None)
+estop.add_hbridge(hbridge)
+
+cfg = {
+    'setpoint': 0.0,  # degrees C
+    'T': 1.0,  # control period in seconds. Sub-second periods are fine.
+
+    # PID gains, output is duty cycle from -1 (full cooling) to 1 (full heating)
+    'kp': 0.5,
+    'ki': 0.0,
+    'kd': 0.0,
+    # feedforward gain in duty per degree C of setpoint above starting temperature
+    'kf': 0.0,
+
+    # thermal runaway protection, see top of file
+    'runaway_window': 5.0,  # seconds of history used for the dT/dt estimate
+    'runaway_max_slope': 2.0,  # C/s, faster than this is never normal
+    'runaway_min_slope': 0.02,  # C/s, slower than this while saturated is a stall
+    'runaway_grace': 20.0,  # seconds of saturation before checking for a stall
+    'runaway_trip_samples': 3,
+}
 
-_MAX_LIST_SIZE = const(255)
-
-i2c = I2C(0, scl=Pin(22), sda=Pin(21))
-t1 = ntc.thermometer(i2c, 72, "epcos100k.tsv")
-
-hbridge = drv8833(1000, 32, 33, 25, 26, None, None)
-setpoint = 0.0
-_T = const(1)
-_TIMEOUT_SECONDS = const(30)
-_TIMEOUT_CYCLES = int(_TIMEOUT_SECONDS / _T)
 starting_temperature = -273.15
-enable = False
+pid = None
+slope = None
 
-if _TIMEOUT_CYCLES > 255:
-    print("TIMEOUT TOO LONG OR PERIOD TOO SHORT")
+
+async def _thermometer_task():
+    while True:
+        thermometers.poll()
+        await asyncio.sleep_ms(1)
 
 
-def __loop():
-    global setpoint
+async def _control_task():
     global starting_temperature
+    T = cfg['T']
+    ticker = runtime.Ticker(int(T * 1000))
+    previous_setpoint = None
+    direction = None
+    saturated_since = None
+    abnormal = 0
     n = 0
-    previous_setpoint = -273.15
-    history = []
-    cycles_since_start = 0
+    # wait for the first complete scan
+    scans = thermometers.scans
+    while thermometers.scans == scans:
+        await asyncio.sleep_ms(1)
+    previous_time = time.ticks_ms()
     while True:
-        if not enable:
-            return
-        temperature = t1.get_temperature()
-        if not safe_temperature(temperature):
-            hbridge.emergency_stop()
-            print("Stopping heat/cool! Unsafe temperature: " + str(temperature))
-            _thread.exit()
-            return
-        if float(setpoint) is not float(previous_setpoint):
+        temperature = thermometers.temperatures[0]
+        now = time.ticks_ms()
+        dt = time.ticks_diff(now, previous_time) / 1000
+        previous_time = now
+        for i in range(min(2, len(thermometers.temperatures))):
+            telemetry.temperatures[i] = thermometers.temperatures[i]
+        for t in thermometers.temperatures:
+            if not safe_temperature(t):
+                hbridge.emergency_stop()
+                log.error("Stopping heat/cool! Unsafe temperature: {}", t)
+                return
+        setpoint = cfg['setpoint']
+        if setpoint != previous_setpoint:
             # if setpoint changed
             starting_temperature = temperature
-            cycles_since_start = 0
-            print("starting temperature: " + str(starting_temperature))
-        e = setpoint - temperature
-        pwm_duty = e * (1 / 2)
-        pwm_duty = min(abs(pwm_duty), 1)
-        direction = "Reverse" if e < 0 else "Forward"
-        hbridge.power(pwm_duty, direction)
-
-        if cycles_since_start > _TIMEOUT_CYCLES:
-            if not abs(e) < 5.0:  # if temperature is not within 5C of setpoint
-                delta = 0
-                if setpoint > starting_temperature:
-                    # if setpoint is higher than starting temperature
-                    delta = temperature - starting_temperature
-                elif setpoint < starting_temperature:
-                    # if setpoint is lower than starting temperature
-                    delta = starting_temperature - temperature
-
-                if delta < 1:
-                    # if temperature has not moved more than 1C towards setpoint
-                    hbridge.emergency_stop()
-                    print("Thermal runaway protection activated.")
-                    print("Check that thermistor is properly mounted and functioning.")
-                    _thread.exit()
-                    return
-        print("n since: " + str(cycles_since_start)
-              + ", set: " + str(setpoint)
-              + ", temp: " + str(temperature) + " C")
-        #
-        fix_push(history, temperature)
+            pid.ff_reference = temperature
+            saturated_since = None
+            abnormal = 0
+            log.info("starting temperature: {}", starting_temperature)
         previous_setpoint = setpoint
-        n = n + 1
-        cycles_since_start += 1
-        sleep(_T)
 
+        u = pid.update(setpoint, temperature, dt if n else T)
+        new_direction = "Forward" if u >= 0 else "Reverse"
+        if new_direction != direction:
+            # only moves the duty between the pins, but no need to redo it every tick
+            hbridge.motor['A'].direction = new_direction
+            direction = new_direction
+        hbridge.motor['A'].duty = abs(u)
+
+        slope.push(temperature)
+        if pid.saturated:
+            if saturated_since is None:
+                saturated_since = now
+        else:
+            saturated_since = None
+        if runaway(setpoint, temperature, slope.slope(), saturated_since, now):
+            abnormal += 1
+        else:
+            abnormal = 0
+        if abnormal >= cfg['runaway_trip_samples']:
+            hbridge.emergency_stop()
+            log.error("Thermal runaway protection activated. dT/dt: {} C/s", slope.slope())
+            log.error("Check that thermistor is properly mounted and functioning.")
+            return
 
-def start(temperature_setpoint):
-    global setpoint
-    global enable
-    global starting_temperature
-    global hbridge
-    setpoint = float(temperature_setpoint)
-    enable = True
-    starting_temperature = t1.get_temperature()
-    hbridge = drv8833(1000, 32, 33, 25, 26, None, None)
-    _thread.start_new_thread(__loop, ())
+        log.info("n: {}, set: {}, temp: {} C, duty: {}", n, setpoint, temperature, u)
+        n += 1
+        await ticker.wait()
+
+
+def _stopped(name):
+    hbridge.emergency_stop()
+    runtime.cancel('thermometers')
+
+
+# returns True if the current temperature slope is abnormal
+def runaway(setpoint, temperature, dTdt, saturated_since, now):
+    if not slope.full:
+        return False
+    if abs(dTdt) > cfg['runaway_max_slope']:
+        return True
+    if saturated_since is None:
+        return False
+    if time.ticks_diff(now, saturated_since) < cfg['runaway_grace'] * 1000:
+        return False
+    # saturated while driving towards the setpoint, so temperature should be moving that way
+    towards = dTdt if pid.output > 0 else -dTdt
+    return towards < cfg['runaway_min_slope']
+
+
+def start(temperature_setpoint, T=None):
+    global pid
+    global slope
+    if runtime.running('p_control'):
+        print("p_control is already running. Use setpoint() to change the temperature.")
+        return
+    if estop.tripped():
+        print("Emergency stop is latched. Call estop.reset() first.")
+        return
+    if T is not None:
+        cfg['T'] = T
+    T = cfg['T']
+    cfg['setpoint'] = float(temperature_setpoint)
+    pid = PID(cfg['kp'], cfg['ki'], cfg['kd'], cfg['kf'], T)
+    slope = RingSlope(max(_MIN_RUNAWAY_WINDOW, int(cfg['runaway_window'] / T)), T)
+    if not runtime.running('thermometers'):
+        runtime.spawn('thermometers', _thermometer_task)
+    log.start()
+    runtime.spawn('p_control', _control_task, on_exit=_stopped)
+
+
+def stop():
+    runtime.cancel('p_control')
+
+
+def _estop(source):
+    runtime.cancel('p_control')
+
+
+estop.register(_estop)
 
 
 def safe_temperature(temperature):
@@ -98,15 +206,4 @@ def safe_temperature(temperature):
 
 
 def setpoint(temperature):
-    global setpoint
-    setpoint = temperature
-
-
-def fix_push(o, value):
-    if len(o) + 1 > _MAX_LIST_SIZE:
-        o.pop(0)
-    try:
-        o.append(value)
-    except MemoryError:
-        hbridge.emergency_stop()
-        raise
+    cfg['setpoint'] = float(temperature)
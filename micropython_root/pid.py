@@ -0,0 +1,75 @@
+"""
+PID controller with setpoint feedforward for the ESP32 running Micropython.
+
+Output is clamped to `output_limits` (default -1 to 1, which maps directly onto
+a DRV8833 duty cycle where the sign selects direction).
+
+Feedforward adds `kf * (setpoint - ff_reference)` to the output. For a heater or
+Peltier element, `ff_reference` is the ambient temperature, so the feedforward
+term supplies the steady-state power needed to hold the setpoint and the PID
+terms only have to correct the remaining error.
+
+The derivative acts on the measurement instead of the error so a setpoint step
+doesn't kick the output, and is low-pass filtered with `d_filter`
+(0 disables filtering, closer to 1 is smoother).
+Integration is paused while the output is saturated (anti-windup).
+
+Usage:
+    pid = PID(kp=0.5, ki=0.02, kd=0.0, kf=0.05, T=0.5)
+    pid.ff_reference = ambient_temperature
+    duty = pid.update(setpoint, temperature)
+
+"""
+
+
+class PID:
+    def __init__(self, kp, ki=0.0, kd=0.0, kf=0.0, T=1.0, output_limits=(-1.0, 1.0), d_filter=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.kf = kf
+        self.T = T  # control period in seconds, used when update() is not given dt
+        self.output_min, self.output_max = output_limits
+        self.d_filter = d_filter
+        self.ff_reference = 0.0
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.previous_measurement = None
+        self.output = 0.0
+        self.saturated = False
+
+    def feedforward(self, setpoint):
+        return self.kf * (setpoint - self.ff_reference)
+
+    def update(self, setpoint, measurement, dt=None):
+        if dt is None:
+            dt = self.T
+        e = setpoint - measurement
+
+        if self.previous_measurement is None or dt <= 0:
+            d = 0.0
+        else:
+            d = -(measurement - self.previous_measurement) / dt
+        self.derivative = self.d_filter * self.derivative + (1 - self.d_filter) * d
+        self.previous_measurement = measurement
+
+        u = self.kp * e + self.ki * self.integral + self.kd * self.derivative
+        u += self.feedforward(setpoint)
+
+        # only integrate when it would not push further into saturation
+        integrate = True
+        if u >= self.output_max:
+            u = self.output_max
+            integrate = e < 0
+        elif u <= self.output_min:
+            u = self.output_min
+            integrate = e > 0
+        self.saturated = u == self.output_max or u == self.output_min
+        if integrate:
+            self.integral += e * dt
+
+        self.output = u
+        return u
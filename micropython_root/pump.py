@@ -1,5 +1,39 @@
-from machine import Pin
+"""
+Pumps and exhaust valve of the ballonet.
+
+Duty changes are ramped instead of applied at once: switching a pump from 0
+to full duty in one step draws a current spike that can brown out the ESP32
+and the I2C sensors. command() (and pump_in/pump_out/stop) only set targets;
+a machine.Timer callback moves the outputs towards them every
+`ramp_period_ms`, at `rise_per_s` going up and `fall_per_s` going down
+(full scale per second).
+
+The ramp also sequences the outputs:
+  - only one pump runs at a time, the other spins down first,
+  - the valve opens at once and the out pump starts `valve_lead_ms` later,
+  - the valve closes only after the out pump has stopped.
+
+emergency_stop() skips the ramp and cuts everything immediately.
+
+Usage:
+    import pump
+    pump.cfg['rise_per_s'] = 2.0  # 0 to full in 0.5 s
+    pump.configure()
+    pump.pump_out(1)
+    pump.settled()  # True once outputs reached the command
+
+"""
+from machine import Pin, Timer
+from micropython import const
+from array import array
+from time import ticks_ms, ticks_diff
 from drv8833 import DRV8833
+import estop
+import trace
+
+_IN = const(0)
+_OUT = const(1)
+_VALVE = const(2)
 
 # args: pwm_frequency, sleep_pin, fault_pin, in1_pin, in2_pin, in3_pin, in4_pin
 hbridge1 = DRV8833(1000, Pin(32), Pin(33), Pin(25), Pin(26), Pin(27), Pin(14))
@@ -12,24 +46,153 @@ hbridge2 = DRV8833(1000, Pin(15), Pin(2), Pin(4), Pin(16), Pin(17), Pin(5))
 # H-Bridge 2 Motor A: Exhaust valve
 #   (NC, check adafruit doc for pneumatic connections)
 
+_in = hbridge1.motor['A']
+_out = hbridge1.motor['B']
+_valve = hbridge2.motor['A']
+_banks = (_in, _out, _valve)
+
+cfg = {
+    'rise_per_s': 4.0,  # full scale per second, going up
+    'fall_per_s': 20.0,  # full scale per second, going down
+    'valve_lead_ms': 100,  # valve open before the out pump starts
+    'ramp_period_ms': 10,
+    'timer': 0,  # hardware timer id
+}
+
+target = array('H', [0, 0, 0])  # commanded duty (0 to 1023) of in, out, valve
+level = array('H', [0, 0, 0])  # duty on the outputs now
+_ramp = {'rise': 0, 'fall': 0, 'running': False, 'valve_opened': 0}
+_timer = None
+
+
+# apply changes to cfg
+def configure():
+    global _timer
+    period = cfg['ramp_period_ms']
+    _ramp['rise'] = max(1, int(cfg['rise_per_s'] * 1023 * period / 1000))
+    _ramp['fall'] = max(1, int(cfg['fall_per_s'] * 1023 * period / 1000))
+    if _timer is None:
+        _timer = Timer(cfg['timer'])
+    if _ramp['running']:
+        _timer.init(period=period, mode=Timer.PERIODIC, callback=_ramp_callback)
+
+
+def _step(now, goal, rise, fall):
+    if now < goal:
+        return min(goal, now + rise)
+    if now > goal:
+        return max(goal, now - fall)
+    return now
+
+
+# Timer callback, moves each output one step towards its target.
+# Integer only, doesn't allocate.
+def _ramp_callback(timer):
+    rise = _ramp['rise']
+    fall = _ramp['fall']
+    # valve opens at once, closes once the out pump has stopped
+    valve = target[_VALVE]
+    if valve > level[_VALVE] or level[_OUT] == 0:
+        if level[_VALVE] == 0 and valve:
+            _ramp['valve_opened'] = ticks_ms()
+        level[_VALVE] = valve
+    # one pump at a time, the out pump also waits for the valve
+    goal = target[_IN] if level[_OUT] == 0 else 0
+    level[_IN] = _step(level[_IN], goal, rise, fall)
+    goal = target[_OUT]
+    if level[_IN]:
+        goal = 0
+    elif valve and ticks_diff(ticks_ms(), _ramp['valve_opened']) < cfg['valve_lead_ms']:
+        goal = 0
+    level[_OUT] = _step(level[_OUT], goal, rise, fall)
+    for i in range(3):
+        _banks[i].set_duty_int(level[i])
+    if settled():
+        _ramp['running'] = False
+        timer.deinit()
+        # command() runs on another thread: if it changed the targets after the
+        # check above it saw running still True and didn't start the timer
+        if not settled():
+            _ramp['running'] = True
+            timer.init(period=cfg['ramp_period_ms'], mode=Timer.PERIODIC, callback=_ramp_callback)
+
+
+def settled():
+    return level[_IN] == target[_IN] and level[_OUT] == target[_OUT] and level[_VALVE] == target[_VALVE]
+
+
+# Set in pump, out pump and valve together, duties from 0 to 1.
+# The outputs get there over the next few ramp periods, see top of file.
+# Calling this every tick with the same command costs a few comparisons.
+def command(in_duty, out_duty, valve_duty):
+    t = trace.enter()
+    try:
+        target[_IN] = min(1023, max(0, int(in_duty * 1024)))
+        target[_OUT] = min(1023, max(0, int(out_duty * 1024)))
+        target[_VALVE] = min(1023, max(0, int(valve_duty * 1024)))
+        if not _ramp['running'] and not settled():
+            _ramp['running'] = True
+            _timer.init(period=cfg['ramp_period_ms'], mode=Timer.PERIODIC, callback=_ramp_callback)
+    finally:
+        trace.exit('pump.command', t)
+
+
 def pump_in(duty=1):
-    hbridge1.motor['A'].duty = duty
-    hbridge1.motor['B'].duty = 0
-    hbridge2.motor['A'].duty = 0
+    command(duty, 0, 0)
 
 
 def pump_out(duty=1):
-    hbridge1.motor['A'].duty = 0
-    hbridge1.motor['B'].duty = duty
-    hbridge2.motor['A'].duty = duty
+    command(0, duty, duty)
 
 
 def stop():
-    hbridge1.motor['A'].duty = 0
-    hbridge1.motor['B'].duty = 0
-    hbridge2.motor['A'].duty = 0
+    command(0, 0, 0)
+
+
+def _clear():
+    _timer.deinit()
+    _ramp['running'] = False
+    for i in range(3):
+        target[i] = 0
+        level[i] = 0
 
 
 def emergency_stop():
+    _clear()
     hbridge1.emergency_stop()
     hbridge2.emergency_stop()
+
+
+# fn(hbridge, active) is called (outside of interrupt context) when either
+# H-bridge reports a fault or recovers from one. Duty is already backed off.
+def add_fault_listener(fn):
+    hbridge1.fault_listeners.append(fn)
+    hbridge2.fault_listeners.append(fn)
+
+
+# total faults and current duty limits, e.g. {'in': 1.0, 'out': 0.5, 'valve': 1.0, 'faults': 3}
+def fault_state():
+    return {
+        'in': _in.duty_limit,
+        'out': _out.duty_limit,
+        'valve': _valve.duty_limit,
+        'faults': hbridge1.fault_count + hbridge2.fault_count,
+        'active': hbridge1.faulted or hbridge2.faulted,
+    }
+
+
+# re-enable the H-bridges after emergency_stop(). Motors come back stopped.
+def reset():
+    _clear()
+    hbridge1.reset()
+    hbridge2.reset()
+
+
+def _estop(source):
+    emergency_stop()
+
+
+configure()
+estop.add_hbridge(hbridge1)
+estop.add_hbridge(hbridge2)
+estop.register(_estop)
@@ -0,0 +1,120 @@
+"""
+Measures how pump duty maps to ballonet fill rate and saves a pumpcurve table.
+
+The balloon is held near neutral buoyancy while the pumps are stepped
+through `levels`. Each step is:
+  rest `rest_s` with the pumps off, velocity v0 from the last `window_s`,
+  run one pump at the level for `step_s`, velocity v1 from the last `window_s`,
+and the flow for that duty is (v1 - v0) / step_s in mm/s^2.
+Every level is run with pump_in and then pump_out, so the ballonet ends up
+about where it started. Altitude comes from the ballonet_controller sensor
+tasks; the controller itself must not be running.
+
+The run is aborted with the pumps stopped if the altitude leaves
+[min_height, max_height].
+
+Usage:
+    import pump_characterize
+    pump_characterize.start()  # runs in the background, prints each step
+    pump_characterize.samples  # (direction, duty, flow) so far
+    pump_characterize.stop()
+When it finishes the table is fitted and saved to pumpcurve.CURVEFILE.
+
+"""
+
+import uasyncio as asyncio
+
+import runtime
+import estop
+import pump
+import pumpcurve
+import ballonet_controller as bc
+from statistics_tools import RingSlope
+
+cfg = {
+    'levels': (0.2, 0.4, 0.6, 0.8, 1.0),  # duties to measure
+    'repeats': 2,
+    'rest_s': 6.0,
+    'step_s': 4.0,
+    'window_s': 2.0,  # seconds of altitude used for each velocity
+    'sample_ms': 100,
+    'min_height': 0.3,  # m above the floor
+    'max_height': 2.5,
+}
+
+samples = []  # (direction, duty, flow in mm/s^2)
+result = None
+_started_sensors = []
+
+
+async def _hold(duration, slope):
+    # keep sampling altitude for `duration` s, returns velocity in m/s
+    ticker = runtime.Ticker(cfg['sample_ms'])
+    for i in range(max(1, int(duration * 1000 / cfg['sample_ms']))):
+        await ticker.wait()
+        meters = bc.altitude_from_readings(cfg['sample_ms'] * 5)
+        if meters is None:
+            raise OSError("no fresh altitude reading")
+        if not cfg['min_height'] <= meters <= cfg['max_height']:
+            raise OSError("altitude {:.2f} m out of bounds".format(meters))
+        slope.push(meters)
+    return slope.slope()
+
+
+async def _characterize_task():
+    global result
+    period = cfg['sample_ms'] / 1000
+    slope = RingSlope(max(2, int(cfg['window_s'] / period)), period)
+    while bc.altitude_from_readings(1000) is None:
+        await asyncio.sleep_ms(50)
+    for repeat in range(cfg['repeats']):
+        for duty in cfg['levels']:
+            for direction, run in (('in', pump.pump_in), ('out', pump.pump_out)):
+                pump.stop()
+                v0 = await _hold(cfg['rest_s'], slope)
+                run(duty)
+                v1 = await _hold(cfg['step_s'], slope)
+                flow = (v1 - v0) * 1000 / cfg['step_s']
+                samples.append((direction, duty, flow))
+                print("{} {}: duty {:.2f}, flow {:7.2f} mm/s^2".format(repeat, direction, duty, flow))
+    pump.stop()
+    result = {name: pumpcurve.fit([(d, f) for n, d, f in samples if n == name]) for name in ('in', 'out')}
+    pumpcurve.save(result)
+    pumpcurve.show(result)
+    print("Saved to " + pumpcurve.CURVEFILE)
+
+
+def _stopped(name):
+    pump.stop()
+    for task in _started_sensors:
+        runtime.cancel(task)
+    del _started_sensors[:]
+
+
+def start():
+    if runtime.running('characterize'):
+        print("Characterization is already running.")
+        return
+    if runtime.running('controller'):
+        print("Stop ballonet_controller first.")
+        return
+    if estop.tripped():
+        print("Emergency stop is latched. Call estop.reset() first.")
+        return
+    del samples[:]
+    if bc.prepare() is None:
+        print("No barometer, can't measure.")
+        return
+    _started_sensors.extend(bc.start_sensors())
+    runtime.spawn('characterize', _characterize_task, on_exit=_stopped)
+
+
+def stop():
+    runtime.cancel('characterize')
+
+
+def _estop(source):
+    runtime.cancel('characterize')
+
+
+estop.register(_estop)
@@ -0,0 +1,112 @@
+"""
+Pump duty to flow lookup, for feedforward.
+
+Flow isn't measured directly; it's the vertical acceleration the pump causes,
+in mm/s^2, which is what the altitude controllers care about. pump_in gives
+negative values (less buoyancy), pump_out positive. Tables are measured with
+pump_characterize.py.
+
+The table for each direction is a list of duties (0 to 1023) with the
+measured flow at each, made monotonic so it can be inverted. On flash it's a
+calstore file holding the duties as uint16 and flows as float32.
+
+Usage:
+    import pumpcurve
+    curves = pumpcurve.load()  # {'in': PUMP_CURVE, 'out': PUMP_CURVE}
+    curves['out'].duty_for(30.0)  # duty from 0 to 1 that gives +30 mm/s^2
+    curves['in'].flow_at(0.5)
+
+"""
+
+from array import array
+import calstore
+
+CURVEFILE = "pump_curve"
+_VERSION = 1
+
+
+class PUMP_CURVE:
+    # duties: increasing, 0 to 1023. flows: same length, monotonic in duty.
+    def __init__(self, duties, flows):
+        if len(duties) != len(flows) or len(duties) < 2:
+            raise ValueError("pump curve needs at least 2 (duty, flow) points")
+        self.duties = array('H', duties)
+        self.flows = array('f', flows)
+        # flows as a non-decreasing array for the inverse lookup
+        self._sign = 1 if self.flows[-1] >= self.flows[0] else -1
+        self._magnitude = array('f', [self._sign * f for f in self.flows])
+
+    # flow at a duty from 0 to 1, interpolated
+    def flow_at(self, duty):
+        d = duty * 1024
+        duties = self.duties
+        if d <= duties[0]:
+            return self.flows[0]
+        for i in range(1, len(duties)):
+            if d <= duties[i]:
+                t = (d - duties[i - 1]) / (duties[i] - duties[i - 1])
+                return self.flows[i - 1] + t * (self.flows[i] - self.flows[i - 1])
+        return self.flows[-1]
+
+    # smallest duty (0 to 1) that gives `flow`, clamped to the table
+    def duty_for(self, flow):
+        m = self._magnitude
+        f = self._sign * flow
+        if f <= m[0]:
+            return self.duties[0] / 1024
+        if f >= m[-1]:
+            return self.duties[-1] / 1024
+        # bisect for the first point at or above f
+        lo = 0
+        hi = len(m) - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if m[mid] < f:
+                lo = mid
+            else:
+                hi = mid
+        t = (f - m[lo]) / (m[hi] - m[lo])
+        return (self.duties[lo] + t * (self.duties[hi] - self.duties[lo])) / 1024
+
+
+# Build a curve from (duty from 0 to 1, flow) samples, e.g. repeated steps.
+# Samples at the same duty are averaged, duty 0 is pinned to zero flow, and
+# the result is made monotonic (each point is at least as far from zero as
+# the one before), which also flattens the dead band at low duty.
+def fit(samples):
+    sums = dict()
+    for duty, flow in samples:
+        d = min(1023, max(0, int(duty * 1024)))
+        entry = sums.setdefault(d, [0.0, 0])
+        entry[0] += flow
+        entry[1] += 1
+    sums[0] = [0.0, 1]
+    duties = sorted(sums)
+    flows = [sums[d][0] / sums[d][1] for d in duties]
+    total = sum(flows)
+    sign = 1 if total >= 0 else -1
+    peak = 0.0
+    for i in range(len(flows)):
+        peak = max(peak, sign * flows[i])
+        flows[i] = sign * peak
+    return PUMP_CURVE(duties, flows)
+
+
+def save(curves, path=CURVEFILE):
+    calstore.save(path, [curves['in'].duties, curves['in'].flows,
+                         curves['out'].duties, curves['out'].flows], version=_VERSION)
+
+
+def load(path=CURVEFILE):
+    arrays = calstore.load(path, version=_VERSION)
+    if arrays is None or len(arrays) != 4:
+        raise ValueError(path + " is missing or not a pump curve file")
+    return {'in': PUMP_CURVE(arrays[0], arrays[1]), 'out': PUMP_CURVE(arrays[2], arrays[3])}
+
+
+def show(curves):
+    for name in ('in', 'out'):
+        curve = curves[name]
+        print(name + ":")
+        for i in range(len(curve.duties)):
+            print("  duty {:5.3f}: {:8.2f} mm/s^2".format(curve.duties[i] / 1024, curve.flows[i]))
@@ -0,0 +1,146 @@
+"""
+Cooperative runtime for sensor, controller and logger tasks using uasyncio.
+
+Every task runs on one uasyncio scheduler, which itself runs in a single
+background thread so the REPL stays usable. Tasks are started and stopped by
+name from anywhere (REPL, other modules) and a name can only run once,
+so calling a controller's start() twice can't launch duplicate loops.
+
+Tasks should never call time.sleep(); wait for sensors with
+`await until(device.data_ready)` and pace loops with `Ticker`.
+
+Sharing the I2C bus between tasks and the REPL thread is handled by i2cbus.
+
+Usage:
+    import runtime
+    runtime.spawn('sensor', my_sensor_task, arg1)   # my_sensor_task is `async def`
+    runtime.running('sensor')  # True
+    runtime.cancel('sensor')
+    runtime.shutdown()  # cancel everything and end the scheduler thread
+
+"""
+
+import _thread
+import uasyncio as asyncio
+from time import ticks_ms, ticks_add, ticks_diff
+
+tasks = dict()  # name: uasyncio Task
+_commands = []  # requests from other threads, handled by the supervisor
+_on_exit = dict()  # name: callback run after the task ends, however it ends
+_wake = asyncio.ThreadSafeFlag()
+_state = {'thread': False}
+
+
+# Schedule `await fn(*args)` as task `name`. Safe to call from any thread.
+# on_exit is called with the task name once the task finishes or is cancelled.
+def spawn(name, fn, *args, on_exit=None):
+    if running(name):
+        raise RuntimeError("task '" + name + "' is already running")
+    _commands.append(('spawn', name, fn, args, on_exit))
+    _ensure_started()
+    _wake.set()
+
+
+def cancel(name):
+    _commands.append(('cancel', name))
+    _wake.set()
+
+
+def running(name):
+    if name in tasks:
+        return True
+    for command in _commands:
+        if command[0] == 'spawn' and command[1] == name:
+            return True
+    return False
+
+
+def shutdown():
+    _commands.append(('shutdown',))
+    _wake.set()
+
+
+async def until(predicate, poll_ms=1, timeout_ms=2000):
+    # Yield to other tasks until predicate() is true
+    start = ticks_ms()
+    while True:
+        if predicate():
+            return
+        if ticks_diff(ticks_ms(), start) > timeout_ms:
+            raise OSError("timed out waiting for " + str(predicate))
+        await asyncio.sleep_ms(poll_ms)
+
+
+# Fixed-rate pacing for periodic tasks. Missed deadlines are skipped, not made up.
+class Ticker:
+    def __init__(self, period_ms):
+        self.period_ms = period_ms
+        self.deadline = ticks_ms()
+        self.overruns = 0
+
+    async def wait(self):
+        self.deadline = ticks_add(self.deadline, self.period_ms)
+        delay = ticks_diff(self.deadline, ticks_ms())
+        if delay < 0:
+            self.overruns += 1
+            self.deadline = ticks_ms()
+            delay = 0
+        await asyncio.sleep_ms(delay)
+
+    # ms until the next deadline, i.e. the idle time if wait() were called now
+    def slack(self):
+        return ticks_diff(ticks_add(self.deadline, self.period_ms), ticks_ms())
+
+
+async def _guard(name, coroutine):
+    try:
+        await coroutine
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print("Task '" + name + "' failed:")
+        import sys
+        sys.print_exception(e)
+    finally:
+        if tasks.get(name) is not None:
+            del tasks[name]
+        callback = _on_exit.pop(name, None)
+        if callback:
+            callback(name)
+
+
+async def _supervisor():
+    while True:
+        await _wake.wait()
+        while _commands:
+            command = _commands.pop(0)
+            if command[0] == 'spawn':
+                name, fn, args, on_exit = command[1:]
+                if on_exit:
+                    _on_exit[name] = on_exit
+                tasks[name] = asyncio.create_task(_guard(name, fn(*args)))
+            elif command[0] == 'cancel':
+                task = tasks.get(command[1])
+                if task:
+                    task.cancel()
+            elif command[0] == 'shutdown':
+                for task in list(tasks.values()):
+                    task.cancel()
+                # let cancelled tasks run their cleanup before the loop ends
+                while tasks:
+                    await asyncio.sleep_ms(0)
+                return
+
+
+def _main():
+    try:
+        asyncio.run(_supervisor())
+    finally:
+        asyncio.new_event_loop()
+        _state['thread'] = False
+
+
+def _ensure_started():
+    if not _state['thread']:
+        _state['thread'] = True
+        _thread.start_new_thread(_main, ())
@@ -0,0 +1,273 @@
+"""
+Framed binary protocol on the USB serial (REPL) link.
+
+Instead of typing Python into the REPL and reading printed lines back, a
+host program (host/serial_link.py) starts serve() once and then exchanges
+small frames: commands, setting reads and writes, and telemetry at the
+controller's tick rate.
+
+On the wire every frame is
+    0x00, COBS(payload), 0x00
+    payload: type (B), sequence (B), body, CRC-16/CCITT-FALSE of all that (<H)
+COBS removes every zero byte from the payload, so a zero always ends a
+frame and the reader can pick up again after any lost byte. Text printed
+by running tasks between frames becomes a frame of its own, which fails
+the CRC; the host shows it as text.
+
+Host to blimp, each answered with the same sequence number:
+    COMMAND   text, as for ballonet_controller.command()  -> ACK
+    GET       a setting name, '' for all                  -> VALUE "name=value ..."
+    SAVE      save the settings                           -> ACK
+    STREAM    B rate in Hz, 0 to stop telemetry            -> ACK
+              (telemetry has one rate, so UDP frames go at it too
+              until serve() returns and puts the old rate back)
+    PING                                                  -> ACK
+    CLOSE     go back to the REPL                         -> ACK
+Blimp to host:
+    HELLO     B protocol version, once when serve() starts
+    ACK       B status (0 ok, 1 failed), then the error text
+    VALUE     text
+    TELEMETRY a telemetry.py frame, sequence 0
+
+Usage (host/serial_link.py types this into the REPL):
+    import serialproto, ballonet_controller
+    serialproto.serve(ballonet_controller.command, ballonet_controller.settings)
+serve() holds the REPL until CLOSE. Ctrl-C is off meanwhile, since 0x03
+can appear inside frames; reset the board if the host goes away.
+
+"""
+
+import sys
+import select
+import ustruct
+from array import array
+import telemetry
+
+VERSION = 1
+
+COMMAND = 0x01
+GET = 0x02
+SAVE = 0x03
+STREAM = 0x04
+PING = 0x05
+CLOSE = 0x7F
+HELLO = 0x80
+ACK = 0x81
+VALUE = 0x82
+TELEMETRY = 0x90
+
+MAX_PAYLOAD = 300
+_MAX_ERROR = 64
+_SLOTS = 4  # telemetry frames waiting for serve() to write them
+_POLL_MS = 5  # longest a waiting frame sits there while the host is quiet
+
+
+def _crc_table():
+    table = array('H', [0] * 256)
+    for i in range(256):
+        c = i << 8
+        for bit in range(8):
+            c = ((c << 1) ^ 0x1021) if c & 0x8000 else c << 1
+        table[i] = c & 0xFFFF
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+# CRC-16/CCITT-FALSE
+def crc16(data, crc=0xFFFF):
+    table = _CRC_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+def cobs_encode(data):
+    out = bytearray(1)
+    code_index = 0
+    code = 1
+    for b in data:
+        if b:
+            out.append(b)
+            code += 1
+        if not b or code == 0xFF:
+            out[code_index] = code
+            code_index = len(out)
+            out.append(0)
+            code = 1
+    out[code_index] = code
+    return bytes(out)
+
+
+def cobs_decode(data):
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        end = i + code
+        if code == 0 or end > n:
+            raise ValueError("bad COBS block")
+        out.extend(data[i + 1:end])
+        i = end
+        if code < 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+
+# A whole frame, delimiters included, ready to write
+def encode(kind, sequence, body=b''):
+    payload = bytes((kind, sequence & 0xFF)) + body
+    return b'\x00' + cobs_encode(payload + ustruct.pack('<H', crc16(payload))) + b'\x00'
+
+
+# Payload between two delimiters to (type, sequence, body). Raises ValueError if damaged.
+def decode(data):
+    payload = cobs_decode(data)
+    if len(payload) < 4:
+        raise ValueError("short frame")
+    if crc16(payload[:-2]) != ustruct.unpack('<H', payload[-2:])[0]:
+        raise ValueError("bad CRC")
+    return payload[0], payload[1], payload[2:-2]
+
+
+# Splits a byte stream into frames. feed() returns a list with a
+# (type, sequence, body) tuple for each good frame and the raw bytes of each
+# damaged one (usually printed text).
+class DECODER:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._overflow = False
+
+    def feed(self, data):
+        frames = []
+        for b in data:
+            if b:
+                if len(self._buffer) < 2 * MAX_PAYLOAD:
+                    self._buffer.append(b)
+                else:
+                    self._overflow = True
+                continue
+            if not self._buffer:
+                continue
+            raw = bytes(self._buffer)
+            self._buffer = bytearray()
+            if self._overflow:
+                self._overflow = False
+                frames.append(raw)
+                continue
+            try:
+                frames.append(decode(raw))
+            except ValueError:
+                frames.append(raw)
+        return frames
+
+
+# The output side of serve(), which does all the writing. Telemetry frames
+# come from the controller's thread: telemetry() only copies them into a
+# preallocated slot, so the tick never waits on encoding or the UART, and
+# serve() writes them out between reads. A frame that finds every slot
+# full is dropped and counted.
+class _LINK:
+    def __init__(self, stream):
+        self.stream = stream
+        self.slots = [bytearray(telemetry.FRAME_SIZE) for i in range(_SLOTS)]
+        self.head = 0  # next slot telemetry() fills
+        self.tail = 0  # next slot write_telemetry() sends
+        self.dropped = 0
+
+    def send(self, kind, sequence, body=b''):
+        self.stream.write(encode(kind, sequence, body))
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    # The telemetry sink. One producer and one consumer, each moving only
+    # its own index after the slot copy, so this needs no lock.
+    def telemetry(self, frame):
+        if self.head - self.tail >= _SLOTS:
+            self.dropped += 1
+            return
+        self.slots[self.head % _SLOTS][:] = frame
+        self.head += 1
+
+    def write_telemetry(self):
+        while self.tail != self.head:
+            self.send(TELEMETRY, 0, bytes(self.slots[self.tail % _SLOTS]))
+            self.tail += 1
+
+
+def _values(settings, name):
+    if settings is None:
+        raise ValueError("no settings")
+    names = settings.order if name == '' else (name,)
+    return " ".join("{}={}".format(n, settings.values[n]) for n in names)
+
+
+# Returns False when the host asked to close
+def _handle(link, frame, command, settings):
+    kind, sequence, body = frame
+    status = 0
+    error = b''
+    try:
+        if kind == COMMAND:
+            command(body.decode())
+        elif kind == GET:
+            link.send(VALUE, sequence, _values(settings, body.decode()).encode())
+            return True
+        elif kind == SAVE:
+            if settings is None:
+                raise ValueError("no settings")
+            settings.save()
+        elif kind == STREAM:
+            if body and body[0]:
+                telemetry.set_rate(body[0])
+                telemetry.add_sink(link.sink)
+            else:
+                telemetry.remove_sink(link.sink)
+        elif kind == CLOSE:
+            link.send(ACK, sequence, b'\x00')
+            return False
+        elif kind != PING:
+            raise ValueError("unknown frame type {}".format(kind))
+    except Exception as e:
+        status = 1
+        error = str(e).encode()[:_MAX_ERROR]
+    link.send(ACK, sequence, bytes((status,)) + error)
+    return True
+
+
+# Answer frames from the host until it sends CLOSE or the input ends.
+# command(text) runs COMMAND frames; settings is the CONFIG for GET and SAVE.
+# stdin and stdout default to the REPL's; tests pass other streams.
+def serve(command, settings=None, stdin=None, stdout=None):
+    repl = stdin is None
+    if repl:
+        import micropython
+        stdin = sys.stdin.buffer
+        stdout = sys.stdout.buffer
+        micropython.kbd_intr(-1)
+    link = _LINK(stdout)
+    link.sink = link.telemetry
+    decoder = DECODER()
+    poller = select.poll()
+    poller.register(sys.stdin if repl else stdin, select.POLLIN)  # stdin.buffer reads the same stream
+    rate_hz = telemetry.cfg['rate_hz']  # STREAM changes it for UDP too
+    try:
+        link.send(HELLO, 0, bytes((VERSION,)))
+        while True:
+            link.write_telemetry()
+            if not poller.poll(_POLL_MS):
+                continue
+            data = stdin.read(1)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                if type(frame) is tuple and not _handle(link, frame, command, settings):
+                    return
+    finally:
+        telemetry.remove_sink(link.sink)
+        if telemetry.cfg['rate_hz'] != rate_hz:
+            telemetry.set_rate(rate_hz)
+        if repl:
+            micropython.kbd_intr(3)
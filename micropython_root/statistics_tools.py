@@ -1,3 +1,6 @@
+import trace
+
+
 def mean(m):  # polyfill because Micropython has no module 'statistics'
     return sum(m) / len(m)
 
@@ -14,22 +17,95 @@ def abs_fwd_timegraph(list_, s):
 # calculates the slope of a linear regression of past n pairs
 # based on https://stackoverflow.com/a/19040841/2712730
 def linreg_past(x, y, n, compute_correlation=False):
-    sumx = sum(x[-n:])
-    sumx2 = sum([i**2 for i in x[-n:]])
-    sumy = sum(y[-n:])
-    sumy2 = sum([i**2 for i in y[-n:]])
-    sumxy = sum([i * j for i, j in zip(x[-n:], y[-n:])])
-    denom = n * sumx2 - sumx**2
-
-    m = (n * sumxy - sumx * sumy) / denom
-    b = (sumy * sumx2 - sumx * sumxy) / denom
-
-    if compute_correlation:
-        r = (
-            (sumxy - sumx * sumy / n)
-            / ((sumx2 - sumx**2)**0.5 / n)
-            * (sumy2 - sumy**2 / n)
-        )
-    else:
-        r = None
-    return (m, b, r)
+    t = trace.enter()
+    try:
+        sumx = sum(x[-n:])
+        sumx2 = sum([i**2 for i in x[-n:]])
+        sumy = sum(y[-n:])
+        sumy2 = sum([i**2 for i in y[-n:]])
+        sumxy = sum([i * j for i, j in zip(x[-n:], y[-n:])])
+        denom = n * sumx2 - sumx**2
+
+        m = (n * sumxy - sumx * sumy) / denom
+        b = (sumy * sumx2 - sumx * sumxy) / denom
+
+        if compute_correlation:
+            r = (
+                (sumxy - sumx * sumy / n)
+                / ((sumx2 - sumx**2)**0.5 / n)
+                * (sumy2 - sumy**2 / n)
+            )
+        else:
+            r = None
+        return (m, b, r)
+    finally:
+        trace.exit('statistics_tools.linreg_past', t)
+
+
+# Streaming least-squares slope over the last n evenly spaced samples.
+# Keeps running sums so each push is O(1), which makes it cheap enough to
+# run every control tick (e.g. dT/dt for thermal runaway detection).
+# Samples are assumed to be taken every `period` seconds.
+class RingSlope:
+    def __init__(self, n, period=1.0):
+        if n < 2:
+            raise ValueError("RingSlope needs at least 2 samples")
+        from array import array
+        self.n = n
+        self.period = period
+        self.ring = array('f', [0.0] * n)
+        self.reset()
+
+    def reset(self):
+        for i in range(self.n):
+            self.ring[i] = 0.0
+        self.head = 0  # index of the oldest sample
+        self.count = 0
+        self._s = 0.0  # sum of y
+        self._w = 0.0  # sum of i * y, i = 0 for oldest sample
+
+    def push(self, y):
+        n = self.n
+        if self.count < n:
+            self.ring[self.count] = y
+            self._w += self.count * y
+            self._s += y
+            self.count += 1
+            return
+        oldest = self.ring[self.head]
+        self.ring[self.head] = y
+        self.head = (self.head + 1) % n
+        # shift every index down by one, drop oldest, append newest at n - 1
+        self._w += -(self._s - oldest) + (n - 1) * y
+        self._s += y - oldest
+        if self.head == 0:
+            # re-sum once per lap so float rounding can't accumulate
+            self._resum()
+
+    def _resum(self):
+        s = 0.0
+        w = 0.0
+        for i in range(self.n):
+            y = self.ring[(self.head + i) % self.n]
+            s += y
+            w += i * y
+        self._s = s
+        self._w = w
+
+    @property
+    def full(self):
+        return self.count >= self.n
+
+    @property
+    def last(self):
+        if self.count < self.n:
+            return self.ring[self.count - 1]
+        return self.ring[(self.head - 1) % self.n]
+
+    # slope in units per second. Returns 0 until two samples are available.
+    def slope(self):
+        n = self.count
+        if n < 2:
+            return 0.0
+        denom = n * (n * n - 1) / 12
+        return (self._w - self._s * (n - 1) / 2) / denom / self.period
@@ -0,0 +1,232 @@
+"""
+Binary telemetry frames over UDP.
+
+Controllers call publish() every tick. Frames go out at most `rate_hz`
+times per second (ticks in between are skipped), are packed into one
+preallocated buffer and sent on a non-blocking socket. A send that would
+block or fails is dropped and counted, never retried, so publish() can't
+stretch a control tick.
+
+By default frames are broadcast on the access point's subnet (see
+boot.start_ap), so any laptop joined to it can listen without the blimp
+knowing its address. host/telemetry_receiver.py decodes them.
+
+Frames are sent from cfg['command_port'], where the blimp also takes
+commands: a datagram of COMMAND (magic b'BC', version, sequence) followed
+by the command text, e.g. b'setpoint=40'. poll() hands the text to a
+handler and answers with ACK (magic b'BA', version, vehicle, sequence,
+status 0 or 1) followed by the error text, if any. A repeated sequence
+number gets the same answer without running the command again, so a
+sender can retry until it gets an ACK. host/ground_station.py uses this.
+
+Frame layout, little-endian, FRAME_SIZE bytes:
+    magic        2s  b'BT'
+    version      B
+    vehicle      B   cfg['vehicle'], to tell blimps apart
+    sequence     H   frame counter, gaps mean lost frames
+    ticks_ms     I
+    altitude     f   m above the floor
+    velocity     f   mm/s
+    setpoint     f   mm/s
+    source       B   altitude source, see altitude.SOURCE_NAMES
+    duty         h   pump duty, 1023 pumping in (sinking) to -1023 pumping out
+    temperature  ff  see `temperatures`, NaN when unused
+    faults       H   pump driver faults so far
+
+Usage:
+    import telemetry
+    telemetry.cfg['rate_hz'] = 10
+    telemetry.start()
+    telemetry.publish(altitude, velocity, setpoint, source, duty)
+    telemetry.poll(handler)  # every tick, handler(text) runs a command
+    telemetry.stats  # sent, dropped
+    telemetry.add_sink(fn)  # fn(frame) also gets every frame, e.g. serialproto
+    telemetry.stop()
+
+"""
+
+import socket
+import ustruct
+from array import array
+from time import ticks_ms, ticks_add, ticks_diff
+
+VERSION = 1
+FRAME = '<2sBBHIfffBhffH'
+FRAME_SIZE = ustruct.calcsize(FRAME)
+MAGIC = b'BT'
+PORT = 5005
+COMMAND = '<2sBH'  # then the command text
+COMMAND_SIZE = ustruct.calcsize(COMMAND)
+COMMAND_MAGIC = b'BC'
+ACK = '<2sBBHB'  # then the error text
+ACK_SIZE = ustruct.calcsize(ACK)
+ACK_MAGIC = b'BA'
+_MAX_COMMAND = 256
+_MAX_ERROR = 64
+
+cfg = {
+    'host': '192.168.4.255',  # AP subnet broadcast
+    'port': PORT,
+    'command_port': PORT + 1,
+    'rate_hz': 10,
+    'vehicle': 0,
+}
+
+# extra channels filled in by whatever measures them, e.g. p_control
+temperatures = array('f', [float('nan'), float('nan')])
+faults = array('H', [0])
+
+stats = {'sent': 0, 'dropped': 0}
+_buffer = bytearray(FRAME_SIZE)
+_sinks = []
+_state = {'socket': None, 'address': None, 'period_ms': 100, 'last': 0, 'sequence': 0,
+          'command': None, 'ack': None}  # last command sequence and its ACK
+
+
+def start():
+    stop()
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    except (AttributeError, OSError):
+        pass  # not every port has SO_BROADCAST
+    s.bind(socket.getaddrinfo('0.0.0.0', cfg['command_port'])[0][-1])
+    s.setblocking(False)
+    _state['socket'] = s
+    _state['address'] = socket.getaddrinfo(cfg['host'], cfg['port'])[0][-1]
+    _state['period_ms'] = int(1000 / cfg['rate_hz'])
+    _state['last'] = ticks_add(ticks_ms(), -_state['period_ms'])
+
+
+def stop():
+    s = _state['socket']
+    _state['socket'] = None
+    if s is not None:
+        s.close()
+
+
+def running():
+    return _state['socket'] is not None
+
+
+def set_rate(rate_hz):
+    cfg['rate_hz'] = rate_hz
+    _state['period_ms'] = int(1000 / rate_hz)
+
+
+# fn(frame) is called with every frame published, socket or not, e.g. by
+# serialproto. It runs in the publishing task, so it must be quick, and must
+# copy the frame if it keeps it.
+def add_sink(fn):
+    if fn not in _sinks:
+        _sinks.append(fn)
+
+
+def remove_sink(fn):
+    if fn in _sinks:
+        _sinks.remove(fn)
+
+
+# Returns True if a frame went out
+def publish(altitude, velocity, setpoint, source, duty):
+    s = _state['socket']
+    if s is None and not _sinks:
+        return False
+    now = ticks_ms()
+    if ticks_diff(now, _state['last']) < _state['period_ms']:
+        return False
+    _state['last'] = now
+    sequence = _state['sequence']
+    _state['sequence'] = (sequence + 1) & 0xFFFF
+    ustruct.pack_into(FRAME, _buffer, 0, MAGIC, VERSION, cfg['vehicle'], sequence, now,
+                      altitude, velocity, setpoint, source, duty,
+                      temperatures[0], temperatures[1], faults[0])
+    for sink in _sinks:
+        sink(_buffer)
+    if s is None:
+        return True
+    try:
+        s.sendto(_buffer, _state['address'])
+    except OSError:
+        stats['dropped'] += 1
+        return False
+    stats['sent'] += 1
+    return True
+
+
+# Runs up to `limit` waiting commands with handler(text) and ACKs them.
+# Returns the number of commands seen.
+def poll(handler, limit=2):
+    s = _state['socket']
+    if s is None:
+        return 0
+    seen = 0
+    while seen < limit:
+        try:
+            data, address = s.recvfrom(_MAX_COMMAND)
+        except OSError:
+            break  # nothing waiting
+        if len(data) < COMMAND_SIZE:
+            continue
+        magic, version, sequence = ustruct.unpack_from(COMMAND, data)
+        if magic != COMMAND_MAGIC or version != VERSION:
+            continue
+        seen += 1
+        if sequence != _state['command']:
+            try:
+                handler(data[COMMAND_SIZE:].decode())
+                status, error = 0, b''
+            except Exception as e:
+                status, error = 1, str(e).encode()[:_MAX_ERROR]
+            _state['command'] = sequence
+            _state['ack'] = encode_ack(cfg['vehicle'], sequence, status, error)
+        try:
+            s.sendto(_state['ack'], address)
+        except OSError:
+            stats['dropped'] += 1
+    return seen
+
+
+# A whole frame as bytes, for tools and simulators; publish() packs in place
+def encode(vehicle, sequence, ticks, altitude, velocity, setpoint, source, duty, temperatures, faults):
+    return ustruct.pack(FRAME, MAGIC, VERSION, vehicle, sequence, ticks, altitude, velocity,
+                        setpoint, source, duty, temperatures[0], temperatures[1], faults)
+
+
+def encode_ack(vehicle, sequence, status, error=b''):
+    return ustruct.pack(ACK, ACK_MAGIC, VERSION, vehicle, sequence, status) + error
+
+
+def encode_command(sequence, text):
+    return ustruct.pack(COMMAND, COMMAND_MAGIC, VERSION, sequence & 0xFFFF) + text.encode()
+
+
+# ACK bytes to (vehicle, sequence, status, error text), None if it isn't an ACK
+def decode_ack(data):
+    if len(data) < ACK_SIZE or data[:2] != ACK_MAGIC:
+        return None
+    magic, version, vehicle, sequence, status = ustruct.unpack_from(ACK, data)
+    if version != VERSION:
+        return None
+    return vehicle, sequence, status, data[ACK_SIZE:].decode()
+
+
+# Frame bytes to a dict, None if it isn't a telemetry frame
+def decode(frame):
+    if len(frame) != FRAME_SIZE or frame[:2] != MAGIC:
+        return None
+    values = ustruct.unpack(FRAME, frame)
+    if values[1] != VERSION:
+        return None
+    return {
+        'vehicle': values[2],
+        'sequence': values[3],
+        'ticks_ms': values[4],
+        'altitude': values[5],
+        'velocity': values[6],
+        'setpoint': values[7],
+        'source': values[8],
+        'duty': values[9],
+        'temperatures': (values[10], values[11]),
+        'faults': values[12],
+    }
@@ -0,0 +1,254 @@
+"""
+Timing spans for finding where a control tick's time goes.
+
+Instrumented code brackets a stage with
+    t = trace.enter()
+    try:
+        ...
+    finally:
+        trace.exit('bmp388.get_data', t)
+which records the name, start and duration in microseconds into a fixed
+ring (the newest cfg['size'] spans). The finally matters: a stage that
+raises, e.g. on a sensor timeout, is often the one worth seeing. Names
+must be string literals so recording allocates nothing. Tracing is off
+until start(); while off, enter() and exit() return at once. A span
+entered while tracing was off isn't recorded, even if start() is called
+before it exits.
+
+Spans are recorded without a lock, so they are safe from timer callbacks;
+two threads finishing spans at the same instant can, rarely, overwrite
+each other's slot.
+
+Nesting isn't tracked while recording. report() works it out afterwards:
+a span is inside another if the other started no later and ended no
+earlier. From that it prints
+  - per stage: count, mean, max and total time, and time not spent in
+    nested stages (self time)
+  - a flame-style summary: each stack of nested stages with its self time,
+    in the "collapsed" format flamegraph.pl and speedscope read.
+
+Usage:
+    import trace
+    trace.start()
+    ...fly for a while...
+    trace.report()
+    trace.dump("trace.bin")  # for host/trace_report.py
+    trace.stop()
+
+"""
+
+import ustruct
+from array import array
+from time import ticks_us, ticks_diff
+
+_PERIOD = 1 << 30  # ticks_us wraps here
+_OFF = -1  # enter() while off; never a ticks_us value
+_MAGIC = b'TRC1'
+_HEADER = '<4sHH'  # magic, number of names, number of spans
+_SPAN = '<HII'  # name index, start, duration
+
+cfg = {'size': 256}
+
+_state = {'enabled': False, 'next': 0, 'count': 0}
+
+
+def _allocate(size):
+    global _names, _starts, _durations
+    cfg['size'] = size
+    _names = [None] * size
+    _starts = array('I', [0] * size)
+    _durations = array('I', [0] * size)
+    _state['next'] = 0
+    _state['count'] = 0
+
+
+_allocate(cfg['size'])
+
+
+def enter():
+    if not _state['enabled']:
+        return _OFF
+    return ticks_us()
+
+
+def exit(name, start):
+    if not _state['enabled'] or start == _OFF:
+        return
+    duration = ticks_diff(ticks_us(), start)
+    i = _state['next']
+    _state['next'] = i + 1 if i + 1 < cfg['size'] else 0
+    _names[i] = name
+    _starts[i] = start
+    _durations[i] = duration
+    if _state['count'] < cfg['size']:
+        _state['count'] += 1
+
+
+# Decorator for functions that aren't on a hot path; the wrapper allocates
+# its argument tuple on every call.
+def span(name):
+    def decorate(fn):
+        def wrapper(*args, **kwargs):
+            t = enter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                exit(name, t)
+        return wrapper
+    return decorate
+
+
+# Clears the ring and starts recording. `size` reallocates it.
+def start(size=None):
+    _state['enabled'] = False
+    if size is not None and size != cfg['size']:
+        _allocate(size)
+    clear()
+    _state['enabled'] = True
+
+
+def stop():
+    _state['enabled'] = False
+
+
+def clear():
+    _state['next'] = 0
+    _state['count'] = 0
+
+
+# The recorded spans, oldest first, as a list of (name, start, duration)
+def spans():
+    count = _state['count']
+    size = cfg['size']
+    first = _state['next'] - count
+    if first < 0:
+        first += size
+    result = []
+    for k in range(count):
+        i = (first + k) % size
+        result.append((_names[i], _starts[i], _durations[i]))
+    return result
+
+
+def dump(path):
+    recorded = spans()
+    names = []
+    for name, start, duration in recorded:
+        if name not in names:
+            names.append(name)
+    with open(path, 'wb') as f:
+        f.write(ustruct.pack(_HEADER, _MAGIC, len(names), len(recorded)))
+        for name in names:
+            encoded = name.encode()
+            f.write(bytes((len(encoded),)) + encoded)
+        for name, start, duration in recorded:
+            f.write(ustruct.pack(_SPAN, names.index(name), start, duration))
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, name_count, span_count = ustruct.unpack_from(_HEADER, data)
+    if magic != _MAGIC:
+        raise ValueError(path + " is not a trace dump")
+    offset = ustruct.calcsize(_HEADER)
+    names = []
+    for k in range(name_count):
+        length = data[offset]
+        names.append(data[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+    size = ustruct.calcsize(_SPAN)
+    recorded = []
+    for k in range(span_count):
+        index, start, duration = ustruct.unpack_from(_SPAN, data, offset + k * size)
+        recorded.append((names[index], start, duration))
+    return recorded
+
+
+# Each span with its stack of enclosing stages and its self time:
+# a list of (stack, duration, self time), stack being a tuple of names,
+# outermost first. Times are in microseconds.
+def nest(recorded):
+    if not recorded:
+        return []
+    base = recorded[0][1]
+    # starts relative to the first span to finish, unwrapped; longest first so parents come before children
+    ordered = sorted(((_relative(start, base), -duration, name) for name, start, duration in recorded))
+    result = []
+    open_spans = []  # [end, stack, duration, nested time] of spans that contain the current one
+    for start, negative_duration, name in ordered:
+        duration = -negative_duration
+        end = start + duration
+        while open_spans and open_spans[-1][0] < end:
+            _close(open_spans.pop(), result)
+        if open_spans:
+            parent = open_spans[-1]
+            parent[3] += duration
+            stack = parent[1] + (name,)
+        else:
+            stack = (name,)
+        open_spans.append([end, stack, duration, 0])
+    while open_spans:
+        _close(open_spans.pop(), result)
+    return result
+
+
+def _relative(ticks, base):
+    d = (ticks - base) % _PERIOD
+    return d - _PERIOD if d >= _PERIOD // 2 else d
+
+
+def _close(entry, result):
+    end, stack, duration, nested = entry
+    result.append((stack, duration, max(0, duration - nested)))
+
+
+# {name: [count, total, max, self total]} in microseconds
+def breakdown(nested):
+    stages = dict()
+    for stack, duration, self_time in nested:
+        stage = stages.setdefault(stack[-1], [0, 0, 0, 0])
+        stage[0] += 1
+        stage[1] += duration
+        stage[2] = max(stage[2], duration)
+        stage[3] += self_time
+    return stages
+
+
+# {"outer;inner": self time} as flamegraph.pl's collapsed stacks
+def collapse(nested):
+    stacks = dict()
+    for stack, duration, self_time in nested:
+        key = ";".join(stack)
+        stacks[key] = stacks.get(key, 0) + self_time
+    return stacks
+
+
+def format_report(recorded):
+    nested = nest(recorded)
+    if not nested:
+        return ["no spans recorded"]
+    stages = breakdown(nested)
+    total_self = sum(stage[3] for stage in stages.values()) or 1
+    lines = ["{:32} {:>6} {:>9} {:>9} {:>10} {:>10} {:>6}".format(
+        "stage", "count", "mean us", "max us", "total us", "self us", "self%")]
+    for name in sorted(stages, key=lambda n: -stages[n][1]):
+        count, total, longest, self_total = stages[name]
+        lines.append("{:32} {:6d} {:9.0f} {:9d} {:10d} {:10d} {:5.1f}%".format(
+            name[:32], count, total / count, longest, total, self_total, 100 * self_total / total_self))
+    lines.append("")
+    lines.append("stacks (self time):")
+    stacks = collapse(nested)
+    for key in sorted(stacks, key=lambda k: -stacks[k]):
+        lines.append("  {} {}".format(key, stacks[key]))
+    return lines
+
+
+def report():
+    was_enabled = _state['enabled']
+    _state['enabled'] = False  # don't record while reading the ring
+    try:
+        for line in format_report(spans()):
+            print(line)
+    finally:
+        _state['enabled'] = was_enabled
@@ -12,6 +12,7 @@ due to movement and uses that to calculate the current velocity.
 import bno055 as bno
 from time import sleep
 import pump
+import estop
 
 ctrl = 1
 delta = 0.6
@@ -37,16 +38,27 @@ def velocity(i2c, address):
 
 
 def stop():
+    global ctrl
     ctrl = 0
     pump.stop()
     return 0
 
 
 def start():
+    global ctrl
     ctrl = 1
     return 0
 
 
 def set_sample_rate(x):
+    global delta
     delta = x
     return 0
+
+
+def _estop(source):
+    global ctrl
+    ctrl = 0
+
+
+estop.register(_estop)
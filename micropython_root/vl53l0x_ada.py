@@ -31,6 +31,7 @@ Implementation Notes
 """
 import math
 import utime
+import vl53l0x_cal
 
 # import adafruit_bus_device.i2c_device as i2c_device
 from micropython import const
@@ -138,7 +139,8 @@ class VL53L0X:
     # thread safe!
     _BUFFER = bytearray(3)
 
-    def __init__(self, i2c, address=41, io_timeout_s=0):
+    # recalibrate: measure SPADs and reference calibration even if they're cached
+    def __init__(self, i2c, address=41, io_timeout_s=0, recalibrate=False):
         # pylint: disable=too-many-statements
         self._i2c = i2c
         self.address = address
@@ -170,7 +172,13 @@ class VL53L0X:
         # second)
         self.signal_rate_limit = 0.25
         self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0xFF)
-        spad_count, spad_is_aperture = self._get_spad_info()
+        # SPAD info and reference calibration are cached per sensor, see vl53l0x_cal.py
+        self.uid = vl53l0x_cal.read_uid(self._i2c, self.address)
+        cached = None if recalibrate else vl53l0x_cal.lookup(self.uid)
+        if cached:
+            spad_count, spad_is_aperture = cached[0], cached[1]
+        else:
+            spad_count, spad_is_aperture = self._get_spad_info()
         # The SPAD map (RefGoodSpadMap) is read by
         # VL53L0X_get_info_from_device() in the API, but the same data seems to
         # be more easily readable from GLOBAL_CONFIG_SPAD_ENABLES_REF_0 through
@@ -291,10 +299,16 @@ class VL53L0X:
         self._measurement_timing_budget_us = self.measurement_timing_budget
         self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0xE8)
         self.measurement_timing_budget = self._measurement_timing_budget_us
-        self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0x01)
-        self._perform_single_ref_calibration(0x40)
-        self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0x02)
-        self._perform_single_ref_calibration(0x00)
+        if cached:
+            vl53l0x_cal.write_ref_calibration(self._i2c, self.address, cached[2], cached[3])
+        else:
+            self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0x01)
+            self._perform_single_ref_calibration(0x40)
+            self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0x02)
+            self._perform_single_ref_calibration(0x00)
+            vhv, phase = vl53l0x_cal.read_ref_calibration(self._i2c, self.address)
+            vl53l0x_cal.save(self.uid, spad_count, spad_is_aperture, vhv, phase)
+        self.calibration_cached = bool(cached)
         # "restore the previous Sequence Config"
         self._write_u8(_SYSTEM_SEQUENCE_CONFIG, 0xE8)
 
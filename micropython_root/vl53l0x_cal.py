@@ -0,0 +1,144 @@
+"""
+Calibration cache for the VL53L0X drivers (VL53L0X.py and vl53l0x_ada.py).
+
+A cold start of a VL53L0X reads the reference SPAD count and type from the
+sensor's NVM, then runs two reference calibrations (VHV and phase), each a
+full measurement with polling. The results only change with the part and,
+slowly, with temperature, so they are saved here keyed by the sensor's
+unique ID (also read from NVM) and written back on later boots instead of
+being measured again.
+
+CALFILE is a calstore file with one byte array of records, each
+    uid (8 bytes), spad count, spad is aperture, vhv settings, phase cal, checksum
+Records that fail the checksum or a range check are ignored and measured again.
+
+To force fresh calibration, e.g. after a big temperature change, pass
+recalibrate=True to the driver or call forget().
+
+"""
+
+import errno
+import ustruct
+import utime
+from array import array
+from i2cbus import batch
+import calstore
+
+CALFILE = "vl53l0x_cal"
+
+_RECORD = '<8sBBBBB'
+_RECORD_SIZE = ustruct.calcsize(_RECORD)
+_IO_TIMEOUT = 2000
+_VERSION = 1
+
+# NVM locations, written to 0x94 to select the word that appears at 0x90
+NVM_SPAD = 0x6B
+NVM_UID_HIGH = 0x7B
+NVM_UID_LOW = 0x7C
+
+
+def _write(i2c, address, *pairs):
+    for register, value in pairs:
+        i2c.writeto_mem(address, register, bytes((value,)))
+
+
+def _read(i2c, address, register):
+    return i2c.readfrom_mem(address, register, 1)[0]
+
+
+# Returns the 4-byte NVM words at `locations`, in one NVM session.
+# Based on VL53L0X_get_info_from_device() in the ST API.
+def read_nvm(i2c, address, locations):
+    words = []
+    with batch(i2c):
+        _write(i2c, address, (0x80, 0x01), (0xFF, 0x01), (0x00, 0x00), (0xFF, 0x06))
+        _write(i2c, address, (0x83, _read(i2c, address, 0x83) | 0x04))
+        _write(i2c, address, (0xFF, 0x07), (0x81, 0x01), (0x80, 0x01))
+        for location in locations:
+            _write(i2c, address, (0x94, location), (0x83, 0x00))
+            for timeout in range(_IO_TIMEOUT):
+                if _read(i2c, address, 0x83):
+                    break
+                utime.sleep_ms(1)
+            else:
+                raise OSError(errno.ETIMEDOUT)  # no builtin TimeoutError on MicroPython
+            _write(i2c, address, (0x83, 0x01))
+            words.append(i2c.readfrom_mem(address, 0x90, 4))
+        _write(i2c, address, (0x81, 0x00), (0xFF, 0x06))
+        _write(i2c, address, (0x83, _read(i2c, address, 0x83) & ~0x04 & 0xFF))
+        _write(i2c, address, (0xFF, 0x01), (0x00, 0x01), (0xFF, 0x00), (0x80, 0x00))
+    return words
+
+
+def read_uid(i2c, address):
+    words = read_nvm(i2c, address, (NVM_UID_HIGH, NVM_UID_LOW))
+    return words[0] + words[1]
+
+
+# VHV settings and phase calibration, see VL53L0X_ref_calibration_io() in the ST API
+def read_ref_calibration(i2c, address):
+    with batch(i2c):
+        _write(i2c, address, (0xFF, 0x01), (0x00, 0x00), (0xFF, 0x00))
+        vhv = _read(i2c, address, 0xCB)
+        phase = _read(i2c, address, 0xEE) & 0xEF
+        _write(i2c, address, (0xFF, 0x01), (0x00, 0x01), (0xFF, 0x00))
+    return vhv, phase
+
+
+def write_ref_calibration(i2c, address, vhv, phase):
+    with batch(i2c):
+        _write(i2c, address, (0xFF, 0x01), (0x00, 0x00), (0xFF, 0x00))
+        _write(i2c, address, (0xCB, vhv))
+        _write(i2c, address, (0xEE, (_read(i2c, address, 0xEE) & 0x80) | phase))
+        _write(i2c, address, (0xFF, 0x01), (0x00, 0x01), (0xFF, 0x00))
+
+
+def _checksum(data):
+    c = 0x5A
+    for b in data:
+        c = ((c << 1) | (c >> 7)) & 0xFF
+        c ^= b
+    return c
+
+
+def _records():
+    arrays = calstore.load(CALFILE, version=_VERSION)
+    if not arrays:
+        return []
+    data = bytes(arrays[0])
+    records = []
+    for offset in range(0, len(data) - _RECORD_SIZE + 1, _RECORD_SIZE):
+        record = data[offset:offset + _RECORD_SIZE]
+        if _checksum(record[:-1]) == record[-1]:
+            records.append(record)
+    return records
+
+
+# Returns (spad count, spad is aperture, vhv, phase) for the sensor with `uid`,
+# or None if there's no valid record
+def lookup(uid):
+    for record in _records():
+        r_uid, count, aperture, vhv, phase, check = ustruct.unpack(_RECORD, record)
+        if r_uid != uid:
+            continue
+        # there are 44 reference SPADs; a VHV setting of 0 means calibration never ran
+        if not 0 < count <= 44 or aperture > 1 or vhv == 0:
+            return None
+        return count, bool(aperture), vhv, phase
+    return None
+
+
+def save(uid, spad_count, is_aperture, vhv, phase):
+    body = ustruct.pack(_RECORD[:-1], uid, spad_count, int(is_aperture), vhv, phase)
+    record = body + bytes((_checksum(body),))
+    records = [r for r in _records() if r[:8] != uid]
+    records.append(record)
+    calstore.save(CALFILE, [array('B', b''.join(records))], version=_VERSION)
+
+
+def forget():
+    try:
+        import os
+        os.remove(CALFILE)
+    except OSError:
+        pass